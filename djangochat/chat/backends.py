@@ -0,0 +1,54 @@
+"""
+Outils communs aux backends partagés entre workers (chat/presence.py,
+chat/ratelimit.py, chat/pubsub.py): connexion SQLite par thread et instance
+unique par processus, construite depuis les settings au premier usage.
+"""
+import os
+import sqlite3
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class SQLiteConnection:
+    """
+    Connexion au fichier `path` (WAL, autocommit), une par thread; rouverte
+    dans un processus fils (gunicorn --preload fork après l'import).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class Lazy:
+    """Instance unique, créée par `factory()` au premier get() (les settings sont alors chargés)."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.instance is None:
+            with self._lock:
+                if self.instance is None:
+                    self.instance = self.factory()
+        return self.instance
+
+
+def from_settings(setting: str, default: str):
+    """Backend settings.<setting>["BACKEND"] (défaut `default`), construit avec ["OPTIONS"]."""
+    conf = getattr(settings, setting, {})
+    return import_string(conf.get("BACKEND", default))(conf.get("OPTIONS", {}))
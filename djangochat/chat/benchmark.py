@@ -0,0 +1,133 @@
+"""
+Outils communs des commandes de mesure (benchmark_chat, loadtest_chat):
+base jetable, jeu de données reproductible et statistiques de latence.
+
+Le jeu de données: `members` utilisateurs bench-<i> membres de chacun des
+`rooms` salons bench-<i> (bench-0 en est le créateur), `messages` messages
+par salon. Contenu tiré d'un générateur initialisé par `seed`.
+"""
+import math
+import platform
+import random
+import sqlite3
+from contextlib import contextmanager
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from .models import Room, Message, Membership
+
+SEED_BATCH = 20000
+PREFIX = "bench-"
+
+WORDS = (
+    "salut bonjour merci oui non peut-être demain ce soir réunion projet code "
+    "revue test déploiement serveur base requête index cache latence message "
+    "salon chat réponse question idée problème solution café pause plus tard"
+).split()
+
+
+@contextmanager
+def scratch_database(path: str = None, keepdb: bool = False):
+    """
+    Base de test (comme `manage.py test`): créée et migrée à l'entrée,
+    détruite à la sortie sauf `keepdb`. `path`: fichier SQLite au lieu de
+    la base en mémoire, pour mesurer avec les vraies E/S.
+    """
+    if path:
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = path
+    old_name = connection.settings_dict["NAME"]
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        teardown_test_environment()
+
+
+def _content(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+
+
+def seed(rooms: int, members: int, messages: int, seed: int = 0, progress=None) -> dict:
+    """
+    Crée le jeu de données s'il n'existe pas déjà (base gardée avec keepdb).
+    Renvoie {"room_ids": [...], "user_ids": [...]}.
+    """
+    existing = list(Room.objects.filter(name__startswith=PREFIX).order_by("id").values_list("id", flat=True))
+    if existing:
+        user_ids = list(User.objects.filter(username__startswith=PREFIX).order_by("id").values_list("id", flat=True))
+        return {"room_ids": existing, "user_ids": user_ids}
+
+    rng = random.Random(seed)
+    password = make_password("bench")
+    with transaction.atomic():
+        User.objects.bulk_create(
+            [User(username=f"{PREFIX}{i}", password=password) for i in range(members)], batch_size=SEED_BATCH
+        )
+        user_ids = list(User.objects.filter(username__startswith=PREFIX).order_by("id").values_list("id", flat=True))
+        Room.objects.bulk_create([Room(name=f"{PREFIX}{i}", created_by_id=user_ids[0]) for i in range(rooms)])
+        room_ids = list(Room.objects.filter(name__startswith=PREFIX).order_by("id").values_list("id", flat=True))
+        Membership.objects.bulk_create(
+            [
+                Membership(room_id=room_id, user_id=user_id, role=Membership.OWNER if i == 0 else Membership.MEMBER)
+                for room_id in room_ids
+                for i, user_id in enumerate(user_ids)
+            ],
+            batch_size=SEED_BATCH,
+        )
+
+    for room_id in room_ids:
+        for start in range(0, messages, SEED_BATCH):
+            batch = [
+                Message(room_id=room_id, author_id=rng.choice(user_ids), content=_content(rng))
+                for _ in range(min(SEED_BATCH, messages - start))
+            ]
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            if progress is not None:
+                progress(room_id, start + len(batch), messages)
+        last = Message.objects.filter(room_id=room_id).select_related("author").order_by("-id").first()
+        if last is not None:
+            Room.objects.filter(id=room_id).update(
+                last_message_id=last.id,
+                last_message_content=last.content,
+                last_message_author=last.author.username,
+                last_message_created_at=last.created_at,
+            )
+    return {"room_ids": room_ids, "user_ids": user_ids}
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Rang le plus proche, sur une liste déjà triée."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def latency_summary(latencies_ms: list) -> dict:
+    values = sorted(latencies_ms)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50), 3),
+        "p90_ms": round(percentile(values, 90), 3),
+        "p95_ms": round(percentile(values, 95), 3),
+        "p99_ms": round(percentile(values, 99), 3),
+        "max_ms": round(values[-1], 3) if values else 0.0,
+    }
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "sqlite": sqlite3.sqlite_version if connection.vendor == "sqlite" else None,
+        "platform": platform.platform(),
+    }
@@ -0,0 +1,381 @@
+"""
+Transport WebSocket des salons (ws/rooms/<id>/), branché dans djangochat/asgi.py.
+
+Application ASGI brute, sans dépendance: chaque connexion est une coroutine,
+aucune thread n'est tenue pendant l'attente. Seuls les accès ORM passent par
+sync_to_async. Les droits sont ceux de chat/services.py, comme pour les vues HTTP.
+
+Client -> serveur:
+    {"type": "resume", "after": <id>, "seq": <seq>}
+    {"type": "send", "content": "..."}
+    {"type": "delete", "id": <message_id>}
+    {"type": "typing"}
+
+Serveur -> client:
+    {"type": "message", "message": {...}}
+    {"type": "delete", "deleted_ids": [...], "seq": <seq>}
+    {"type": "typing", "typing": [...]}
+    {"type": "state", "version": <v>, "room": {...}, "role": "...", "members": [...], "delta": true?}
+    {"type": "error", "error": "<code>"}
+    {"type": "error", "error": "rate_limited", "scope": "send"|"typing", "retry_after": <s>}
+
+Les nouveautés arrivent par le bus (chat/pubsub.py); la base n'est relue qu'à
+la reprise, si la file de l'abonné déborde, et toutes les RESYNC_INTERVAL s.
+Idem pour "en train d'écrire": copie locale tenue à jour par les événements
+"typing", le store (chat/presence.py) n'est relu qu'à la connexion et au resync.
+"""
+import asyncio
+import json
+import re
+import time
+from http.cookies import CookieError, SimpleCookie
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http import HttpRequest
+from django.http.request import split_domain_port, validate_host
+
+from .models import Room, Message, Membership
+from . import presence, pubsub, ratelimit, services
+from .pubsub import room_channel
+from .services import ChatError, active_typers, for_viewer, serialize_message
+
+ROOM_PATH = re.compile(r"^/ws/rooms/(?P<room_id>\d+)/$")
+
+TICK_INTERVAL = 1.0
+RESYNC_INTERVAL = 30.0
+
+# au-delà, SQLite refuse le paramètre (OverflowError)
+MAX_FRAME_INT = 2**63 - 1
+
+# codes de fermeture applicatifs (plage 4000-4999)
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_NOT_FOUND = 4404
+
+
+def database_sync_to_async(func):
+    """sync_to_async qui recycle les connexions DB comme le cycle requête/réponse."""
+
+    def inner(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(inner)
+
+
+def _headers(scope) -> dict:
+    return {name.decode("latin1").lower(): value.decode("latin1") for name, value in scope.get("headers", [])}
+
+
+def _origin_allowed(headers: dict) -> bool:
+    origin = headers.get("origin")
+    if not origin:
+        # pas de navigateur => pas de CSRF cross-site possible
+        return True
+    if origin in settings.CSRF_TRUSTED_ORIGINS:
+        return True
+    netloc = urlsplit(origin).netloc
+    if netloc == headers.get("host"):
+        return True
+    domain, _port = split_domain_port(netloc)
+    return bool(domain) and validate_host(domain, settings.ALLOWED_HOSTS)
+
+
+@database_sync_to_async
+def _load_user(cookie_header: str):
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header or "")
+    except CookieError:
+        pass
+    morsel = cookies.get(settings.SESSION_COOKIE_NAME)
+    engine = import_module(settings.SESSION_ENGINE)
+    request = HttpRequest()
+    request.session = engine.SessionStore(morsel.value if morsel else None)
+    return get_user(request)
+
+
+@database_sync_to_async
+def _load_room(room_id: int, user):
+    room = Room.objects.filter(id=room_id).first()
+    if room is None:
+        return None, None
+    return room, services.get_membership(user, room)
+
+
+def _frame_int(frame: dict, key: str, default=0):
+    """Entier positif d'une trame (nombre ou chaîne de chiffres); TypeError/ValueError sinon."""
+    value = frame.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise TypeError(key)
+    value = int(value)
+    if value > MAX_FRAME_INT:
+        raise ValueError(key)
+    return max(value, 0)
+
+
+class RoomSocket:
+    def __init__(self, scope, receive, send, room_id: int):
+        self.scope = scope
+        self.receive = receive
+        self._send = send
+        self._send_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self.room_id = room_id
+        self.user = None
+        self.room = None
+        self.membership = None
+        self.sub = None
+        self.after_id = 0
+        self.seq = 0
+        self.typing = {}
+        self.last_typing = None
+        self.state_version = None
+
+    async def send_json(self, payload: dict) -> None:
+        async with self._send_lock:
+            await self._send({"type": "websocket.send", "text": json.dumps(payload)})
+
+    async def close(self, code: int = 1000) -> None:
+        async with self._send_lock:
+            await self._send({"type": "websocket.close", "code": code})
+
+    async def run(self) -> None:
+        event = await self.receive()
+        if event["type"] != "websocket.connect":
+            return
+
+        headers = _headers(self.scope)
+        if not _origin_allowed(headers):
+            await self.close(CLOSE_FORBIDDEN)
+            return
+
+        self.user = await _load_user(headers.get("cookie", ""))
+        if not self.user.is_authenticated:
+            await self.close(CLOSE_UNAUTHORIZED)
+            return
+
+        self.room, self.membership = await _load_room(self.room_id, self.user)
+        if self.room is None:
+            await self.close(CLOSE_NOT_FOUND)
+            return
+        # on ne rejoint pas un salon via la socket: l'adhésion passe par room_detail
+        if not self.membership or self.membership.role == Membership.BANNED:
+            await self.close(CLOSE_FORBIDDEN)
+            return
+
+        self.sub, (self.after_id, self.seq) = await pubsub.asubscribe_and_read(
+            self._cursor, room_channel(self.room_id)
+        )
+        pusher = None
+        try:
+            self.typing = await self._load_typing()
+            async with self._send_lock:
+                await self._send({"type": "websocket.accept"})
+
+            pusher = asyncio.ensure_future(self.push_loop())
+            while True:
+                event = await self.receive()
+                if event["type"] == "websocket.disconnect":
+                    break
+                if event["type"] == "websocket.receive":
+                    await self.handle_frame(event.get("text") or "")
+        finally:
+            if pusher is not None:
+                pusher.cancel()
+            self.sub.close()
+
+    async def handle_frame(self, text: str) -> None:
+        # tout le contenu de la trame est validé ici: une valeur mal typée
+        # donne "bad_frame", jamais une exception qui tuerait la socket
+        try:
+            frame = json.loads(text)
+            kind = frame["type"]
+            after = _frame_int(frame, "after")
+            seq = _frame_int(frame, "seq", None)
+            message_id = _frame_int(frame, "id")
+            content = frame.get("content") or ""
+            if not isinstance(content, str):
+                raise TypeError("content")
+        except (ValueError, TypeError, KeyError):
+            await self.send_json({"type": "error", "error": "bad_frame"})
+            return
+
+        try:
+            if kind == "resume":
+                await self.flush_messages(after, seq)
+            elif kind == "send":
+                await self._send_message(content)
+            elif kind == "delete":
+                await self._delete_message(message_id)
+            elif kind == "typing":
+                await self._mark_typing()
+            else:
+                await self.send_json({"type": "error", "error": "bad_frame"})
+        except ratelimit.RateLimited as e:
+            await self.send_json(
+                {"type": "error", "error": e.code, "scope": e.scope, "retry_after": round(e.retry_after, 3)}
+            )
+        except ChatError as e:
+            await self.send_json({"type": "error", "error": e.code})
+            if e.code == "banned":
+                await self.close(CLOSE_FORBIDDEN)
+
+    async def push_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if not await self.flush_state():
+            return
+        next_resync = loop.time() + RESYNC_INTERVAL
+        while True:
+            event = await self.sub.aget(timeout=TICK_INTERVAL)
+            if self.sub.take_overflow() or loop.time() >= next_resync:
+                next_resync = loop.time() + RESYNC_INTERVAL
+                self.typing = await self._load_typing()
+                await self.flush_messages()
+                if not await self.flush_state():
+                    return
+            if event is not None and not await self.handle_event(event):
+                return
+            await self.flush_typing()
+
+    async def handle_event(self, event: dict) -> bool:
+        kind = event["type"]
+        if kind in ("message", "delete"):
+            # sous le verrou du curseur: une reprise en cours ne doit pas être
+            # doublée; déjà envoyé par flush_messages: ignoré
+            async with self._flush_lock:
+                if kind == "message" and event["message"]["id"] > self.after_id:
+                    self.after_id = event["message"]["id"]
+                    await self.send_json(
+                        {"type": "message", "message": for_viewer(event["message"], self.membership.role, self.user.id)}
+                    )
+                elif kind == "delete" and event["seq"] > self.seq:
+                    self.seq = event["seq"]
+                    await self.send_json({"type": "delete", "deleted_ids": [event["message_id"]], "seq": self.seq})
+        elif kind == "typing":
+            if event["expires"]:
+                self.typing[event["username"]] = event["expires"]
+            else:
+                self.typing.pop(event["username"], None)
+        elif kind == "room" and event["deleted"]:
+            await self.close(CLOSE_NOT_FOUND)
+            return False
+        elif kind in ("member", "room"):
+            return await self.flush_state()
+        return True
+
+    async def flush_messages(self, after: int = None, seq: int = None) -> None:
+        # appelé par la boucle et à la reprise (curseur du client): un seul
+        # curseur à la fois. Page après page jusqu'au bout, sinon le prochain
+        # événement en direct ferait sauter le curseur par-dessus le reste
+        async with self._flush_lock:
+            if after is not None:
+                self.after_id = after
+            if seq is not None:
+                self.seq = seq
+            while True:
+                previous_seq = self.seq
+                messages, deleted_ids = await self._changes()
+                for m in messages:
+                    self.after_id = max(self.after_id, m.id)
+                    await self.send_json(
+                        {"type": "message", "message": serialize_message(m, self.membership.role, self.user.id)}
+                    )
+                if deleted_ids:
+                    await self.send_json({"type": "delete", "deleted_ids": deleted_ids, "seq": self.seq})
+                if len(messages) < services.MESSAGES_PAGE_SIZE and self.seq == previous_seq:
+                    return
+
+    async def flush_typing(self) -> None:
+        now = time.time()
+        self.typing = {u: expires for u, expires in self.typing.items() if expires > now}
+        typing = active_typers(self.typing, self.user.username, now)
+        if typing != self.last_typing:
+            self.last_typing = typing
+            await self.send_json({"type": "typing", "typing": typing})
+
+    async def flush_state(self) -> bool:
+        # état complet au premier envoi, puis deltas depuis la version envoyée
+        try:
+            state = await self._room_state()
+        except ChatError as e:
+            await self.send_json({"type": "error", "error": e.code})
+            await self.close(CLOSE_FORBIDDEN)
+            return False
+        if not state.get("unchanged"):
+            self.state_version = state["version"]
+            await self.send_json({"type": "state", **state})
+        return True
+
+    # --- accès DB (thread pool) ---
+
+    def _membership(self):
+        # relue en base: self.room date de la connexion, sa state_version
+        # (clé du cache d'adhésion) ne verrait pas un bannissement
+        return Membership.objects.filter(user_id=self.user.id, room_id=self.room_id).first()
+
+    @database_sync_to_async
+    def _cursor(self):
+        last = Message.objects.filter(room_id=self.room_id).order_by("-id").values_list("id", flat=True).first()
+        seq = Room.objects.filter(id=self.room_id).values_list("change_seq", flat=True).first()
+        return last or 0, seq or 0
+
+    @database_sync_to_async
+    def _changes(self):
+        messages = services.messages_after(self.room_id, self.after_id)
+        deleted_ids, self.seq = services.changes_after(self.room_id, self.seq)
+        return messages, deleted_ids
+
+    @database_sync_to_async
+    def _send_message(self, content: str) -> None:
+        membership = self._membership()
+        if membership is None:
+            raise ChatError("forbidden", status=403)
+        ratelimit.hit("send", self.user.id, self.room_id)
+        services.send_message(self.user, self.room, membership, content)
+
+    @database_sync_to_async
+    def _delete_message(self, message_id: int) -> None:
+        membership = self._membership()
+        if membership is None:
+            raise ChatError("forbidden", status=403)
+        msg = Message.objects.filter(id=message_id, room_id=self.room_id).first()
+        if msg is None:
+            raise ChatError("not_found", status=404)
+        services.delete_message(self.user, membership, msg)
+
+    @database_sync_to_async
+    def _mark_typing(self) -> None:
+        ratelimit.hit("typing", self.user.id, self.room_id)
+        services.mark_typing(self._membership(), self.room_id, self.user.username)
+
+    @sync_to_async
+    def _load_typing(self) -> dict:
+        return presence.active(self.room_id)
+
+    @database_sync_to_async
+    def _room_state(self) -> dict:
+        room = Room.objects.filter(id=self.room_id).first()
+        if room is None:
+            raise ChatError("not_found", status=404)
+        self.membership = self._membership()
+        return services.room_state(room, self.membership, self.state_version)
+
+
+async def websocket_application(scope, receive, send):
+    match = ROOM_PATH.match(scope.get("path", ""))
+    if match is None:
+        await receive()
+        await send({"type": "websocket.close", "code": CLOSE_NOT_FOUND})
+        return
+    await RoomSocket(scope, receive, send, int(match.group("room_id"))).run()
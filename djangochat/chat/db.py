@@ -0,0 +1,192 @@
+"""
+Profil SQLite de production (réglages dans settings.DATABASES / CHAT_DB).
+
+- Les PRAGMA (WAL, synchronous, mmap, cache) sont appliqués à l'ouverture de
+  chaque connexion par OPTIONS["init_command"]; transaction_mode IMMEDIATE
+  fait prendre le verrou d'écriture dès le BEGIN, donc sous le busy timeout,
+  au lieu d'échouer en "database is locked" au premier UPDATE.
+- Optionnel: les vues de poll marquées @poll_reads lisent par l'alias
+  CHAT_DB["READ_ALIAS"] (connexion query_only), jamais par celle qui écrit.
+- Les insertions de messages passent par un seul écrivain par processus
+  (message_writer): les threads attendent sur un verrou Python, en file,
+  plutôt que de se disputer le verrou SQLite.
+- Optionnel (CHAT_DB["BATCH_WRITES"]): ces insertions sont regroupées par une
+  thread d'écriture, plusieurs requêtes par transaction (group commit).
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+
+_read_alias = ContextVar("chat_read_alias", default=None)
+_writer_lock = threading.Lock()
+
+
+def _conf() -> dict:
+    return getattr(settings, "CHAT_DB", {})
+
+
+def read_alias():
+    alias = _conf().get("READ_ALIAS")
+    return alias if alias in settings.DATABASES else None
+
+
+class ReadAliasRouter:
+    """Route les lectures des vues @poll_reads vers l'alias en lecture seule."""
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # un objet lu par l'alias de lecture s'enregistre quand même par "default"
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # les deux alias pointent sur le même fichier
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return False if db == read_alias() else None
+
+
+def poll_reads(view):
+    """
+    Lectures de la vue par l'alias de lecture, s'il est configuré. Ne couvre
+    que l'exécution de la vue: le corps d'une réponse streamée lit par défaut.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        alias = read_alias()
+        if alias is None:
+            return view(request, *args, **kwargs)
+        token = _read_alias.set(alias)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _read_alias.reset(token)
+
+    return wrapper
+
+
+@contextmanager
+def message_writer():
+    """
+    Transaction d'insertion de message, un seul écrivain à la fois par processus
+    (CHAT_DB["SERIALIZE_MESSAGE_WRITES"]). Ne pas appeler depuis un atomic()
+    déjà ouvert: la transaction externe tiendrait le verrou SQLite en attendant ce verrou-ci.
+    """
+    if not _conf().get("SERIALIZE_MESSAGE_WRITES", True):
+        with transaction.atomic():
+            yield
+        return
+    with _writer_lock, transaction.atomic():
+        yield
+
+
+class GroupCommitWriter:
+    """
+    Thread d'écriture qui exécute les insertions soumises par les requêtes
+    concurrentes dans une même transaction: la première attend au plus
+    `window` secondes que d'autres arrivent (ou `max_batch`), puis un seul
+    COMMIT pour tout le lot. Chaque insertion a son savepoint: une erreur
+    n'annule que la sienne et remonte à la requête qui l'a soumise.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, fn):
+        """Exécute fn() dans le prochain lot et renvoie son résultat (bloquant)."""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((fn, future))
+        return future.result()
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # une thread par processus (gunicorn --preload fork après l'import)
+                self._queue = queue.SimpleQueue()
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._queue,), name="chat-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self, q) -> None:
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch) -> None:
+        outcomes = []
+        try:
+            with _writer_lock, transaction.atomic():
+                for fn, future in batch:
+                    try:
+                        with transaction.atomic():
+                            outcomes.append((future, fn(), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+        except Exception as e:
+            # COMMIT refusé: rien n'a été écrit; connexion rouverte au prochain lot
+            connection.close()
+            for _fn, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_group_writer = None
+_group_writer_lock = threading.Lock()
+
+
+def _get_group_writer() -> GroupCommitWriter:
+    global _group_writer
+    if _group_writer is None:
+        with _group_writer_lock:
+            if _group_writer is None:
+                conf = _conf()
+                _group_writer = GroupCommitWriter(conf.get("BATCH_WINDOW", 0.005), conf.get("BATCH_MAX", 100))
+    return _group_writer
+
+
+def run_message_write(fn):
+    """
+    Exécute fn() (insertion d'un message) en transaction et renvoie son résultat:
+    par la thread de group commit si CHAT_DB["BATCH_WRITES"], sinon sur place.
+    Dans un atomic() déjà ouvert, toujours sur place: l'écriture doit faire
+    partie de la transaction de l'appelant.
+    """
+    if _conf().get("BATCH_WRITES") and not connection.in_atomic_block:
+        return _get_group_writer().submit(fn)
+    with message_writer():
+        return fn()
@@ -0,0 +1,357 @@
+"""
+Générateur de charge (manage.py loadtest_chat): des utilisateurs simulés qui
+suivent le calendrier de chat.js en transport HTTP (long-poll des messages,
+api_sync adaptatif, ping "en train d'écrire" puis envoi, lobby api_room_list
+avec ETag) contre un serveur WSGI multi-thread lancé dans un processus à
+part, sur une base SQLite jetable. Les transports WebSocket et SSE demandent
+un serveur ASGI et ne sont pas simulés (cf. SimUser).
+
+Un envoi porte un jeton "lt:<n>"; la latence de livraison est mesurée du
+POST jusqu'à ce que chaque autre membre du salon le reçoive (long-poll ou
+sync). Les erreurs "database is locked" sont comptées côté serveur.
+"""
+import http.client
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.signals import got_request_exception
+from django.db import OperationalError, connections
+
+from .benchmark import latency_summary
+
+# mêmes bornes que adaptivePoll() dans chat.js
+POLL_DEFAULT_MS = 3000
+POLL_MAX_MS = 30000
+POLL_MAX_BACKOFF = 3
+TYPING_BEFORE_SEND = 0.8
+REQUEST_TIMEOUT = 30
+# mêmes valeurs que LONG_POLL_WAIT_S / LONG_POLL_RETRY_MS de chat.js
+LONG_POLL_WAIT_S = 25
+LONG_POLL_RETRY_S = 3
+
+TRANSPORTS = ("longpoll", "poll")
+# requêtes qui attendent par construction: hors de la latence globale (seuil de saturation)
+LONG_POLL_ENDPOINT = "api_messages_wait"
+
+_TOKEN = re.compile(r"\blt:(\d+)\b")
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def _serve(ready, lock_errors, server_errors):
+    connections.close_all()
+
+    def on_exception(sender, request=None, **kwargs):
+        exc = sys.exc_info()[1]
+        if isinstance(exc, OperationalError) and "locked" in str(exc):
+            with lock_errors.get_lock():
+                lock_errors.value += 1
+        else:
+            with server_errors.get_lock():
+                server_errors.value += 1
+
+    got_request_exception.connect(on_exception, weak=False)
+    httpd = ThreadedWSGIServer(("127.0.0.1", 0), _QuietHandler, allow_reuse_address=True)
+    httpd.daemon_threads = True
+    httpd.set_app(WSGIHandler())
+    ready.put(httpd.server_address[1])
+    httpd.serve_forever()
+
+
+class Server:
+    """Serveur de l'application dans un processus fils (son propre GIL), sur la base courante."""
+
+    def __init__(self):
+        ctx = multiprocessing.get_context("fork")
+        self.lock_errors = ctx.Value("i", 0)
+        self.server_errors = ctx.Value("i", 0)
+        ready = ctx.Queue()
+        connections.close_all()
+        self.process = ctx.Process(target=_serve, args=(ready, self.lock_errors, self.server_errors), daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join(5)
+
+
+def login_cookie(user: User) -> str:
+    """Session ouverte directement en base (comme Client.force_login), sans mot de passe."""
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return session.session_key
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latencies = {}
+            self.statuses = {}
+            self.errors = 0
+            self.delivery = []
+            self.sends = 0
+            self.started = time.monotonic()
+
+    def request(self, endpoint: str, status, elapsed_ms: float):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed_ms)
+            key = str(status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            if status is None or status >= 500:
+                self.errors += 1
+
+    def delivered(self, latency_ms: float):
+        with self._lock:
+            self.delivery.append(latency_ms)
+
+    def sent(self):
+        with self._lock:
+            self.sends += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            total = sum(len(v) for v in self.latencies.values())
+            all_latencies = list(
+                itertools.chain.from_iterable(v for k, v in self.latencies.items() if k != LONG_POLL_ENDPOINT)
+            )
+            return {
+                "duration_s": round(elapsed, 3),
+                "requests": total,
+                "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+                "errors": self.errors,
+                "error_rate": round(self.errors / total, 4) if total else 0.0,
+                "rate_limited": self.statuses.get("429", 0),
+                "status": dict(self.statuses),
+                "latency": latency_summary(all_latencies),
+                "latency_by_endpoint": {k: latency_summary(v) for k, v in self.latencies.items()},
+                "sends": self.sends,
+                "delivery_latency": latency_summary(self.delivery),
+            }
+
+
+class _Connection:
+    """Connexion keep-alive d'un onglet; chaque requête est comptée dans Stats."""
+
+    def __init__(self, run, headers: dict, timeout: float = REQUEST_TIMEOUT):
+        self.run_ = run
+        self.headers = headers
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, endpoint: str, method: str, path: str, body: dict = None, headers=None):
+        headers = dict(self.headers, **(headers or {}))
+        payload = None
+        if body is not None:
+            payload = urlencode(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        started = time.monotonic()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.run_.port, timeout=self.timeout)
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.run_.stats.request(endpoint, None, (time.monotonic() - started) * 1000)
+            self.close()
+            return None, None, b""
+        self.run_.stats.request(endpoint, response.status, (time.monotonic() - started) * 1000)
+        return response.status, response, data
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+
+
+class SimUser(threading.Thread):
+    """
+    Un onglet: dans un salon ou sur le lobby (liste des salons).
+
+    Dans un salon, transport "longpoll" (ce que fait chat.js face à un
+    serveur WSGI: pas de WebSocket, SSE refusé par un 503): une thread de
+    long-poll api_messages?wait= sur sa propre connexion, et api_sync
+    sans les messages (messages=0) au rythme adaptatif, plus les envois.
+    Transport "poll": api_sync avec les messages, le repli de chat.js
+    sans long-poll ni SSE.
+    """
+
+    def __init__(self, run, username: str, session_key: str, room_id, send_interval: float, rng):
+        super().__init__(daemon=True)
+        self.run_ = run
+        self.username = username
+        self.room_id = room_id
+        self.send_interval = send_interval
+        self.rng = rng
+        csrf = secrets.token_hex(16)
+        self.headers = {"Cookie": f"sessionid={session_key}; csrftoken={csrf}", "X-CSRFToken": csrf}
+        self.http = _Connection(run, self.headers)
+        # état du client, comme chat.js
+        self.after = run.last_ids.get(room_id) or 0
+        self.seq = None
+        self.state_version = -1
+        self.etag = None
+        self.interval = 0
+        self.empty_streak = 0
+
+    def _next_poll(self, empty: bool, wait_ms: float = 0) -> float:
+        self.empty_streak = self.empty_streak + 1 if empty else 0
+        base = self.interval or POLL_DEFAULT_MS
+        delay = min(base * 2 ** min(self.empty_streak, POLL_MAX_BACKOFF), max(base, POLL_MAX_MS))
+        return max(delay, wait_ms) / 1000
+
+    def _received(self, resp: dict) -> None:
+        now = time.monotonic()
+        for m in resp.get("messages", []):
+            self.after = max(self.after, m["id"])
+            match = _TOKEN.search(m["content"])
+            if match and m["author"] != self.username:
+                sent_at = self.run_.sent_at.get(int(match.group(1)))
+                if sent_at is not None:
+                    self.run_.stats.delivered((now - sent_at) * 1000)
+        self.seq = resp.get("seq", self.seq)
+
+    def long_poll(self) -> None:
+        conn = _Connection(self.run_, self.headers, timeout=LONG_POLL_WAIT_S + 10)
+        stop = self.run_.stop
+        while not stop.is_set():
+            params = {"after": self.after, "wait": LONG_POLL_WAIT_S}
+            if self.seq is not None:
+                params["seq"] = self.seq
+            status, response, data = conn.request(
+                LONG_POLL_ENDPOINT, "GET", f"/api/rooms/{self.room_id}/messages/?{urlencode(params)}"
+            )
+            if stop.is_set():
+                # serveur arrêté pendant l'attente: réponse tronquée
+                break
+            if status == 200:
+                self._received(json.loads(data))
+                continue
+            retry = response.getheader("Retry-After") if status == 429 else None
+            stop.wait(float(retry) if retry else LONG_POLL_RETRY_S)
+        conn.close()
+
+    def sync(self) -> float:
+        params = {"state_version": self.state_version}
+        if self.run_.transport == "longpoll":
+            params["messages"] = 0
+        else:
+            params["after"] = self.after
+            if self.seq is not None:
+                params["seq"] = self.seq
+        status, response, data = self.http.request("api_sync", "GET", f"/api/rooms/{self.room_id}/sync/?{urlencode(params)}")
+        if status != 200:
+            retry = response.getheader("Retry-After") if status == 429 else None
+            return self._next_poll(True, float(retry or 0) * 1000)
+        resp = json.loads(data)
+        self._received(resp)
+        if "state" in resp:
+            self.state_version = resp["state"]["version"]
+        self.interval = resp.get("next_poll_ms") or 0
+        empty = not resp.get("messages") and not resp.get("deleted_ids") and not resp.get("typing") and "state" not in resp
+        return self._next_poll(empty)
+
+    def send(self) -> float:
+        self.http.request("api_typing", "POST", f"/api/rooms/{self.room_id}/typing/", {})
+        time.sleep(TYPING_BEFORE_SEND)
+        token = next(self.run_.tokens)
+        self.run_.sent_at[token] = time.monotonic()
+        status, _response, _data = self.http.request(
+            "api_send_message", "POST", f"/api/rooms/{self.room_id}/send/", {"content": f"charge lt:{token}"}
+        )
+        if status == 200:
+            self.run_.stats.sent()
+            # comme chat.js: une activité locale remet le poll au rythme suggéré
+            self.empty_streak = 0
+        return self.rng.expovariate(1 / self.send_interval)
+
+    def lobby(self) -> float:
+        headers = {"If-None-Match": self.etag} if self.etag else None
+        status, response, data = self.http.request("api_room_list", "GET", "/api/rooms/", headers=headers)
+        if status == 200:
+            self.etag = response.getheader("ETag")
+            self.interval = json.loads(data).get("next_poll_ms") or 0
+        return self._next_poll(status != 200)
+
+    def run(self):
+        stop = self.run_.stop
+        # départs étalés, comme des onglets ouverts à des moments différents
+        if stop.wait(self.rng.uniform(0, 1)):
+            return
+        if self.room_id is None:
+            timers = {"lobby": time.monotonic()}
+        else:
+            timers = {"sync": time.monotonic()}
+            if self.send_interval > 0:
+                timers["send"] = time.monotonic() + self.rng.expovariate(1 / self.send_interval)
+            if self.run_.transport == "longpoll":
+                threading.Thread(target=self.long_poll, daemon=True).start()
+        while not stop.is_set():
+            name = min(timers, key=timers.get)
+            if stop.wait(max(timers[name] - time.monotonic(), 0)):
+                break
+            delay = getattr(self, name)()
+            timers[name] = time.monotonic() + delay
+        self.http.close()
+
+
+class LoadRun:
+    def __init__(
+        self, port: int, last_ids: dict, sessions: list, send_interval: float, lobby_ratio: float, seed: int,
+        transport: str = "longpoll",
+    ):
+        self.port = port
+        self.transport = transport
+        # salon -> dernier message au départ: le client arrive avec la page déjà chargée
+        self.last_ids = last_ids
+        self.room_ids = sorted(last_ids)
+        self.sessions = sessions
+        self.send_interval = send_interval
+        self.lobby_ratio = lobby_ratio
+        self.rng = random.Random(seed)
+        self.stats = Stats()
+        self.stop = threading.Event()
+        self.tokens = itertools.count(1)
+        self.sent_at = {}
+        self.users = []
+
+    def grow(self, count: int) -> None:
+        """Ajoute des utilisateurs jusqu'à `count` (les salons sont attribués en tourniquet)."""
+        while len(self.users) < count:
+            i = len(self.users)
+            username, session_key = self.sessions[i]
+            in_lobby = self.rng.random() < self.lobby_ratio
+            room_id = None if in_lobby else self.room_ids[i % len(self.room_ids)]
+            user = SimUser(self, username, session_key, room_id, self.send_interval, random.Random(self.rng.random()))
+            self.users.append(user)
+            user.start()
+
+    def shutdown(self) -> None:
+        self.stop.set()
+        for user in self.users:
+            user.join(REQUEST_TIMEOUT)
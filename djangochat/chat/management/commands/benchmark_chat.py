@@ -0,0 +1,135 @@
+import json
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from chat import benchmark
+from chat.models import Room
+
+ENDPOINTS = (
+    "api_messages",
+    "api_send_message",
+    "api_room_list",
+    "api_room_state",
+    "api_typing_get",
+    "api_typing_post",
+    "room_detail",
+)
+CLIENTS = 20
+
+
+class Command(BaseCommand):
+    help = (
+        "Mesure latence (percentiles) et requêtes SQL par appel des endpoints du chat, "
+        "sur une base jetable peuplée de façon reproductible. Résultat en JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=5)
+        parser.add_argument("--members", type=int, default=50, help="membres par salon")
+        parser.add_argument("--messages", type=int, default=10000, help="messages par salon")
+        parser.add_argument("--requests", type=int, default=200, help="appels mesurés par endpoint")
+        parser.add_argument("--warmup", type=int, default=20, help="appels non mesurés par endpoint")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--endpoint", action="append", choices=ENDPOINTS, help="à répéter; défaut: tous")
+        parser.add_argument("--db", help="fichier SQLite de la base jetable (défaut: en mémoire)")
+        parser.add_argument("--keepdb", action="store_true", help="garder la base peuplée pour le prochain run")
+        parser.add_argument("--output", help="fichier JSON (défaut: sortie standard)")
+
+    def handle(self, *args, **options):
+        for name in ("rooms", "members", "requests"):
+            if options[name] < 1:
+                raise CommandError(f"--{name} doit être positif.")
+        if options["messages"] < 0 or options["warmup"] < 0:
+            raise CommandError("--messages et --warmup ne peuvent pas être négatifs.")
+
+        # pas de limite de débit ni de DEBUG (journal des requêtes) pendant la mesure
+        with benchmark.scratch_database(options["db"], options["keepdb"]), override_settings(
+            DEBUG=False, CHAT_RATELIMIT={}
+        ):
+            started = time.perf_counter()
+            data = benchmark.seed(
+                options["rooms"], options["members"], options["messages"], options["seed"], self._progress(options)
+            )
+            seed_seconds = time.perf_counter() - started
+            results = self._run(data, options)
+            report = {
+                "config": {
+                    k: options[k] for k in ("rooms", "members", "messages", "requests", "warmup", "seed")
+                },
+                "environment": benchmark.environment(),
+                "seed_seconds": round(seed_seconds, 3),
+                "endpoints": results,
+            }
+
+        body = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(body + "\n")
+            self.stderr.write(f"Résultats écrits dans {options['output']}")
+        else:
+            self.stdout.write(body)
+
+    def _progress(self, options):
+        def progress(room_id, done, total):
+            if options["verbosity"] >= 2:
+                self.stderr.write(f"salon {room_id}: {done}/{total} messages")
+
+        return progress
+
+    def _run(self, data, options) -> dict:
+        rng = random.Random(options["seed"])
+        clients = []
+        for user_id in data["user_ids"][:CLIENTS]:
+            client = Client()
+            client.force_login(User.objects.get(id=user_id))
+            clients.append(client)
+
+        calls = _calls(data["room_ids"])
+        results = {}
+        for name in options["endpoint"] or ENDPOINTS:
+            call = calls[name]
+            for _ in range(options["warmup"]):
+                call(rng.choice(clients), rng.choice(data["room_ids"]))
+
+            latencies, queries, statuses = [], [], {}
+            for _ in range(options["requests"]):
+                client, room_id = rng.choice(clients), rng.choice(data["room_ids"])
+                with CaptureQueriesContext(connection) as ctx:
+                    started = time.perf_counter()
+                    response = call(client, room_id)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                queries.append(len(ctx.captured_queries))
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+            results[name] = dict(
+                benchmark.latency_summary(latencies),
+                queries_mean=round(sum(queries) / len(queries), 2),
+                queries_max=max(queries),
+                status=statuses,
+            )
+        return results
+
+
+def _calls(room_ids) -> dict:
+    # dernier id par salon, pour demander "les messages après un id récent" comme le poll
+    last_ids = dict(Room.objects.filter(id__in=room_ids).values_list("id", "last_message_id"))
+
+    def url(name, room_id):
+        return reverse(name, args=[room_id])
+
+    return {
+        "api_messages": lambda c, r: c.get(url("api_messages", r), {"after": max((last_ids[r] or 0) - 5, 0)}),
+        "api_send_message": lambda c, r: c.post(url("api_send_message", r), {"content": "benchmark"}),
+        "api_room_list": lambda c, r: c.get(reverse("api_room_list")),
+        "api_room_state": lambda c, r: c.get(url("api_room_state", r)),
+        "api_typing_get": lambda c, r: c.get(url("api_typing", r)),
+        "api_typing_post": lambda c, r: c.post(url("api_typing", r)),
+        "room_detail": lambda c, r: c.get(url("room_detail", r)),
+    }
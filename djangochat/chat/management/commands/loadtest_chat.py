@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from chat import benchmark, loadtest
+from chat.models import Room
+
+
+def _steps(raw: str) -> list:
+    try:
+        steps = sorted({int(n) for n in raw.split(",") if n.strip()})
+    except ValueError:
+        raise CommandError("--users attend une liste d'entiers, ex. 10,25,50.")
+    if not steps or steps[0] < 1:
+        raise CommandError("--users doit contenir des nombres positifs.")
+    return steps
+
+
+class Command(BaseCommand):
+    help = (
+        "Charge concurrente réaliste: des utilisateurs simulés suivent le calendrier de chat.js "
+        "contre un serveur local, par paliers croissants, jusqu'à saturation. Débit, taux "
+        "d'erreur (dont 'database is locked'), latences et délai de livraison en JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", default="10,25,50,100", help="paliers d'utilisateurs simultanés")
+        parser.add_argument("--step-duration", type=float, default=30, help="secondes mesurées par palier")
+        parser.add_argument("--settle", type=float, default=3, help="secondes non mesurées après chaque montée")
+        parser.add_argument("--send-interval", type=float, default=20, help="secondes entre deux envois d'un utilisateur (moyenne, 0: aucun)")
+        parser.add_argument("--lobby-ratio", type=float, default=0.1, help="part des utilisateurs sur la liste des salons")
+        parser.add_argument(
+            "--transport",
+            choices=loadtest.TRANSPORTS,
+            default="longpoll",
+            help="longpoll: chat.js face à un serveur WSGI (long-poll + sync sans messages); "
+            "poll: sync avec les messages",
+        )
+        parser.add_argument("--rooms", type=int, default=5)
+        parser.add_argument("--messages", type=int, default=1000, help="messages par salon au départ")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--slo-ms", type=float, default=500, help="p95 de latence des requêtes au-delà duquel le palier est saturé")
+        parser.add_argument("--max-error-rate", type=float, default=0.01)
+        parser.add_argument("--full-ramp", action="store_true", help="continuer les paliers après la saturation")
+        parser.add_argument("--db", help="fichier SQLite de la base jetable (défaut: fichier temporaire)")
+        parser.add_argument("--keepdb", action="store_true", help="garder la base peuplée pour le prochain run")
+        parser.add_argument("--output", help="fichier JSON (défaut: sortie standard)")
+
+    def handle(self, *args, **options):
+        steps = _steps(options["users"])
+        if options["step_duration"] <= 0 or options["settle"] < 0 or options["send_interval"] < 0:
+            raise CommandError("--step-duration doit être positif, --settle et --send-interval non négatifs.")
+        if not 0 <= options["lobby_ratio"] <= 1:
+            raise CommandError("--lobby-ratio doit être entre 0 et 1.")
+        if options["rooms"] < 1 or options["messages"] < 0:
+            raise CommandError("--rooms doit être positif et --messages non négatif.")
+
+        # le serveur tourne dans un autre processus: la base doit être un fichier
+        tmpdir = None
+        path = options["db"]
+        if not path:
+            tmpdir = tempfile.mkdtemp(prefix="loadtest-")
+            path = os.path.join(tmpdir, "loadtest.sqlite3")
+
+        try:
+            # pas de limite de débit: on cherche la capacité du serveur, pas celle du limiteur
+            with benchmark.scratch_database(path, options["keepdb"]), override_settings(
+                DEBUG=False, CHAT_RATELIMIT={}
+            ):
+                data = benchmark.seed(options["rooms"], steps[-1], options["messages"], options["seed"])
+                if len(data["user_ids"]) < steps[-1]:
+                    raise CommandError(
+                        f"La base gardée n'a que {len(data['user_ids'])} utilisateurs bench-*, "
+                        f"il en faut {steps[-1]}: relancer sans --keepdb."
+                    )
+                report = self._run(data, steps, options)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        body = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(body + "\n")
+            self.stderr.write(f"Résultats écrits dans {options['output']}")
+        else:
+            self.stdout.write(body)
+
+    def _run(self, data, steps, options) -> dict:
+        users = User.objects.filter(id__in=data["user_ids"][: steps[-1]]).order_by("id")
+        sessions = [(user.username, loadtest.login_cookie(user)) for user in users]
+        last_ids = dict(Room.objects.filter(id__in=data["room_ids"]).values_list("id", "last_message_id"))
+
+        server = loadtest.Server()
+        run = loadtest.LoadRun(
+            server.port, last_ids, sessions, options["send_interval"], options["lobby_ratio"], options["seed"],
+            options["transport"],
+        )
+        results, sustained, saturated_at = [], 0, None
+        try:
+            for count in steps:
+                run.grow(count)
+                time.sleep(options["settle"])
+                run.stats.reset()
+                locked, exceptions = server.lock_errors.value, server.server_errors.value
+                time.sleep(options["step_duration"])
+
+                step = dict(users=count, **run.stats.snapshot())
+                step["sqlite_locked"] = server.lock_errors.value - locked
+                step["server_exceptions"] = server.server_errors.value - exceptions
+                step["saturated"] = (
+                    step["error_rate"] > options["max_error_rate"] or step["latency"]["p95_ms"] > options["slo_ms"]
+                )
+                results.append(step)
+                if options["verbosity"] >= 2:
+                    self.stderr.write(
+                        f"{count} utilisateurs: {step['throughput_rps']} req/s, p95 {step['latency']['p95_ms']} ms, "
+                        f"erreurs {step['error_rate']:.2%}"
+                    )
+                if step["saturated"]:
+                    saturated_at = saturated_at or count
+                    if not options["full_ramp"]:
+                        break
+                elif saturated_at is None:
+                    sustained = count
+        finally:
+            run.shutdown()
+            server.stop()
+
+        return {
+            "config": {
+                k: options[k]
+                for k in (
+                    "users", "transport", "step_duration", "settle", "send_interval", "lobby_ratio",
+                    "rooms", "messages", "seed", "slo_ms", "max_error_rate",
+                )
+            },
+            "environment": benchmark.environment(),
+            "steps": results,
+            "saturation": {"max_sustained_users": sustained, "saturated_at_users": saturated_at},
+        }
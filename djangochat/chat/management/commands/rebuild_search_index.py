@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import search
+
+
+class Command(BaseCommand):
+    help = "Reconstruit l'index plein texte des messages (FTS5) par lots."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError("La recherche plein texte n'existe que sur SQLite (FTS5).")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size doit être positif.")
+
+        def progress(done, total, indexed):
+            if options["verbosity"] >= 2:
+                self.stdout.write(f"{done}/{total} ids parcourus, {indexed} messages indexés")
+
+        indexed = search.rebuild_index(options["batch_size"], progress)
+        self.stdout.write(self.style.SUCCESS(f"{indexed} messages indexés."))
@@ -0,0 +1,181 @@
+"""
+Mesures des vues, agrégées en mémoire du processus et exposées au format
+texte Prometheus (vue `metrics`): histogramme de latence par vue, nombre et
+durée des requêtes SQL, octets de réponse, succès/échecs des caches.
+
+Seule une fraction CHAT_METRICS["SAMPLE_RATE"] des requêtes est mesurée
+(MetricsMiddleware); les compteurs portent sur cet échantillon, le taux est
+exporté pour les extrapoler. Les requêtes SQL sont comptées par un
+execute_wrapper posé sur chaque connexion le temps de la requête: celles des
+threads d'arrière-plan (GroupCommitWriter) n'y figurent pas.
+
+Pour les réponses en flux (SSE, NDJSON), la latence s'arrête au premier
+octet et la taille n'est pas comptée.
+"""
+import bisect
+import random
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+DEFAULTS = {"ENABLED": True, "SAMPLE_RATE": 1.0, "TOKEN": None}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # s
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_current = ContextVar("chat_metrics_sample", default=None)
+
+
+def conf(key: str):
+    return getattr(settings, "CHAT_METRICS", {}).get(key, DEFAULTS[key])
+
+
+def sampled() -> bool:
+    if not conf("ENABLED"):
+        return False
+    rate = conf("SAMPLE_RATE")
+    return rate >= 1 or random.random() < rate
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.bounds, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            yield bound, total
+
+
+class ViewStats:
+    __slots__ = ("latency", "queries", "query_seconds", "response_bytes", "statuses")
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.query_seconds = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+
+
+class Sample:
+    """Requête en cours de mesure: compteur passé à connection.execute_wrapper."""
+
+    __slots__ = ("queries", "query_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - started
+            self.queries += 1
+
+    def measure(self):
+        """Contexte: pose le wrapper sur toutes les connexions et rend l'échantillon courant."""
+        stack = ExitStack()
+        for conn in connections.all():
+            stack.enter_context(conn.execute_wrapper(self))
+        token = _current.set(self)
+        stack.callback(_current.reset, token)
+        return stack
+
+
+class Registry:
+    def __init__(self):
+        self._views = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def record(self, view: str, status: int, seconds: float, sample: Sample, nbytes) -> None:
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = ViewStats()
+            stats.latency.observe(seconds)
+            stats.queries.observe(sample.queries)
+            stats.query_seconds += sample.query_seconds
+            if nbytes is not None:
+                stats.response_bytes += nbytes
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+    def cache(self, name: str, hit: bool) -> None:
+        key = (name, "hit" if hit else "miss")
+        with self._lock:
+            self._caches[key] = self._caches.get(key, 0) + 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._views.clear()
+            self._caches.clear()
+
+    def render(self) -> str:
+        with self._lock:
+            views = sorted(self._views.items())
+            lines = [
+                "# HELP chat_metrics_sample_rate Fraction of requests measured.",
+                "# TYPE chat_metrics_sample_rate gauge",
+                f"chat_metrics_sample_rate {_number(conf('SAMPLE_RATE'))}",
+            ]
+            _histogram(lines, "chat_request_duration_seconds", "Sampled request latency per view.", views, "latency")
+            _histogram(lines, "chat_request_queries", "SQL queries per sampled request.", views, "queries")
+
+            lines += ["# HELP chat_requests_total Sampled requests per view and status.", "# TYPE chat_requests_total counter"]
+            for view, stats in views:
+                for status, n in sorted(stats.statuses.items()):
+                    lines.append(f'chat_requests_total{{view="{view}",status="{status}"}} {n}')
+            lines += ["# HELP chat_query_seconds_total SQL time of sampled requests.", "# TYPE chat_query_seconds_total counter"]
+            lines += [f'chat_query_seconds_total{{view="{v}"}} {_number(s.query_seconds)}' for v, s in views]
+            lines += ["# HELP chat_response_bytes_total Body size of sampled non-streaming responses.", "# TYPE chat_response_bytes_total counter"]
+            lines += [f'chat_response_bytes_total{{view="{v}"}} {s.response_bytes}' for v, s in views]
+            lines += ["# HELP chat_cache_requests_total Cache lookups in sampled requests.", "# TYPE chat_cache_requests_total counter"]
+            for (name, result), n in sorted(self._caches.items()):
+                lines.append(f'chat_cache_requests_total{{cache="{name}",result="{result}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _histogram(lines: list, name: str, help_text: str, views, attr: str) -> None:
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for view, stats in views:
+        h = getattr(stats, attr)
+        for bound, total in h.cumulative():
+            lines.append(f'{name}_bucket{{view="{view}",le="{_number(bound)}"}} {total}')
+        lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {h.count}')
+        lines.append(f'{name}_sum{{view="{view}"}} {_number(h.sum)}')
+        lines.append(f'{name}_count{{view="{view}"}} {h.count}')
+
+
+registry = Registry()
+
+
+def cache_lookup(name: str, hit: bool) -> None:
+    """Succès ou échec d'un cache, compté seulement dans une requête échantillonnée."""
+    if _current.get() is not None:
+        registry.cache(name, hit)
@@ -0,0 +1,83 @@
+import time
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+
+try:
+    import brotli
+except ImportError:  # dépendance optionnelle
+    brotli = None
+
+from . import metrics
+
+re_accepts_brotli = _lazy_re_compile(r"\bbr\b")
+
+# Seules les réponses d'API sont compressées: pas les pages HTML (jeton CSRF, BREACH)
+COMPRESSED_TYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "application/msgpack",
+    "application/vnd.djangochat.columnar+json",
+)
+BROTLI_QUALITY = 5
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware de Django limité aux réponses d'API, avec brotli en
+    priorité si le module est installé et que le client l'accepte. Le flux
+    SSE n'est jamais compressé: gzip retiendrait les événements dans son tampon.
+    """
+
+    def process_response(self, request, response):
+        content_type = response.get("Content-Type", "").split(";")[0].strip()
+        if content_type not in COMPRESSED_TYPES:
+            return response
+        if (
+            brotli is None
+            or response.streaming
+            or response.has_header("Content-Encoding")
+            or len(response.content) < 200
+            or not re_accepts_brotli.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        ):
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        compressed = brotli.compress(response.content, quality=BROTLI_QUALITY)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response.headers["Content-Length"] = str(len(compressed))
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = "br"
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Mesure un échantillon des requêtes (chat/metrics.py). À placer en tête de
+    MIDDLEWARE: la latence couvre toute la pile, la taille est celle envoyée
+    (après compression).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not metrics.sampled():
+            return self.get_response(request)
+        sample = metrics.Sample()
+        started = time.perf_counter()
+        with sample.measure():
+            response = self.get_response(request)
+        seconds = time.perf_counter() - started
+
+        match = request.resolver_match
+        # pas de chemin brut en étiquette: une URL inconnue ne crée pas de série
+        view = match.view_name if match else "unresolved"
+        nbytes = None if response.streaming else len(response.content)
+        metrics.registry.record(view, response.status_code, seconds, sample, nbytes)
+        return response
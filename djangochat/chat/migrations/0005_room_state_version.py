@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 04:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_delete_typingstatus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='state_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 6.0.1 on 2026-10-18 04:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_last_message(apps, schema_editor):
+    Room = apps.get_model("chat", "Room")
+    Message = apps.get_model("chat", "Message")
+    for room in Room.objects.all().iterator():
+        last = (
+            Message.objects.filter(room_id=room.id)
+            .select_related("author")
+            .order_by("-id")
+            .first()
+        )
+        if last is None:
+            continue
+        room.last_message_id = last.id
+        room.last_message_content = last.content
+        room.last_message_author = last.author.username
+        room.last_message_is_deleted = last.is_deleted
+        room.last_message_created_at = last.created_at
+        room.save(
+            update_fields=[
+                "last_message_id",
+                "last_message_content",
+                "last_message_author",
+                "last_message_is_deleted",
+                "last_message_created_at",
+            ]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_room_state_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message_author',
+            field=models.CharField(blank=True, default='', max_length=150),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_content',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_created_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_is_deleted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['-last_message_created_at', 'name'], name='chat_room_last_msg_idx'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
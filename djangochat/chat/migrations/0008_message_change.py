@@ -0,0 +1,59 @@
+# Generated by Django 6.0.1 on 2026-10-18 04:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_deletions(apps, schema_editor):
+    Room = apps.get_model("chat", "Room")
+    Message = apps.get_model("chat", "Message")
+    MessageChange = apps.get_model("chat", "MessageChange")
+    deleted = Message.objects.filter(is_deleted=True).order_by("edited_at", "id")
+    MessageChange.objects.bulk_create(
+        (MessageChange(room_id=m.room_id, message_id=m.id, kind="DELETE") for m in deleted.iterator()),
+        batch_size=500,
+    )
+    for row in MessageChange.objects.values("room_id").annotate(seq=Max("id")):
+        Room.objects.filter(id=row["room_id"]).update(change_seq=row["seq"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('DELETE', 'Delete'), ('EDIT', 'Edit')], max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_msg_room_deleted_idx',
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='change_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='messagechange',
+            name='message',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='messagechange',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_changes', to='chat.room'),
+        ),
+        migrations.RunPython(backfill_deletions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+from django.db import migrations
+
+# Index plein texte FTS5 à contenu externe: seul l'index est stocké, le texte
+# reste dans chat_message. Les messages supprimés et les messages système
+# n'y figurent pas. Propre à SQLite: ignoré sur les autres bases.
+#
+# chat_message_fts_state.watermark: les triggers ne touchent qu'aux ids
+# <= watermark. Pendant une reconstruction (chat/search.py) il suit le dernier
+# lot indexé, sinon il vaut le plus grand entier SQLite.
+INDEXED = (
+    "{row}.is_deleted = 0 AND substr({row}.content, 1, 9) <> '[SYSTEM] '"
+    " AND {row}.id <= (SELECT watermark FROM chat_message_fts_state)"
+)
+
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+    " content, content='chat_message', content_rowid='id',"
+    " tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TABLE chat_message_fts_state (watermark INTEGER NOT NULL)",
+    "INSERT INTO chat_message_fts_state (watermark) VALUES (9223372036854775807)",
+    "CREATE TRIGGER chat_message_fts_ai AFTER INSERT ON chat_message"
+    f" WHEN {INDEXED.format(row='new')} BEGIN"
+    " INSERT INTO chat_message_fts (rowid, content) VALUES (new.id, new.content);"
+    " END",
+    "CREATE TRIGGER chat_message_fts_ad AFTER DELETE ON chat_message"
+    f" WHEN {INDEXED.format(row='old')} BEGIN"
+    " INSERT INTO chat_message_fts (chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);"
+    " END",
+    # un seul trigger pour l'update: l'ancienne version doit sortir avant que la nouvelle entre
+    "CREATE TRIGGER chat_message_fts_au AFTER UPDATE OF content, is_deleted ON chat_message BEGIN"
+    " INSERT INTO chat_message_fts (chat_message_fts, rowid, content)"
+    f" SELECT 'delete', old.id, old.content WHERE {INDEXED.format(row='old')};"
+    " INSERT INTO chat_message_fts (rowid, content)"
+    f" SELECT new.id, new.content WHERE {INDEXED.format(row='new')};"
+    " END",
+    "INSERT INTO chat_message_fts (rowid, content)"
+    f" SELECT id, content FROM chat_message WHERE {INDEXED.format(row='chat_message')}",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_au",
+    "DROP TRIGGER IF EXISTS chat_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chat_message_fts_ai",
+    "DROP TABLE IF EXISTS chat_message_fts_state",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for sql in statements:
+            schema_editor.execute(sql)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_change'),
+    ]
+
+    operations = [
+        migrations.RunPython(_run(CREATE_SQL), _run(DROP_SQL)),
+    ]
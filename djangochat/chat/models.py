@@ -9,6 +9,22 @@ class Room(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name="rooms_created")
     created_at = models.DateTimeField(auto_now_add=True)
     password = models.CharField(max_length=128, blank=True, default="")
+    # incrémenté à chaque changement de membres / rôles / nom (api_sync)
+    state_version = models.PositiveIntegerField(default=0)
+    # id du dernier MessageChange du salon (0: aucun), évite la requête du poll
+    change_seq = models.PositiveBigIntegerField(default=0)
+
+    # dernier message, maintenu à l'envoi et à la suppression (liste des salons)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_content = models.TextField(blank=True, default="")
+    last_message_author = models.CharField(max_length=150, blank=True, default="")
+    last_message_is_deleted = models.BooleanField(default=False)
+    last_message_created_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["-last_message_created_at", "name"], name="chat_room_last_msg_idx"),
+        ]
 
     def __str__(self) -> str:
         return self.name
@@ -31,9 +47,14 @@ class Membership(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="memberships")
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default=MEMBER)
     joined_at = models.DateTimeField(auto_now_add=True)
+    # Room.state_version au dernier changement de cette adhésion (deltas de api_room_state)
+    version = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ("user", "room")
+        indexes = [
+            models.Index(fields=["room", "version"], name="chat_membership_room_ver_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"{self.user} in {self.room} ({self.role})"
@@ -49,7 +70,38 @@ class Message(models.Model):
 
     class Meta:
         ordering = ["id"]
+        indexes = [
+            # poll: room=? AND id > after, et dernier message d'un salon (order_by -id)
+            models.Index(fields=["room", "id"], name="chat_msg_room_id_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"#{self.id} {self.author}: {self.content[:30]}"
 
+
+class MessageChange(models.Model):
+    """
+    Journal des modifications de messages déjà envoyés (suppressions, éditions).
+    L'id auto-incrémenté sert de numéro de séquence: les clients demandent
+    "les changements après seq N" au lieu d'un horodatage. L'index de la clé
+    étrangère room suffit: il est trié par (room_id, id).
+    """
+
+    DELETE = "DELETE"
+    EDIT = "EDIT"
+
+    KIND_CHOICES = [
+        (DELETE, "Delete"),
+        (EDIT, "Edit"),
+    ]
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="message_changes")
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="changes")
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self) -> str:
+        return f"#{self.id} {self.kind} message {self.message_id}"
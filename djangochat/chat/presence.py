@@ -0,0 +1,115 @@
+"""
+Indicateur "en train d'écrire": une entrée par (salon, utilisateur) avec une
+date d'expiration, mise à jour atomiquement (pas de lecture/réécriture d'un
+dict par salon). Lire un salon coûte O(utilisateurs qui écrivent).
+
+Les changements sont aussi publiés sur le bus (chat/services.py): les sockets
+tiennent leur propre copie et n'interrogent pas le store à chaque tick.
+
+Backends (settings.CHAT_TYPING["BACKEND"]):
+    - chat.presence.InMemoryBackend: un seul processus.
+    - chat.presence.SQLiteBackend: partagé entre les workers d'une même machine.
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .backends import Lazy, SQLiteConnection, from_settings
+
+DEFAULT_BACKEND = "chat.presence.InMemoryBackend"
+
+
+class InMemoryBackend:
+    def __init__(self, options: dict):
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def touch(self, room_id: int, username: str, expires: float) -> None:
+        with self._lock:
+            self._rooms.setdefault(room_id, {})[username] = expires
+
+    def clear(self, room_id: int, username: str) -> bool:
+        with self._lock:
+            entries = self._rooms.get(room_id)
+            if not entries:
+                return False
+            expires = entries.pop(username, None)
+            if not entries:
+                del self._rooms[room_id]
+            # une entrée expirée n'était plus affichée: rien à annoncer
+            return expires is not None and expires > time.time()
+
+    def active(self, room_id: int, now: float) -> dict:
+        with self._lock:
+            entries = self._rooms.get(room_id)
+            if not entries:
+                return {}
+            for username in [u for u, exp in entries.items() if exp <= now]:
+                del entries[username]
+            if not entries:
+                del self._rooms[room_id]
+            return dict(entries)
+
+
+class SQLiteBackend:
+    """Table SQLite partagée (WAL), clé primaire (room_id, username)."""
+
+    def __init__(self, options: dict):
+        self.path = str(options.get("PATH") or os.path.join(settings.BASE_DIR, "presence.sqlite3"))
+        self._db = SQLiteConnection(self.path)
+        self._touched = 0
+        self._db.get().execute(
+            "CREATE TABLE IF NOT EXISTS chat_typing ("
+            " room_id INTEGER NOT NULL,"
+            " username TEXT NOT NULL,"
+            " expires REAL NOT NULL,"
+            " PRIMARY KEY (room_id, username)) WITHOUT ROWID"
+        )
+
+    def touch(self, room_id: int, username: str, expires: float) -> None:
+        conn = self._db.get()
+        conn.execute(
+            "INSERT INTO chat_typing (room_id, username, expires) VALUES (?, ?, ?)"
+            " ON CONFLICT (room_id, username) DO UPDATE SET expires = excluded.expires",
+            (room_id, username, expires),
+        )
+        self._touched += 1
+        if self._touched % 500 == 0:
+            conn.execute("DELETE FROM chat_typing WHERE expires < ?", (time.time(),))
+
+    def clear(self, room_id: int, username: str) -> bool:
+        cur = self._db.get().execute(
+            "DELETE FROM chat_typing WHERE room_id = ? AND username = ? AND expires > ?",
+            (room_id, username, time.time()),
+        )
+        return cur.rowcount > 0
+
+    def active(self, room_id: int, now: float) -> dict:
+        rows = self._db.get().execute(
+            "SELECT username, expires FROM chat_typing WHERE room_id = ? AND expires > ?",
+            (room_id, now),
+        )
+        return dict(rows.fetchall())
+
+
+_store = Lazy(lambda: from_settings("CHAT_TYPING", DEFAULT_BACKEND))
+
+
+def get_store():
+    return _store.get()
+
+
+def touch(room_id: int, username: str, expires: float) -> None:
+    get_store().touch(room_id, username, expires)
+
+
+def clear(room_id: int, username: str) -> bool:
+    """Retire l'utilisateur; True s'il était affiché comme en train d'écrire."""
+    return get_store().clear(room_id, username)
+
+
+def active(room_id: int) -> dict:
+    """{username: expiration (epoch)} des utilisateurs qui écrivent encore."""
+    return get_store().active(room_id, time.time())
@@ -0,0 +1,286 @@
+"""
+Bus publish/subscribe des salons.
+
+Les vues publient sur un canal par salon (room_channel) après commit; les flux
+SSE et WebSocket s'y abonnent au lieu d'interroger la base en boucle.
+
+Chaque abonné a une file bornée: si elle déborde, les plus anciens événements
+sont jetés et `Subscription.take_overflow()` le signale, l'abonné se resynchronise
+alors depuis la base (qui reste la source de vérité).
+
+Backends (settings.CHAT_BUS["BACKEND"]):
+    - chat.pubsub.InMemoryBackend: un seul processus (runserver, ASGI mono-process).
+    - chat.pubsub.SQLiteBackend: plusieurs processus sur la même machine (workers
+      gunicorn); les événements transitent par un petit fichier SQLite en WAL,
+      relu par une seule thread par processus, et seulement s'il y a des abonnés.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .backends import Lazy, SQLiteConnection
+
+DEFAULT_BACKEND = "chat.pubsub.InMemoryBackend"
+DEFAULT_QUEUE_SIZE = 256
+
+LOBBY_CHANNEL = "lobby"
+
+
+def room_channel(room_id: int) -> str:
+    return f"room:{room_id}"
+
+
+class Subscription:
+    def __init__(self, bus, channels, maxsize: int):
+        self.bus = bus
+        self.channels = tuple(channels)
+        self.maxsize = maxsize
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._overflowed = False
+        self._loop = None
+        self._async_event = None
+
+    def push(self, event: dict) -> None:
+        with self._cond:
+            if len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self._overflowed = True
+            self._queue.append(event)
+            self._cond.notify()
+            loop, waiter = self._loop, self._async_event
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(waiter.set)
+            except RuntimeError:
+                # boucle fermée: l'abonné est parti
+                pass
+
+    def take_overflow(self) -> bool:
+        """True (une seule fois) si des événements ont été perdus depuis le dernier appel."""
+        with self._cond:
+            overflowed, self._overflowed = self._overflowed, False
+        return overflowed
+
+    def _pop(self):
+        with self._cond:
+            return self._queue.popleft() if self._queue else None
+
+    def get(self, timeout=None):
+        """Prochain événement, ou None après `timeout` secondes (usage synchrone)."""
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(timeout)
+            return self._queue.popleft() if self._queue else None
+
+    async def aget(self, timeout=None):
+        """Équivalent de get() pour une coroutine, sans bloquer de thread."""
+        if self._async_event is None:
+            with self._cond:
+                self._loop = asyncio.get_running_loop()
+                self._async_event = asyncio.Event()
+        self._async_event.clear()
+        event = self._pop()
+        if event is not None:
+            return event
+        try:
+            await asyncio.wait_for(self._async_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._pop()
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Bus:
+    def __init__(self, backend: str = DEFAULT_BACKEND, options=None):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self.backend = import_string(backend)(self, options or {})
+
+    def publish(self, channel: str, event: dict) -> None:
+        self.backend.publish(channel, dict(event, channel=channel))
+
+    def subscribe(self, *channels, maxsize: int = DEFAULT_QUEUE_SIZE) -> Subscription:
+        sub = Subscription(self, channels, maxsize)
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(sub)
+        self.backend.subscribed()
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            for channel in sub.channels:
+                subs = self._subscribers.get(channel)
+                if subs is None:
+                    continue
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[channel]
+
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def deliver(self, event: dict) -> None:
+        """Distribue un événement aux abonnés locaux de son canal."""
+        with self._lock:
+            subs = list(self._subscribers.get(event["channel"], ()))
+        for sub in subs:
+            sub.push(event)
+
+
+class InMemoryBackend:
+    def __init__(self, bus: Bus, options: dict):
+        self.bus = bus
+
+    def publish(self, channel: str, event: dict) -> None:
+        self.bus.deliver(event)
+
+    def subscribed(self) -> None:
+        pass
+
+
+class SQLiteBackend:
+    """
+    Relais inter-processus via une table SQLite partagée.
+
+    Un événement publié est distribué tout de suite aux abonnés du processus
+    émetteur, et inséré dans la table; dans chaque autre processus une thread
+    relit les nouvelles lignes toutes les POLL_INTERVAL secondes.
+    """
+
+    def __init__(self, bus: Bus, options: dict):
+        self.bus = bus
+        self.path = str(options.get("PATH") or os.path.join(settings.BASE_DIR, "bus.sqlite3"))
+        self.poll_interval = float(options.get("POLL_INTERVAL", 0.05))
+        self.retention = float(options.get("RETENTION", 300))
+        self._db = SQLiteConnection(self.path)
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._origin = None
+        self._published = 0
+        self._db.get().execute(
+            "CREATE TABLE IF NOT EXISTS chat_bus_event ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " channel TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " origin TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+
+    @property
+    def origin(self) -> str:
+        # recalculé après un fork (gunicorn --preload): chaque worker a le sien
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._origin = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+        return self._origin
+
+    def publish(self, channel: str, event: dict) -> None:
+        conn = self._db.get()
+        now = time.time()
+        conn.execute(
+            "INSERT INTO chat_bus_event (channel, payload, origin, created) VALUES (?, ?, ?, ?)",
+            (channel, json.dumps(event), self.origin, now),
+        )
+        self._published += 1
+        if self._published % 500 == 0:
+            conn.execute("DELETE FROM chat_bus_event WHERE created < ?", (now - self.retention,))
+        self.bus.deliver(event)
+
+    def subscribed(self) -> None:
+        with self._start_lock:
+            thread = getattr(self, "_thread", None)
+            if thread is not None and thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="chat-bus", daemon=True)
+            self._thread.start()
+
+    def _last_id(self, conn) -> int:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_bus_event").fetchone()[0]
+
+    def _run(self) -> None:
+        conn = self._db.get()
+        last_id = self._last_id(conn)
+        idle = False
+        while True:
+            time.sleep(self.poll_interval)
+            if not self.bus.has_subscribers():
+                idle = True
+                continue
+            try:
+                if idle:
+                    # pas d'abonnés pendant un moment: on ne rejoue pas l'historique
+                    last_id, idle = self._last_id(conn), False
+                rows = conn.execute(
+                    "SELECT id, payload, origin FROM chat_bus_event WHERE id > ? ORDER BY id LIMIT 500",
+                    (last_id,),
+                ).fetchall()
+            except sqlite3.Error:
+                continue
+            origin = self.origin
+            for row_id, payload, row_origin in rows:
+                last_id = row_id
+                if row_origin != origin:
+                    self.bus.deliver(json.loads(payload))
+
+
+def _make_bus() -> Bus:
+    conf = getattr(settings, "CHAT_BUS", {})
+    return Bus(conf.get("BACKEND", DEFAULT_BACKEND), conf.get("OPTIONS", {}))
+
+
+_bus = Lazy(_make_bus)
+
+
+def get_bus() -> Bus:
+    return _bus.get()
+
+
+def publish(channel: str, event: dict) -> None:
+    get_bus().publish(channel, event)
+
+
+def subscribe(*channels, maxsize: int = DEFAULT_QUEUE_SIZE) -> Subscription:
+    return get_bus().subscribe(*channels, maxsize=maxsize)
+
+
+# Abonnement puis lecture de la base, jamais l'inverse: un événement publié
+# entre les deux arrive alors en double (le curseur du lecteur l'écarte) au
+# lieu d'être perdu. Si la lecture échoue, l'abonnement est refermé.
+
+
+def subscribe_and_read(read, *channels, maxsize: int = DEFAULT_QUEUE_SIZE):
+    """(abonnement, read()) dans cet ordre."""
+    sub = subscribe(*channels, maxsize=maxsize)
+    try:
+        return sub, read()
+    except BaseException:
+        sub.close()
+        raise
+
+
+async def asubscribe_and_read(read, *channels, maxsize: int = DEFAULT_QUEUE_SIZE):
+    """subscribe_and_read() pour une lecture asynchrone: (abonnement, await read())."""
+    sub = subscribe(*channels, maxsize=maxsize)
+    try:
+        return sub, await read()
+    except BaseException:
+        sub.close()
+        raise
@@ -0,0 +1,152 @@
+"""
+Limitation de débit par seau à jetons, par (action, salon, utilisateur).
+
+Chaque action ("send", "typing", "poll", "longpoll") a un débit en jetons
+par seconde et une rafale maximale (settings.CHAT_RATELIMIT["RATES"]),
+surchargeables salon par salon (CHAT_RATELIMIT["ROOMS"]). Une requête consomme un jeton; sans
+jeton disponible, les vues répondent 429 avec Retry-After et la WebSocket
+renvoie {"type": "error", "error": "rate_limited", ...}.
+
+Backends (CHAT_RATELIMIT["BACKEND"]):
+    - chat.ratelimit.InMemoryBackend: un seul processus.
+    - chat.ratelimit.SQLiteBackend: seaux partagés entre les workers d'une même machine.
+"""
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from .backends import Lazy, SQLiteConnection, from_settings
+from .services import ChatError
+
+DEFAULT_BACKEND = "chat.ratelimit.InMemoryBackend"
+
+# un seau inutilisé depuis PRUNE_AFTER s est plein: inutile de le garder
+PRUNE_AFTER = 3600
+PRUNE_EVERY = 1000
+
+
+class RateLimited(ChatError):
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__("rate_limited", status=429)
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class InMemoryBackend:
+    def __init__(self, options: dict):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._taken = 0
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        """Consomme un jeton; 0 si accepté, sinon secondes avant le prochain jeton."""
+        with self._lock:
+            self._taken += 1
+            if self._taken % PRUNE_EVERY == 0:
+                for k in [k for k, (_, updated) in self._buckets.items() if updated < now - PRUNE_AFTER]:
+                    del self._buckets[k]
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(now - updated, 0) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1, now)
+            return 0.0
+
+
+class SQLiteBackend:
+    """Table SQLite partagée (WAL); la recharge et la consommation se font en un seul UPSERT."""
+
+    TAKE_SQL = (
+        "INSERT INTO chat_ratelimit (key, tokens, updated) VALUES (:key, :burst - 1, :now)"
+        " ON CONFLICT (key) DO UPDATE"
+        " SET tokens = min(:burst, tokens + max(:now - updated, 0) * :rate) - 1, updated = :now"
+        " WHERE min(:burst, tokens + max(:now - updated, 0) * :rate) >= 1"
+        " RETURNING tokens"
+    )
+
+    def __init__(self, options: dict):
+        self.path = str(options.get("PATH") or os.path.join(settings.BASE_DIR, "ratelimit.sqlite3"))
+        self._db = SQLiteConnection(self.path)
+        self._taken = 0
+        self._db.get().execute(
+            "CREATE TABLE IF NOT EXISTS chat_ratelimit ("
+            " key TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        conn = self._db.get()
+        self._taken += 1
+        if self._taken % PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM chat_ratelimit WHERE updated < ?", (now - PRUNE_AFTER,))
+        params = {"key": key, "rate": rate, "burst": burst, "now": now}
+        if conn.execute(self.TAKE_SQL, params).fetchall():
+            return 0.0
+        # refusé: la ligne n'a pas bougé, on estime l'attente
+        row = conn.execute("SELECT tokens, updated FROM chat_ratelimit WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return 0.0
+        tokens = min(burst, row[0] + max(now - row[1], 0) * rate)
+        return max((1 - tokens) / rate, 0.0)
+
+
+_store = Lazy(lambda: from_settings("CHAT_RATELIMIT", DEFAULT_BACKEND))
+
+
+def _conf() -> dict:
+    return getattr(settings, "CHAT_RATELIMIT", {})
+
+
+def get_store():
+    return _store.get()
+
+
+def rate_for(scope: str, room_id: int = None):
+    """(jetons par seconde, rafale) de l'action dans ce salon, ou None si illimitée."""
+    conf = _conf()
+    room_rates = conf.get("ROOMS", {}).get(room_id, {})
+    if scope in room_rates:
+        return room_rates[scope]
+    return conf.get("RATES", {}).get(scope)
+
+
+def hit(scope: str, user_id: int, room_id: int = None) -> None:
+    """Consomme un jeton pour l'utilisateur; lève RateLimited s'il n'y en a plus."""
+    rate = rate_for(scope, room_id)
+    if not rate:
+        return
+    per_second, burst = rate
+    wait = get_store().take(f"{scope}:{room_id or 0}:{user_id}", per_second, max(burst, 1), time.time())
+    if wait > 0:
+        raise RateLimited(scope, wait)
+
+
+def rate_limit(scope, methods=None):
+    """
+    Décorateur de vue (sous @login_required): 429 + Retry-After au-delà du
+    débit de `scope` (nom, ou fonction request -> nom). `methods`: ne
+    limiter que ces méthodes HTTP.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods is None or request.method in methods:
+                try:
+                    hit(scope(request) if callable(scope) else scope, request.user.id, kwargs.get("room_id"))
+                except RateLimited as e:
+                    response = JsonResponse({"error": e.code, "retry_after": round(e.retry_after, 3)}, status=429)
+                    response["Retry-After"] = str(math.ceil(e.retry_after))
+                    return response
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
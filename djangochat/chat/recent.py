@@ -0,0 +1,186 @@
+"""
+Tampon circulaire, par salon, des derniers messages sérialisés
+(services.message_payload), pour servir le poll et le chargement de
+room_detail sans requête. Propre au processus.
+
+Le tampon d'un salon contient tous les messages d'id > `floor`: une demande
+plus ancienne est un miss, servie par la base. Il est alimenté par les
+envois et suppressions de ce processus (après commit) et, pour ceux des
+autres processus, recomplété par services._recent_buffer() contre la ligne
+Room que la vue vient de lire (last_message_id, change_seq).
+
+Au-delà de CHAT_RECENT["MAX_BYTES"] (taille estimée), les salons les moins
+récemment lus sont évincés.
+"""
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+DEFAULTS = {"ENABLED": True, "PER_ROOM": 200, "MAX_BYTES": 16 * 1024 * 1024}
+
+# empreinte approximative d'un dict de message, hors texte
+PAYLOAD_OVERHEAD = 600
+
+
+def conf(key: str):
+    return getattr(settings, "CHAT_RECENT", {}).get(key, DEFAULTS[key])
+
+
+def _weight(payload: dict) -> int:
+    return PAYLOAD_OVERHEAD + len(payload["content"]) + len(payload["author"])
+
+
+class RoomBuffer:
+    def __init__(self, created_at, size: int, floor: int, seq: int):
+        self.created_at = created_at
+        self.size = size
+        self.messages = deque()
+        self.floor = floor
+        self.last_id = floor
+        self.seq = seq
+        self.bytes = 0
+
+    def append(self, payload: dict) -> None:
+        self.messages.append(payload)
+        self.last_id = payload["id"]
+        self.bytes += _weight(payload)
+        while len(self.messages) > self.size:
+            dropped = self.messages.popleft()
+            self.floor = dropped["id"]
+            self.bytes -= _weight(dropped)
+
+    def mark_deleted(self, message_ids) -> None:
+        ids = set(message_ids)
+        for i, payload in enumerate(self.messages):
+            if payload["id"] in ids and not payload["is_deleted"]:
+                deleted = dict(payload, content="[message supprimé]", is_deleted=True)
+                self.bytes += _weight(deleted) - _weight(payload)
+                self.messages[i] = deleted
+
+    def after(self, after_id: int, limit: int):
+        if after_id < self.floor:
+            return None
+        return [p for p in self.messages if p["id"] > after_id][:limit]
+
+    def latest(self, n: int):
+        if len(self.messages) < n + 1 and self.floor != 0:
+            return None
+        messages = list(self.messages)
+        return messages[-n:], len(messages) > n or self.floor != 0
+
+
+class RecentStore:
+    def __init__(self):
+        self._rooms = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _get(self, room_id: int, created_at=None):
+        buf = self._rooms.get(room_id)
+        # même id, autre salon (base recréée, tests): le tampon ne vaut plus rien
+        if buf is not None and created_at is not None and buf.created_at != created_at:
+            self._drop(room_id)
+            return None
+        return buf
+
+    def _drop(self, room_id: int) -> None:
+        buf = self._rooms.pop(room_id, None)
+        if buf is not None:
+            self._bytes -= buf.bytes
+
+    def _mutate(self, room_id: int, fn) -> None:
+        buf = self._rooms.get(room_id)
+        if buf is None:
+            return
+        before = buf.bytes
+        fn(buf)
+        self._bytes += buf.bytes - before
+        self._evict()
+
+    def _evict(self) -> None:
+        limit = conf("MAX_BYTES")
+        while self._bytes > limit and len(self._rooms) > 1:
+            _room_id, buf = self._rooms.popitem(last=False)
+            self._bytes -= buf.bytes
+
+    def cursor(self, room_id: int, created_at):
+        """(last_id, seq) du tampon du salon, ou None s'il n'y en a pas."""
+        with self._lock:
+            buf = self._get(room_id, created_at)
+            return None if buf is None else (buf.last_id, buf.seq)
+
+    def load(self, room_id: int, created_at, payloads: list, complete: bool, seq: int) -> None:
+        """Remplace le tampon par `payloads` (ordre croissant); `complete`: tout l'historique du salon."""
+        size = conf("PER_ROOM")
+        floor = 0 if complete or not payloads else payloads[0]["id"] - 1
+        buf = RoomBuffer(created_at, size, floor, seq)
+        for payload in payloads:
+            buf.append(payload)
+        with self._lock:
+            self._drop(room_id)
+            self._rooms[room_id] = buf
+            self._bytes += buf.bytes
+            self._evict()
+
+    def extend(self, room_id: int, since: int, payloads: list) -> None:
+        """Fin relue en base: tous les messages d'id > `since`, en ordre."""
+
+        def apply(buf):
+            if buf.last_id < since:
+                return
+            for payload in payloads:
+                if payload["id"] > buf.last_id:
+                    buf.append(payload)
+
+        with self._lock:
+            self._mutate(room_id, apply)
+
+    def record_message(self, room_id: int, payload: dict, previous_id) -> None:
+        """Message inséré par ce processus; `previous_id`: dernier message du salon avant lui."""
+        with self._lock:
+            buf = self._rooms.get(room_id)
+            if buf is None or payload["id"] <= buf.last_id:
+                return
+            if buf.last_id != (previous_id or 0):
+                # un message d'un autre processus manque entre les deux
+                self._drop(room_id)
+                return
+            self._mutate(room_id, lambda b: b.append(payload))
+
+    def record_deletes(self, room_id: int, message_ids, seq: int = None) -> None:
+        def apply(buf):
+            buf.mark_deleted(message_ids)
+            if seq is not None:
+                buf.seq = max(buf.seq, seq)
+
+        with self._lock:
+            self._mutate(room_id, apply)
+
+    def after(self, room_id: int, after_id: int, limit: int):
+        with self._lock:
+            buf = self._rooms.get(room_id)
+            if buf is None:
+                return None
+            self._rooms.move_to_end(room_id)
+            return buf.after(after_id, limit)
+
+    def latest(self, room_id: int, n: int):
+        with self._lock:
+            buf = self._rooms.get(room_id)
+            if buf is None:
+                return None
+            self._rooms.move_to_end(room_id)
+            return buf.latest(n)
+
+    def discard(self, room_id: int) -> None:
+        with self._lock:
+            self._drop(room_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rooms.clear()
+            self._bytes = 0
+
+
+store = RecentStore()
@@ -0,0 +1,161 @@
+"""
+Recherche plein texte des messages, sur la table FTS5 chat_message_fts
+(migration 0009, SQLite uniquement). Les triggers de la migration la tiennent
+à jour à l'envoi et à la suppression; `manage.py rebuild_search_index` la
+reconstruit par lots.
+
+Résultats triés par pertinence (bm25), puis par id; le curseur de page est
+"<rank>:<id>" du dernier résultat renvoyé.
+"""
+import html
+import re
+
+from django.db import connection, transaction
+
+FTS_TABLE = "chat_message_fts"
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SNIPPET_TOKENS = 12
+
+# plus grand entier SQLite: watermark hors reconstruction (cf. migration 0009)
+_MAX_WATERMARK = 9223372036854775807
+
+# marqueurs internes du snippet, remplacés par <mark> après échappement HTML
+_HL_START = "\x02"
+_HL_END = "\x03"
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def is_available() -> bool:
+    return connection.vendor == "sqlite"
+
+
+def match_expression(query: str) -> str:
+    """
+    Requête utilisateur -> expression MATCH sûre: chaque mot entre guillemets
+    (pas de syntaxe FTS5 injectée), tous requis, le dernier en préfixe.
+    """
+    terms = [f'"{t}"' for t in _TOKEN.findall(query or "")]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def encode_cursor(rank: float, message_id: int) -> str:
+    return f"{rank!r}:{message_id}"
+
+
+def decode_cursor(raw: str):
+    rank, _, message_id = (raw or "").partition(":")
+    try:
+        return float(rank), int(message_id)
+    except ValueError:
+        return None
+
+
+def _as_datetime(value):
+    # SQL brut: conversion (fuseau) faite à la main, comme le ferait l'ORM
+    return connection.ops.convert_datetimefield_value(value, None, connection)
+
+
+def _snippet_html(snippet: str) -> str:
+    return html.escape(snippet).replace(_HL_START, "<mark>").replace(_HL_END, "</mark>")
+
+
+def search_messages(query: str, user_id: int, room_id: int = None, cursor=None, limit: int = SEARCH_PAGE_SIZE):
+    """
+    Une page de résultats et le curseur de la suivante (None s'il n'y en a pas).
+    Sans `room_id`, limité aux salons dont l'utilisateur est membre (non banni);
+    avec, l'appelant a déjà vérifié l'accès au salon.
+    """
+    match = match_expression(query)
+    if not match:
+        return [], None
+
+    sql = [
+        "SELECT m.id, m.room_id, r.name, u.username, m.created_at, f.rank,",
+        f" snippet({FTS_TABLE}, 0, %s, %s, '…', %s)",
+        f" FROM {FTS_TABLE} f",
+        " JOIN chat_message m ON m.id = f.rowid",
+        " JOIN chat_room r ON r.id = m.room_id",
+        " JOIN auth_user u ON u.id = m.author_id",
+        f" WHERE {FTS_TABLE} MATCH %s",
+    ]
+    params = [_HL_START, _HL_END, SNIPPET_TOKENS, match]
+    if room_id is not None:
+        sql.append(" AND m.room_id = %s")
+        params.append(room_id)
+    else:
+        sql.append(
+            " AND m.room_id IN (SELECT room_id FROM chat_membership WHERE user_id = %s AND role <> 'BANNED')"
+        )
+        params.append(user_id)
+    if cursor is not None:
+        sql.append(" AND (f.rank > %s OR (f.rank = %s AND f.rowid > %s))")
+        params.extend([cursor[0], cursor[0], cursor[1]])
+    sql.append(" ORDER BY f.rank, f.rowid LIMIT %s")
+    params.append(limit + 1)
+
+    with connection.cursor() as c:
+        c.execute("".join(sql), params)
+        rows = c.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][5], rows[-1][0])
+
+    results = []
+    for message_id, room, room_name, author, created_at, _rank, snippet in rows:
+        results.append(
+            {
+                "id": message_id,
+                "room_id": room,
+                "room": room_name,
+                "author": author,
+                "created_at": _as_datetime(created_at).isoformat(),
+                "snippet": _snippet_html(snippet),
+            }
+        )
+    return results, next_cursor
+
+
+def rebuild_index(batch_size: int = 5000, progress=None) -> int:
+    """
+    Vide puis réindexe chat_message par tranches d'id, une transaction par
+    tranche pour ne pas bloquer les écritures. Renvoie le nombre de messages indexés.
+
+    Le watermark suit la dernière tranche: les triggers ignorent les messages
+    au-delà (la tranche qui les couvrira lira leur état du moment), ce qui évite
+    de retirer de l'index une ligne qui n'y est pas encore.
+    """
+    with transaction.atomic(), connection.cursor() as c:
+        c.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('delete-all')")
+        c.execute(f"UPDATE {FTS_TABLE}_state SET watermark = 0")
+
+    indexed = 0
+    start = 0
+    while True:
+        end = start + batch_size
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, content)"
+                " SELECT id, content FROM chat_message"
+                " WHERE id > %s AND id <= %s AND is_deleted = 0 AND substr(content, 1, 9) <> '[SYSTEM] '",
+                [start, end],
+            )
+            indexed += c.rowcount
+            c.execute("SELECT COALESCE(MAX(id), 0) FROM chat_message")
+            max_id = c.fetchone()[0]
+            done = end >= max_id
+            c.execute(f"UPDATE {FTS_TABLE}_state SET watermark = %s", [_MAX_WATERMARK if done else end])
+        if progress is not None:
+            progress(min(end, max_id), max_id, indexed)
+        if done:
+            break
+        start = end
+
+    with connection.cursor() as c:
+        c.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return indexed
@@ -0,0 +1,391 @@
+"""
+Règles métier partagées par les vues HTTP (chat/views.py) et le transport
+WebSocket (chat/consumers.py), pour que les deux appliquent les mêmes droits.
+"""
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .models import Room, Message, MessageChange, Membership
+from . import metrics, presence, recent
+from .db import run_message_write
+from .pubsub import LOBBY_CHANNEL, publish, room_channel
+
+MAX_MESSAGE_LENGTH = 2000
+TYPING_WINDOW = 1.5
+
+ROOM_LIST_VERSION_KEY = "room_list_version"
+
+CHANGES_BATCH = 500
+# messages relus par requête (poll, rattrapage des flux)
+MESSAGES_PAGE_SIZE = 200
+
+MEMBERSHIP_CACHE_TIMEOUT = 300
+_NO_MEMBERSHIP = "none"
+
+# Intervalle de poll suggéré aux clients (ms) selon l'ancienneté du dernier message
+POLL_INTERVAL_ACTIVE = 1000
+POLL_INTERVAL_RECENT = 3000
+POLL_INTERVAL_IDLE = 10000
+ACTIVE_WINDOW = 60
+RECENT_WINDOW = 600
+
+
+class ChatError(Exception):
+    """Action refusée; `code` est renvoyé tel quel au client ({"error": code})."""
+
+    def __init__(self, code: str, status: int = 400):
+        super().__init__(code)
+        self.code = code
+        self.status = status
+
+
+def message_payload(m: Message) -> dict:
+    """Forme d'un message indépendante du lecteur (c'est elle qui passe sur le bus)."""
+    return {
+        "id": m.id,
+        "author": m.author.username,
+        "author_id": m.author_id,
+        "content": "[message supprimé]" if m.is_deleted else m.content,
+        "created_at": m.created_at.isoformat(),
+        "is_deleted": m.is_deleted,
+    }
+
+
+def for_viewer(payload: dict, role: str, user_id: int) -> dict:
+    data = dict(payload)
+    author_id = data.pop("author_id")
+    data["can_delete"] = (role in (Membership.OWNER, Membership.MOD)) or (author_id == user_id)
+    return data
+
+
+def serialize_message(m: Message, role: str, user_id: int) -> dict:
+    return for_viewer(message_payload(m), role, user_id)
+
+
+def _bump_state_version(room_id: int) -> None:
+    Room.objects.filter(id=room_id).update(state_version=F("state_version") + 1)
+
+
+def _publish_on_commit(channel: str, event: dict) -> None:
+    transaction.on_commit(lambda: publish(channel, event))
+
+
+def publish_message(msg: Message) -> None:
+    _publish_on_commit(room_channel(msg.room_id), {"type": "message", "message": message_payload(msg)})
+
+
+def _membership_key(user_id: int, room: Room) -> str:
+    # la version d'état du salon change à chaque adhésion ou rôle modifié
+    # (member_changed): une entrée d'un autre processus n'est jamais relue
+    return f"membership_{user_id}_{room.id}_{room.state_version}"
+
+
+def get_membership(user, room: Room, memo: dict = None):
+    """
+    Adhésion (ou None) de `user` au salon, via le cache: les endpoints de poll
+    ne refont pas la requête Membership à chaque appel. `memo` (un dict porté
+    par la requête) évite aussi de relire le cache plusieurs fois par requête.
+    `room` doit avoir été lu par la requête en cours: la clé porte sa
+    state_version, un bannissement ou un changement de rôle fait donc
+    manquer le cache dans tous les processus, sans invalidation explicite.
+    """
+    if memo is not None and room.id in memo:
+        return memo[room.id]
+    key = _membership_key(user.id, room)
+    membership = cache.get(key)
+    metrics.cache_lookup("membership", membership is not None)
+    if membership is None:
+        membership = Membership.objects.filter(user_id=user.id, room_id=room.id).first()
+        cache.set(key, membership or _NO_MEMBERSHIP, timeout=MEMBERSHIP_CACHE_TIMEOUT)
+    elif membership == _NO_MEMBERSHIP:
+        membership = None
+    if memo is not None:
+        memo[room.id] = membership
+    return membership
+
+
+def member_changed(membership: Membership) -> None:
+    """
+    Adhésion créée ou rôle modifié: nouvelle version d'état (donc nouvelle clé
+    de cache, cf. get_membership) + événement. L'adhésion prend la nouvelle
+    version du salon (deltas de room_state).
+    """
+    with transaction.atomic():
+        _bump_state_version(membership.room_id)
+        Membership.objects.filter(pk=membership.pk).update(
+            version=Subquery(Room.objects.filter(id=OuterRef("room_id")).values("state_version")[:1])
+        )
+    _publish_on_commit(
+        room_channel(membership.room_id),
+        {
+            "type": "member",
+            "user_id": membership.user_id,
+            "username": membership.user.username,
+            "role": membership.role,
+        },
+    )
+
+
+def room_list_version() -> int:
+    """
+    Version globale de la liste des salons (api_room_list), dans le cache.
+    Valeur initiale horodatée: si la clé est évincée, on ne retombe pas sur
+    une ancienne version dont le payload serait encore en cache.
+    """
+    version = cache.get(ROOM_LIST_VERSION_KEY)
+    if version is None:
+        cache.add(ROOM_LIST_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(ROOM_LIST_VERSION_KEY)
+    return version
+
+
+def _bump_room_list_version() -> None:
+    try:
+        cache.incr(ROOM_LIST_VERSION_KEY)
+    except ValueError:
+        room_list_version()
+
+
+def room_changed(room_id: int, deleted: bool = False) -> None:
+    """Salon créé, renommé ou supprimé."""
+    if not deleted:
+        _bump_state_version(room_id)
+    transaction.on_commit(_bump_room_list_version)
+    event = {"type": "room", "room_id": room_id, "deleted": deleted}
+    _publish_on_commit(room_channel(room_id), event)
+    _publish_on_commit(LOBBY_CHANNEL, event)
+
+
+def _record_last_message(msg: Message) -> None:
+    # garde sur l'id: un envoi concurrent plus récent ne doit pas être écrasé
+    Room.objects.filter(
+        Q(last_message_id__isnull=True) | Q(last_message_id__lt=msg.id), id=msg.room_id
+    ).update(
+        last_message_id=msg.id,
+        last_message_content=msg.content,
+        last_message_author=msg.author.username,
+        last_message_is_deleted=msg.is_deleted,
+        last_message_created_at=msg.created_at,
+    )
+    transaction.on_commit(_bump_room_list_version)
+
+
+def _insert_message(room: Room, author, content: str) -> Message:
+    # insertion + résumé du salon: une seule transaction, un seul écrivain
+    def insert():
+        previous_id = Room.objects.filter(id=room.id).values_list("last_message_id", flat=True).first()
+        msg = Message.objects.create(room=room, author=author, content=content)
+        _record_last_message(msg)
+        payload = message_payload(msg)
+        transaction.on_commit(lambda: recent.store.record_message(room.id, payload, previous_id))
+        return msg
+
+    msg = run_message_write(insert)
+    publish_message(msg)
+    return msg
+
+
+def post_system_message(room: Room, author, text: str) -> Message:
+    return _insert_message(room, author, f"[SYSTEM] {text}")
+
+
+def send_message(user, room: Room, membership: Membership, content: str) -> Message:
+    if membership.role == Membership.BANNED:
+        raise ChatError("banned", status=403)
+
+    content = (content or "").strip()
+    if not content:
+        raise ChatError("empty")
+    if len(content) > MAX_MESSAGE_LENGTH:
+        raise ChatError("too_long")
+
+    msg = _insert_message(room, user, content)
+    if presence.clear(room.id, user.username):
+        _publish_on_commit(room_channel(room.id), _typing_event(user.username, 0))
+    return msg
+
+
+def delete_message(user, membership: Membership, msg: Message) -> Message:
+    if membership.role == Membership.BANNED:
+        raise ChatError("banned", status=403)
+
+    is_mod = membership.role in (Membership.OWNER, Membership.MOD)
+    is_author = msg.author_id == user.id
+    if not (is_mod or is_author):
+        raise ChatError("forbidden", status=403)
+
+    # suppression, ligne de changement et change_seq: tout ou rien, sinon un
+    # client qui synchronise par `seq` manquerait la suppression
+    def write():
+        msg.is_deleted = True
+        msg.edited_at = timezone.now()
+        msg.save(update_fields=["is_deleted", "edited_at"])
+        change = MessageChange.objects.create(room_id=msg.room_id, message=msg, kind=MessageChange.DELETE)
+        Room.objects.filter(id=msg.room_id, change_seq__lt=change.id).update(change_seq=change.id)
+        if Room.objects.filter(id=msg.room_id, last_message_id=msg.id).update(last_message_is_deleted=True):
+            transaction.on_commit(_bump_room_list_version)
+        transaction.on_commit(lambda: recent.store.record_deletes(msg.room_id, [msg.id]))
+        _publish_on_commit(
+            room_channel(msg.room_id), {"type": "delete", "message_id": msg.id, "seq": change.id}
+        )
+
+    run_message_write(write)
+    return msg
+
+
+def messages_after(room_id: int, after_id: int) -> list:
+    """Page de MESSAGES_PAGE_SIZE messages après `after_id`; une page pleine: il peut en rester."""
+    return list(
+        Message.objects.filter(room_id=room_id, id__gt=after_id)
+        .select_related("author")
+        .order_by("id")[:MESSAGES_PAGE_SIZE]
+    )
+
+
+def changes_after(room_id: int, seq: int):
+    """
+    (ids supprimés, nouvelle séquence) pour les changements du salon après `seq`.
+    Par lots de CHANGES_BATCH: la séquence renvoyée reprend là où le lot s'arrête.
+    Les vues qui ont déjà le salon comparent d'abord avec Room.change_seq.
+    """
+    rows = MessageChange.objects.filter(room_id=room_id, id__gt=seq).values_list("id", "message_id", "kind")
+    deleted_ids = []
+    for change_id, message_id, kind in rows[:CHANGES_BATCH]:
+        seq = change_id
+        if kind == MessageChange.DELETE:
+            deleted_ids.append(message_id)
+    return deleted_ids, seq
+
+
+def poll_interval(last_activity, typing: bool = False) -> int:
+    """
+    Délai (ms) conseillé avant le prochain poll: court si quelqu'un écrit ou
+    vient d'écrire, long pour un salon (ou un lobby) inactif.
+    """
+    if typing:
+        return POLL_INTERVAL_ACTIVE
+    if last_activity is None:
+        return POLL_INTERVAL_IDLE
+    age = (timezone.now() - last_activity).total_seconds()
+    if age < ACTIVE_WINDOW:
+        return POLL_INTERVAL_ACTIVE
+    if age < RECENT_WINDOW:
+        return POLL_INTERVAL_RECENT
+    return POLL_INTERVAL_IDLE
+
+
+def _recent_buffer(room: Room) -> bool:
+    """
+    Met le tampon des derniers messages du salon (chat/recent.py) au niveau
+    de `room`, lue par la vue: fin manquante et suppressions relues en base
+    (une requête chacune, seulement s'il y a du nouveau). False si désactivé.
+    """
+    if not recent.conf("ENABLED"):
+        return False
+    size = recent.conf("PER_ROOM")
+    cursor = recent.store.cursor(room.id, room.created_at)
+    if cursor is None:
+        rows = list(Message.objects.filter(room=room).select_related("author").order_by("-id")[: size + 1])
+        rows.reverse()
+        recent.store.load(
+            room.id, room.created_at, [message_payload(m) for m in rows], len(rows) <= size, room.change_seq
+        )
+        return True
+
+    last_id, seq = cursor
+    if (room.last_message_id or 0) > last_id:
+        rows = list(
+            Message.objects.filter(room=room, id__gt=last_id).select_related("author").order_by("id")[: size + 1]
+        )
+        if len(rows) > size:
+            # trop de retard: on repart des derniers messages
+            recent.store.discard(room.id)
+            return _recent_buffer(room)
+        recent.store.extend(room.id, last_id, [message_payload(m) for m in rows])
+    if room.change_seq > seq:
+        deleted_ids, new_seq = changes_after(room.id, seq)
+        recent.store.record_deletes(room.id, deleted_ids, new_seq)
+    return True
+
+
+def recent_messages_after(room: Room, after_id: int, limit: int):
+    """Payloads des messages après `after_id` par le tampon, ou None (trop ancien: lire la base)."""
+    if not _recent_buffer(room):
+        return None
+    return recent.store.after(room.id, after_id, limit)
+
+
+def recent_latest(room: Room, n: int):
+    """(n derniers payloads, y en a-t-il d'autres avant) par le tampon, ou None."""
+    if not _recent_buffer(room):
+        return None
+    return recent.store.latest(room.id, n)
+
+
+def _check_typing_access(membership) -> None:
+    if not membership or membership.role == Membership.BANNED:
+        raise ChatError("forbidden", status=403)
+
+
+def _typing_event(username: str, expires: float) -> dict:
+    # expires == 0: l'utilisateur a cessé d'écrire (message envoyé)
+    return {"type": "typing", "username": username, "expires": expires}
+
+
+def mark_typing(membership, room_id: int, username: str) -> None:
+    _check_typing_access(membership)
+    expires = time.time() + TYPING_WINDOW
+    presence.touch(room_id, username, expires)
+    publish(room_channel(room_id), _typing_event(username, expires))
+
+
+def active_typers(typing: dict, username: str, now: float = None) -> list:
+    """Noms encore actifs dans un dict {username: expiration}, hors `username`."""
+    now = time.time() if now is None else now
+    return sorted(u for u, expires in typing.items() if expires > now and u != username)
+
+
+def typing_users(membership, room_id: int, username: str) -> list:
+    _check_typing_access(membership)
+    return active_typers(presence.active(room_id), username)
+
+
+def room_state(room: Room, membership, since: int = None) -> dict:
+    """
+    État du salon (nom, rôle du lecteur, membres) à la version room.state_version.
+    `since`: version que le client a déjà. Identique -> {"unchanged": True};
+    plus ancienne -> seulement les adhésions modifiées depuis ("delta": True).
+    Les adhésions ne sont jamais supprimées (un banni reste, rôle BANNED), un
+    delta n'a donc pas à porter de retraits. Sans `since`, ou si la version est
+    inconnue, la liste complète.
+    """
+    if membership and membership.role == Membership.BANNED:
+        raise ChatError("banned", status=403)
+    if not membership:
+        raise ChatError("forbidden", status=403)
+
+    version = room.state_version
+    if since is not None and since == version:
+        return {"version": version, "unchanged": True}
+
+    members = Membership.objects.filter(room=room)
+    delta = since is not None and 0 <= since < version
+    if delta:
+        members = members.filter(version__gt=since)
+    members = members.values("user_id", "user__username", "role")
+    state = {
+        "version": version,
+        "room": {"id": room.id, "name": room.name},
+        "role": membership.role,
+        "members": [
+            {"user_id": m["user_id"], "username": m["user__username"], "role": m["role"]}
+            for m in members
+        ],
+    }
+    if delta:
+        state["delta"] = True
+    return state
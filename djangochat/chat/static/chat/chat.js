@@ -69,18 +69,300 @@
     );
   }
 
-  function initChatRoom() {
-    if (!window.CHAT_CONFIG || !window.CHAT_CONFIG.apiMessagesUrl) return;
-    if (!$("#chat-box").length) return;
+  // Événements du salon ouvert ("message", "delete", "typing", "state", ...),
+  // quel que soit le transport qui les livre (WebSocket, SSE ou sync HTTP).
+  const roomEvents = (function () {
+    const handlers = {};
+    return {
+      on: function (type, fn) {
+        (handlers[type] = handlers[type] || []).push(fn);
+      },
+      emit: function (type, data) {
+        (handlers[type] || []).forEach(function (fn) {
+          fn(data);
+        });
+      },
+    };
+  })();
+
+  // Dernier changement (suppression...) vu par ce client, cf. MessageChange.
+  let changeSeq = 0;
+  roomEvents.on("delete", function (data) {
+    if (data.seq > changeSeq) changeSeq = data.seq;
+  });
 
-    let lastSync = null;
+  // 429 (chat/ratelimit.py): délai en ms avant de réessayer, d'après Retry-After
+  function retryAfterMs(xhr) {
+    const seconds = parseFloat(xhr.getResponseHeader("Retry-After"));
+    return (isNaN(seconds) ? 1 : Math.max(seconds, 1)) * 1000;
+  }
 
-    function getLastId() {
-      const items = $("#chat-box [data-id]");
-      if (!items.length) return 0;
-      return parseInt($(items[items.length - 1]).attr("data-id"), 10) || 0;
+  // Poll adaptatif: le délai suit next_poll_ms renvoyé par le serveur, double
+  // à chaque réponse vide (au plus POLL_MAX_MS), et rien ne part tant que
+  // l'onglet est caché; on repart aussitôt quand il redevient visible.
+  // run(done) appelle done({ interval, empty, wait }).
+  const POLL_DEFAULT_MS = 3000;
+  const POLL_MAX_MS = 30000;
+  const POLL_MAX_BACKOFF = 3;
+
+  function adaptivePoll(run) {
+    let timer = null;
+    let running = false;
+    let emptyStreak = 0;
+
+    function schedule(delay) {
+      clearTimeout(timer);
+      timer = document.hidden ? null : setTimeout(tick, delay);
     }
 
+    function tick() {
+      timer = null;
+      if (document.hidden) return;
+      running = true;
+      run(function (result) {
+        running = false;
+        emptyStreak = result.empty ? emptyStreak + 1 : 0;
+        const base = result.interval || POLL_DEFAULT_MS;
+        let delay = Math.min(base * Math.pow(2, Math.min(emptyStreak, POLL_MAX_BACKOFF)), Math.max(base, POLL_MAX_MS));
+        if (result.wait) delay = Math.max(delay, result.wait);
+        schedule(delay);
+      });
+    }
+
+    document.addEventListener("visibilitychange", function () {
+      if (!document.hidden && !running) {
+        emptyStreak = 0;
+        schedule(0);
+      }
+    });
+
+    tick();
+    return {
+      // activité locale (envoi, saisie): on revient au rythme suggéré
+      reset: function () {
+        emptyStreak = 0;
+      },
+    };
+  }
+
+  // Les API de messages répondent en colonnes (format=columnar, cf. chat/wire.py):
+  // auteurs dédupliqués et dates en ms, moins d'octets sur le réseau.
+  const WIRE_FORMAT = "columnar";
+
+  function decodeMessages(cols) {
+    if (!cols || Array.isArray(cols)) return cols || [];
+    return cols.id.map(function (id, i) {
+      return {
+        id: id,
+        author: cols.authors[cols.author[i]],
+        content: cols.content[i],
+        created_at: new Date(cols.created_at[i]).toISOString(),
+        is_deleted: cols.is_deleted[i],
+        can_delete: cols.can_delete[i],
+      };
+    });
+  }
+
+  function getLastId() {
+    const items = $("#chat-box [data-id]");
+    if (!items.length) return 0;
+    return parseInt($(items[items.length - 1]).attr("data-id"), 10) || 0;
+  }
+
+  // Une WebSocket par salon remplace les pollers (messages, typing, état).
+  // Si elle ne s'ouvre jamais (déploiement WSGI), on retombe sur SSE + sync.
+  function createRoomSocket() {
+    const cfg = window.CHAT_CONFIG;
+    if (!cfg || !cfg.wsUrl || !window.WebSocket) return null;
+
+    const fallbacks = [];
+    let ws = null;
+    let everOpened = false;
+    let failed = false;
+    let retries = 0;
+
+    const sock = {
+      onFallback: function (fn) {
+        if (failed) fn();
+        else fallbacks.push(fn);
+      },
+      isOpen: function () {
+        return ws !== null && ws.readyState === WebSocket.OPEN;
+      },
+      send: function (payload) {
+        if (!sock.isOpen()) return false;
+        ws.send(JSON.stringify(payload));
+        return true;
+      },
+    };
+
+    function connect() {
+      const scheme = window.location.protocol === "https:" ? "wss://" : "ws://";
+      ws = new WebSocket(scheme + window.location.host + cfg.wsUrl);
+      ws.onopen = function () {
+        everOpened = true;
+        retries = 0;
+        sock.send({ type: "resume", after: getLastId(), seq: changeSeq });
+      };
+      ws.onmessage = function (e) {
+        const data = JSON.parse(e.data);
+        roomEvents.emit(data.type, data);
+      };
+      ws.onclose = function (e) {
+        if (e.code === 4401 || e.code === 4403 || e.code === 4404) {
+          window.location.href = cfg.roomDetailUrl;
+          return;
+        }
+        if (!everOpened) {
+          failed = true;
+          fallbacks.splice(0).forEach(function (fn) {
+            fn();
+          });
+          return;
+        }
+        retries += 1;
+        setTimeout(connect, Math.min(30000, 1000 * Math.pow(2, retries)));
+      };
+    }
+
+    connect();
+    return sock;
+  }
+
+  let roomSocket = null;
+  let syncPoller = null;
+
+  // Sans WebSocket: flux SSE pour les messages s'il tient, et un seul poll
+  // api_sync par tick pour le reste (et les messages si SSE est indisponible).
+  // Long-poll api_messages (wait=...): le serveur répond dès qu'un message ou
+  // une suppression arrive, sinon après LONG_POLL_WAIT_S secondes.
+  const LONG_POLL_WAIT_S = 25;
+  const LONG_POLL_RETRY_MS = 3000;
+  // Le serveur envoie un "ping" toutes les SSE_HEARTBEAT_INTERVAL (15 s) sans
+  // nouveauté: rien pendant deux intervalles, le flux est bloqué.
+  const SSE_STALL_MS = 30000;
+
+  function startHttpTransport() {
+    const cfg = window.CHAT_CONFIG;
+    let streaming = false;
+    let longPolling = false;
+
+    function longPoll() {
+      longPolling = true;
+      $.ajax({
+        url: cfg.apiMessagesUrl,
+        data: { after: getLastId(), seq: changeSeq, wait: LONG_POLL_WAIT_S, format: WIRE_FORMAT },
+        timeout: (LONG_POLL_WAIT_S + 10) * 1000,
+      })
+        .done(function (resp) {
+          decodeMessages(resp.messages).forEach(function (m) {
+            roomEvents.emit("message", { message: m });
+          });
+          if (resp.deleted_ids && resp.deleted_ids.length) {
+            roomEvents.emit("delete", { deleted_ids: resp.deleted_ids });
+          }
+          if (resp.seq > changeSeq) changeSeq = resp.seq;
+          longPoll();
+        })
+        .fail(function (xhr) {
+          if (xhr && xhr.status === 403) {
+            window.location.href = cfg.roomDetailUrl;
+            return;
+          }
+          setTimeout(longPoll, xhr && xhr.status === 429 ? retryAfterMs(xhr) : LONG_POLL_RETRY_MS);
+        });
+    }
+
+    if (window.EventSource && cfg.apiStreamUrl) {
+      const source = new EventSource(cfg.apiStreamUrl + "?after=" + getLastId() + "&seq=" + changeSeq);
+      let stallTimer = null;
+      streaming = true;
+
+      function fallBack() {
+        if (!streaming) return;
+        streaming = false;
+        clearTimeout(stallTimer);
+        source.close();
+        if (cfg.apiMessagesUrl) longPoll();
+      }
+
+      // flux muet (proxy qui garde la connexion sans rien transmettre): long-poll
+      function alive() {
+        clearTimeout(stallTimer);
+        stallTimer = setTimeout(fallBack, SSE_STALL_MS);
+      }
+
+      alive();
+      source.onopen = alive;
+      source.addEventListener("ping", alive);
+      source.addEventListener("message", function (e) {
+        alive();
+        roomEvents.emit("message", { message: JSON.parse(e.data) });
+      });
+      source.addEventListener("delete", function (e) {
+        alive();
+        roomEvents.emit("delete", JSON.parse(e.data));
+      });
+      source.onerror = function () {
+        // EventSource se reconnecte seul (Last-Event-ID); fermé = 403 ou proxy => long-poll
+        if (source.readyState === EventSource.CLOSED) fallBack();
+      };
+    } else if (cfg.apiMessagesUrl) {
+      longPoll();
+    }
+
+    let stateVersion = -1;
+
+    function sync(done) {
+      const params = { state_version: stateVersion, format: WIRE_FORMAT };
+      // les messages arrivent déjà par le flux SSE ou le long-poll
+      if (streaming || longPolling) {
+        params.messages = 0;
+      } else {
+        params.after = getLastId();
+        params.seq = changeSeq;
+      }
+      $.get(cfg.apiSyncUrl, params)
+        .done(function (resp) {
+          const messages = decodeMessages(resp.messages);
+          const typing = resp.typing || [];
+          messages.forEach(function (m) {
+            roomEvents.emit("message", { message: m });
+          });
+          if (resp.deleted_ids && resp.deleted_ids.length) {
+            roomEvents.emit("delete", { deleted_ids: resp.deleted_ids });
+          }
+          if (resp.seq > changeSeq) changeSeq = resp.seq;
+          roomEvents.emit("typing", { typing: typing });
+          if (resp.state) {
+            stateVersion = resp.state.version;
+            roomEvents.emit("state", resp.state);
+          }
+          const empty = !messages.length && !(resp.deleted_ids || []).length && !typing.length && !resp.state;
+          done({ interval: resp.next_poll_ms, empty: empty });
+        })
+        .fail(function (xhr) {
+          if (xhr && xhr.status === 403) {
+            window.location.href = cfg.roomDetailUrl;
+            return;
+          }
+          done({ empty: true, wait: xhr && xhr.status === 429 ? retryAfterMs(xhr) : 0 });
+        });
+    }
+
+    syncPoller = adaptivePoll(sync);
+  }
+
+  function startRoomTransport() {
+    if (!window.CHAT_CONFIG || !window.CHAT_CONFIG.apiSyncUrl) return;
+    if (roomSocket) roomSocket.onFallback(startHttpTransport);
+    else startHttpTransport();
+  }
+
+  function initChatRoom() {
+    if (!window.CHAT_CONFIG || !window.CHAT_CONFIG.apiMessagesUrl) return;
+    if (!$("#chat-box").length) return;
+
     function scrollToBottomIfNearBottom() {
       const box = $("#chat-box")[0];
       const distanceFromBottom = box.scrollHeight - box.scrollTop - box.clientHeight;
@@ -89,75 +371,91 @@
       }
     }
 
-    function fetchMessages() {
-      const after = getLastId();
-      $.get(window.CHAT_CONFIG.apiMessagesUrl, { after: after, since: lastSync })
-        .done(function (resp) {
-          if (resp.messages && resp.messages.length) {
-            resp.messages.forEach(function (m) {
-              $("#chat-box").append(renderMessage(m));
-            });
-            scrollToBottomIfNearBottom();
-          }
+    function appendMessage(m) {
+      // le flux et l'envoi peuvent livrer le même message
+      if ($('#chat-box [data-id="' + m.id + '"]').length) return;
+      $("#chat-box").append(renderMessage(m));
+    }
 
-          if (resp.deleted_ids && resp.deleted_ids.length) {
-            resp.deleted_ids.forEach(function (id) {
-              const el = $('#chat-box [data-id="' + id + '"]');
-              if (!el.length) return;
-            el.find(".message-text").text("[message supprimé]");
-              el.find(".delete-btn").remove();
-            });
-          }
+    // Historique plus ancien chargé à la demande, quand on remonte en haut
+    let hasOlder = !!window.CHAT_CONFIG.hasOlder;
+    let loadingOlder = false;
 
-          lastSync = resp.server_now || new Date().toISOString();
+    function loadOlder() {
+      if (!hasOlder || loadingOlder || !window.CHAT_CONFIG.apiHistoryUrl) return;
+      const first = $("#chat-box > [data-id]").first();
+      if (!first.length) return;
+      loadingOlder = true;
+      $.get(window.CHAT_CONFIG.apiHistoryUrl, { before: first.attr("data-id"), format: WIRE_FORMAT })
+        .done(function (resp) {
+          const box = $("#chat-box")[0];
+          const previousHeight = box.scrollHeight;
+          $("#chat-box").prepend(decodeMessages(resp.messages).map(renderMessage).join(""));
+          // garde à l'écran le message qui y était
+          box.scrollTop += box.scrollHeight - previousHeight;
+          hasOlder = !!resp.has_more;
         })
-      .fail(function (xhr) {
-        if (xhr && xhr.status === 403) {
-          window.location.href = window.CHAT_CONFIG.roomDetailUrl;
-          return;
-        }
-        // silencieux
-      });
+        .always(function () {
+          loadingOlder = false;
+        });
+    }
+
+    $("#chat-box").on("scroll", function () {
+      if (this.scrollTop < 80) loadOlder();
+    });
+
+    function markDeleted(id) {
+      const el = $('#chat-box [data-id="' + id + '"]');
+      if (!el.length) return;
+      el.find(".message-text").text("[message supprimé]");
+      el.find(".delete-btn").remove();
     }
 
     function sendMessage() {
       const content = ($("#msg-input").val() || "").trim();
       if (!content) return;
 
+      if (roomSocket && roomSocket.send({ type: "send", content: content })) {
+        $("#msg-input").val("");
+        return;
+      }
+
+      if (syncPoller) syncPoller.reset();
       $.post(window.CHAT_CONFIG.apiSendUrl, {
         content: content,
         csrfmiddlewaretoken: window.CHAT_CONFIG.csrfToken,
       })
         .done(function (resp) {
           if (resp.ok && resp.message) {
-            $("#chat-box").append(renderMessage(resp.message));
+            appendMessage(resp.message);
             $("#msg-input").val("");
             const box = $("#chat-box")[0];
             box.scrollTop = box.scrollHeight;
           }
         })
         .fail(function (xhr) {
-          alert("Erreur envoi message (" + xhr.status + ")");
+          if (xhr.status === 429) {
+            alert("Trop de messages, réessayez dans " + Math.ceil(retryAfterMs(xhr) / 1000) + " s.");
+          } else {
+            alert("Erreur envoi message (" + xhr.status + ")");
+          }
         });
     }
 
     function deleteMessage(messageId) {
+      if (roomSocket && roomSocket.send({ type: "delete", id: messageId })) return;
+
       const url = window.CHAT_CONFIG.apiDeleteBase + messageId + "/";
       $.post(url, { csrfmiddlewaretoken: window.CHAT_CONFIG.csrfToken })
         .done(function () {
           // update UI: remplace contenu
-          const el = $('#chat-box [data-id="' + messageId + '"]');
-          el.find(".message-text").text("[message supprimé]");
-          el.find(".delete-btn").remove();
+          markDeleted(messageId);
         })
         .fail(function (xhr) {
           alert("Impossible de supprimer (" + xhr.status + ")");
         });
     }
 
-    fetchMessages();
-    setInterval(fetchMessages, 1500);
-
     $("#send-btn").on("click", sendMessage);
     $("#msg-input").on("keypress", function (e) {
       if (e.which === 13) sendMessage();
@@ -166,42 +464,57 @@
     let lastTypingSent = 0;
 
     function sendTypingPing() {
+      if (roomSocket && roomSocket.send({ type: "typing" })) return;
       if (!window.CHAT_CONFIG.apiTypingUrl) return;
       $.post(window.CHAT_CONFIG.apiTypingUrl, {
         csrfmiddlewaretoken: window.CHAT_CONFIG.csrfToken,
+      }).fail(function (xhr) {
+        // plus de ping avant la fin du délai
+        if (xhr.status === 429) lastTypingSent = Date.now() + retryAfterMs(xhr);
       });
     }
 
-    function pollTyping() {
-      if (!window.CHAT_CONFIG.apiTypingUrl || !typingIndicator.length) return;
-      $.get(window.CHAT_CONFIG.apiTypingUrl)
-        .done(function (resp) {
-          if (resp.typing && resp.typing.length) {
-            const verb = resp.typing.length > 1 ? "sont" : "est";
-            typingIndicator.text(resp.typing.join(", ") + " " + verb + " en train d'écrire...");
-            typingIndicator.addClass("typing-active");
-          } else {
-            typingIndicator.text("");
-            typingIndicator.removeClass("typing-active");
-          }
-        })
-        .fail(function () {
-          typingIndicator.text("");
-          typingIndicator.removeClass("typing-active");
-        });
+    function renderTyping(users) {
+      if (users && users.length) {
+        const verb = users.length > 1 ? "sont" : "est";
+        typingIndicator.text(users.join(", ") + " " + verb + " en train d'écrire...");
+        typingIndicator.addClass("typing-active");
+      } else {
+        typingIndicator.text("");
+        typingIndicator.removeClass("typing-active");
+      }
     }
 
     $("#msg-input").on("input", function () {
       const now = Date.now();
       if (now - lastTypingSent < 800) return;
       lastTypingSent = now;
+      if (syncPoller) syncPoller.reset();
       sendTypingPing();
     });
 
-    if (window.CHAT_CONFIG.apiTypingUrl && typingIndicator.length) {
-      pollTyping();
-      setInterval(pollTyping, 1000);
-    }
+    roomEvents.on("message", function (data) {
+      appendMessage(data.message);
+      scrollToBottomIfNearBottom();
+    });
+    roomEvents.on("delete", function (data) {
+      (data.deleted_ids || []).forEach(markDeleted);
+    });
+    roomEvents.on("typing", function (data) {
+      if (typingIndicator.length) renderTyping(data.typing);
+    });
+    roomEvents.on("error", function (data) {
+      if (data.error === "rate_limited") {
+        const wait = Math.max(data.retry_after || 0, 1) * 1000;
+        if (data.scope === "typing") lastTypingSent = Date.now() + wait;
+        else alert("Trop de messages, réessayez dans " + Math.ceil(wait / 1000) + " s.");
+      } else if (data.error === "empty" || data.error === "too_long") {
+        alert("Erreur envoi message (" + data.error + ")");
+      } else if (data.error === "forbidden") {
+        alert("Action impossible (" + data.error + ")");
+      }
+    });
+
     $(".emoji-btn").on("click", function () {
       const emo = $(this).data("emoji");
       const input = $("#msg-input");
@@ -273,20 +586,27 @@
       );
     }
 
-    function fetchRooms() {
-      $.get(window.CHAT_LIST_CONFIG.apiRoomListUrl)
+    let interval = 0;
+
+    function fetchRooms(done) {
+      // ifModified: jQuery renvoie l'ETag, un 304 arrive ici sans corps
+      $.ajax({ url: window.CHAT_LIST_CONFIG.apiRoomListUrl, ifModified: true })
         .done(function (resp) {
-          if (!resp.rooms) return;
+          if (!resp || !resp.rooms) {
+            done({ interval: interval, empty: true });
+            return;
+          }
+          interval = resp.next_poll_ms || 0;
           const html = resp.rooms.map(renderRoomItem).join("");
           listEl.html(html || '<div class="list-group-item">Aucun salon pour l\'instant.</div>');
+          done({ interval: interval, empty: false });
         })
         .fail(function () {
-          // silencieux
+          done({ interval: interval, empty: true });
         });
     }
 
-    fetchRooms();
-    setInterval(fetchRooms, 3000);
+    adaptivePoll(fetchRooms);
   }
 
   function initRoomState() {
@@ -294,147 +614,192 @@
     const membersEl = $("#members-list");
     if (!membersEl.length) return;
 
-    function renderMembers(resp) {
-      if (resp.room && resp.room.name) {
-        $("#room-name").text(resp.room.name);
-        $(".rename-input").val(resp.room.name);
-      }
-      if (resp.role) {
-        $("#current-role").text(roleLabel(resp.role));
-      }
-      if (!resp.members) return;
+    const ROLE_ORDER = ["OWNER", "MOD", "MEMBER", "BANNED"];
+    // user_id -> membre, tenu à jour par les états complets et les deltas
+    let members = {};
+    let currentRole = "";
+
+    function roleTitle(role) {
+      return role === "OWNER"
+        ? "Créateur"
+        : role === "MOD"
+        ? "Modérateur"
+        : role === "MEMBER"
+        ? "Membres"
+        : role === "BANNED"
+        ? "Bannis"
+        : role;
+    }
 
-      const groups = { OWNER: [], MOD: [], MEMBER: [], BANNED: [] };
-      resp.members.forEach(function (m) {
-        if (!groups[m.role]) groups[m.role] = [];
-        groups[m.role].push(m);
-      });
+    function compareMembers(a, b) {
+      return a.username < b.username ? -1 : a.username > b.username ? 1 : 0;
+    }
+
+    function blockHtml(role, rows) {
+      return (
+        '<div class="member-role-block" data-role="' +
+        role +
+        '">' +
+        '<div class="member-role-title">' +
+        roleTitle(role) +
+        "</div>" +
+        '<div class="list-group">' +
+        rows +
+        "</div></div>"
+      );
+    }
 
-      const order = ["OWNER", "MOD", "MEMBER", "BANNED"];
-      const currentRole = resp.role;
+    function memberRowHtml(mem) {
       const currentUserId = window.CHAT_CONFIG.currentUserId;
       const csrf = escapeHtml(window.CHAT_CONFIG.csrfToken || "");
+      const mutedClass = mem.role === "BANNED" ? "opacity-50" : "";
+      let actions = "";
+
+      if (
+        currentRole === "OWNER" &&
+        mem.role !== "OWNER" &&
+        mem.user_id !== currentUserId
+      ) {
+        if (mem.role === "MOD") {
+          actions +=
+            '<form method="post" action="' +
+            window.CHAT_CONFIG.apiUnmodBase +
+            mem.user_id +
+            '/" class="d-inline">' +
+            '<input type="hidden" name="csrfmiddlewaretoken" value="' +
+            csrf +
+            '">' +
+            '<button type="submit" class="btn btn-sm btn-outline-secondary member-action-btn">Retirer modérateur</button>' +
+            "</form>";
+        } else if (mem.role !== "BANNED") {
+          actions +=
+            '<form method="post" action="' +
+            window.CHAT_CONFIG.apiModBase +
+            mem.user_id +
+            '/" class="d-inline">' +
+            '<input type="hidden" name="csrfmiddlewaretoken" value="' +
+            csrf +
+            '">' +
+            '<button type="submit" class="btn btn-sm btn-outline-primary member-action-btn">Mettre modérateur</button>' +
+            "</form>";
+        }
+      }
 
-      let html = "";
-      order.forEach(function (role) {
-        const list = groups[role] || [];
-        if (!list.length) return;
-
-        const title =
-          role === "OWNER"
-            ? "Créateur"
-            : role === "MOD"
-            ? "Modérateur"
-            : role === "MEMBER"
-            ? "Membres"
-            : role === "BANNED"
-            ? "Bannis"
-            : role;
-
-        html += '<div class="member-role-block">';
-        html += '<div class="member-role-title">' + title + "</div>";
-        html += '<div class="list-group">';
-
-        list.forEach(function (mem) {
-          const mutedClass = mem.role === "BANNED" ? "opacity-50" : "";
-          let actions = "";
-
-          if (
-            currentRole === "OWNER" &&
-            mem.role !== "OWNER" &&
-            mem.user_id !== currentUserId
-          ) {
-            if (mem.role === "MOD") {
-              actions +=
-                '<form method="post" action="' +
-                window.CHAT_CONFIG.apiUnmodBase +
-                mem.user_id +
-                '/" class="d-inline">' +
-                '<input type="hidden" name="csrfmiddlewaretoken" value="' +
-                csrf +
-                '">' +
-                '<button type="submit" class="btn btn-sm btn-outline-secondary member-action-btn">Retirer modérateur</button>' +
-                "</form>";
-            } else if (mem.role !== "BANNED") {
-              actions +=
-                '<form method="post" action="' +
-                window.CHAT_CONFIG.apiModBase +
-                mem.user_id +
-                '/" class="d-inline">' +
-                '<input type="hidden" name="csrfmiddlewaretoken" value="' +
-                csrf +
-                '">' +
-                '<button type="submit" class="btn btn-sm btn-outline-primary member-action-btn">Mettre modérateur</button>' +
-                "</form>";
-            }
-          }
-
-          if (currentRole === "OWNER" || currentRole === "MOD") {
-            if (mem.role === "BANNED") {
-              actions +=
-                '<form method="post" action="' +
-                window.CHAT_CONFIG.apiUnbanBase +
-                mem.user_id +
-                '/" class="d-inline">' +
-                '<input type="hidden" name="csrfmiddlewaretoken" value="' +
-                csrf +
-                '">' +
-                '<button type="submit" class="btn btn-sm btn-outline-success member-action-btn">Débannir</button>' +
-                "</form>";
-            } else if (mem.role !== "OWNER" && mem.user_id !== currentUserId) {
-              actions +=
-                '<form method="post" action="' +
-                window.CHAT_CONFIG.apiBanBase +
-                mem.user_id +
-                '/" class="d-inline">' +
-                '<input type="hidden" name="csrfmiddlewaretoken" value="' +
-                csrf +
-                '">' +
-                '<button type="submit" class="btn btn-sm btn-outline-danger member-action-btn">Bannir</button>' +
-                "</form>";
-            }
-          }
-
-          html +=
-            '<div class="list-group-item member-row d-flex flex-column ' +
-            mutedClass +
+      if (currentRole === "OWNER" || currentRole === "MOD") {
+        if (mem.role === "BANNED") {
+          actions +=
+            '<form method="post" action="' +
+            window.CHAT_CONFIG.apiUnbanBase +
+            mem.user_id +
+            '/" class="d-inline">' +
+            '<input type="hidden" name="csrfmiddlewaretoken" value="' +
+            csrf +
             '">' +
-            '<div class="member-name"><strong>' +
-            escapeHtml(mem.username) +
-            "</strong></div>" +
-            '<div class="member-actions">' +
-            actions +
-            "</div>" +
-            "</div>";
-        });
+            '<button type="submit" class="btn btn-sm btn-outline-success member-action-btn">Débannir</button>' +
+            "</form>";
+        } else if (mem.role !== "OWNER" && mem.user_id !== currentUserId) {
+          actions +=
+            '<form method="post" action="' +
+            window.CHAT_CONFIG.apiBanBase +
+            mem.user_id +
+            '/" class="d-inline">' +
+            '<input type="hidden" name="csrfmiddlewaretoken" value="' +
+            csrf +
+            '">' +
+            '<button type="submit" class="btn btn-sm btn-outline-danger member-action-btn">Bannir</button>' +
+            "</form>";
+        }
+      }
 
-        html += "</div></div>";
-      });
+      return (
+        '<div class="list-group-item member-row d-flex flex-column ' +
+        mutedClass +
+        '" data-user-id="' +
+        mem.user_id +
+        '">' +
+        '<div class="member-name"><strong>' +
+        escapeHtml(mem.username) +
+        "</strong></div>" +
+        '<div class="member-actions">' +
+        actions +
+        "</div>" +
+        "</div>"
+      );
+    }
 
+    function renderAll() {
+      const groups = {};
+      Object.keys(members).forEach(function (id) {
+        const m = members[id];
+        (groups[m.role] = groups[m.role] || []).push(m);
+      });
+      let html = "";
+      ROLE_ORDER.forEach(function (role) {
+        const list = (groups[role] || []).sort(compareMembers);
+        if (list.length) html += blockHtml(role, list.map(memberRowHtml).join(""));
+      });
       membersEl.html(html);
     }
 
-    function fetchState() {
-      $.get(window.CHAT_CONFIG.apiRoomStateUrl)
-        .done(function (resp) {
-          renderMembers(resp);
-        })
-        .fail(function (xhr) {
-          if (xhr && xhr.status === 403) {
-            window.location.href = window.CHAT_CONFIG.roomDetailUrl;
-            return;
-          }
-          // silencieux
+    // Membre modifié (delta): sa ligne sort de son ancien bloc et entre à sa
+    // place dans celui de son rôle, le reste de la liste n'est pas touché.
+    function patchMember(mem) {
+      const old = membersEl.find('.member-row[data-user-id="' + mem.user_id + '"]');
+      const oldBlock = old.closest(".member-role-block");
+      old.remove();
+      if (oldBlock.length && !oldBlock.find(".member-row").length) oldBlock.remove();
+
+      const rank = ROLE_ORDER.indexOf(mem.role);
+      if (rank < 0) return;
+      let block = membersEl.children('.member-role-block[data-role="' + mem.role + '"]');
+      if (!block.length) {
+        block = $(blockHtml(mem.role, ""));
+        const nextBlock = membersEl.children(".member-role-block").filter(function () {
+          return ROLE_ORDER.indexOf($(this).attr("data-role")) > rank;
         });
+        if (nextBlock.length) block.insertBefore(nextBlock.first());
+        else membersEl.append(block);
+      }
+      const nextRow = block.find(".member-row").filter(function () {
+        const other = members[$(this).attr("data-user-id")];
+        return other && compareMembers(other, mem) > 0;
+      });
+      const row = $(memberRowHtml(mem));
+      if (nextRow.length) row.insertBefore(nextRow.first());
+      else block.children(".list-group").append(row);
+    }
+
+    function renderMembers(resp) {
+      if (resp.unchanged) return;
+      if (resp.room && resp.room.name) {
+        $("#room-name").text(resp.room.name);
+        $(".rename-input").val(resp.room.name);
+      }
+      if (resp.role) {
+        $("#current-role").text(roleLabel(resp.role));
+      }
+      if (!resp.members) return;
+
+      // les boutons de chaque ligne dépendent du rôle du lecteur
+      const roleChanged = resp.role !== currentRole;
+      currentRole = resp.role;
+      if (!resp.delta) members = {};
+      resp.members.forEach(function (m) {
+        members[m.user_id] = m;
+      });
+      if (!resp.delta || roleChanged) renderAll();
+      else resp.members.forEach(patchMember);
     }
 
-    fetchState();
-    setInterval(fetchState, 3000);
+    roomEvents.on("state", renderMembers);
   }
 
   $(function () {
+    if (window.CHAT_CONFIG) changeSeq = window.CHAT_CONFIG.changeSeq || 0;
+    roomSocket = createRoomSocket();
     initChatRoom();
     initRoomList();
     initRoomState();
+    startRoomTransport();
   });
 })();
@@ -1,3 +1,1660 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+import time
+import types
+import unittest
+import zlib
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.db.models import F
+from django.http import HttpResponse, JsonResponse
+from django.test import AsyncClient, Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import db, metrics, presence, pubsub, ratelimit, recent, search, services, urls, wire
+from .consumers import websocket_application
+from .middleware import CompressionMiddleware
+from .models import Room, Message, MessageChange, Membership
+from .services import ChatError, serialize_message
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "plans EXPLAIN propres à SQLite")
+class HotQueryIndexTests(TestCase):
+    """Les requêtes des chemins chauds doivent passer par un index, jamais par un scan de table."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice", password="x")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+        Message.objects.bulk_create(
+            [Message(room=cls.room, author=cls.user, content=f"m{i}") for i in range(50)]
+        )
+
+    def assertSearchesIndex(self, qs, index_name: str):
+        plan = qs.explain()
+        table = qs.model._meta.db_table
+        self.assertIn(f"SEARCH {table} USING INDEX {index_name}", plan)
+        self.assertNotIn(f"SCAN {table}", plan)
+
+    def test_new_messages_after_id(self):
+        qs = Message.objects.filter(room=self.room, id__gt=10).select_related("author").order_by("id")[:200]
+        self.assertSearchesIndex(qs, "chat_msg_room_id_idx")
+
+    def test_changes_after_seq(self):
+        qs = MessageChange.objects.filter(room=self.room, id__gt=10).values_list("id", "message_id", "kind")
+        # index de la clé étrangère room: (room_id, rowid), rowid étant l'id
+        plan = qs.explain()
+        self.assertIn("SEARCH chat_messagechange USING INDEX", plan)
+        self.assertIn("(room_id=? AND rowid>?)", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_last_message_of_room(self):
+        qs = Message.objects.filter(room=self.room).order_by("-id")[:1]
+        self.assertSearchesIndex(qs, "chat_msg_room_id_idx")
+        self.assertNotIn("TEMP B-TREE", qs.explain())
+
+    def test_membership_lookup(self):
+        qs = Membership.objects.filter(user=self.user, room=self.room)
+        # index unique de unique_together ("user", "room")
+        self.assertIn("SEARCH chat_membership USING INDEX", qs.explain())
+        self.assertIn("(user_id=? AND room_id=?)", qs.explain())
+
+    def test_room_listing_order(self):
+        qs = Room.objects.order_by(F("last_message_created_at").desc(nulls_last=True), "name")
+        plan = qs.explain()
+        self.assertIn("USING INDEX chat_room_last_msg_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+async def read_events(client, url: str, data: dict, count: int, timeout: float = 5):
+    """(réponse, `count` premiers morceaux) d'un flux SSE, puis fermeture du flux."""
+    response = await client.get(url, data)
+    chunks = aiter(response.streaming_content)
+    try:
+        events = [(await asyncio.wait_for(anext(chunks), timeout)).decode() for _ in range(count)]
+    finally:
+        await chunks.aclose()
+    return response, events
+
+
+@override_settings(CHAT_RATELIMIT={})
+class MessageStreamTests(TestCase):
+    """Flux SSE (api_messages_stream): générateur asynchrone, réservé à ASGI."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+        cls.message = Message.objects.create(room=cls.room, author=cls.user, content="bonjour")
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse("api_messages_stream", args=[self.room.id])
+
+    def test_wsgi_refused(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {"error": "stream_unavailable"})
+
+    async def test_events_arrive_before_close(self):
+        await self.async_client.aforce_login(self.user)
+        response, events = await read_events(self.async_client, self.url, {"after": self.message.id - 1}, 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(events[0].startswith("retry:"))
+        self.assertIn("event: message", events[1])
+        self.assertIn('"content": "bonjour"', events[1])
+
+    async def test_live_event(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url, {"after": self.message.id})
+        chunks = aiter(response.streaming_content)
+        try:
+            await asyncio.wait_for(anext(chunks), 5)  # retry
+            payload = dict(services.message_payload(self.message), id=self.message.id + 1, content="en direct")
+            pubsub.publish(pubsub.room_channel(self.room.id), {"type": "message", "message": payload})
+            event = (await asyncio.wait_for(anext(chunks), 5)).decode()
+        finally:
+            await chunks.aclose()
+        self.assertIn("event: message", event)
+        self.assertIn("en direct", event)
+        self.assertIn(f"id: {self.message.id + 1}:", event)
+
+    async def test_catch_up_past_one_page(self):
+        await self.async_client.aforce_login(self.user)
+        backlog = services.MESSAGES_PAGE_SIZE + 100
+        await Message.objects.abulk_create(
+            Message(room=self.room, author=self.user, content=f"m{i}") for i in range(backlog)
+        )
+        ids = [i async for i in Message.objects.filter(room=self.room).order_by("id").values_list("id", flat=True)]
+        response = await self.async_client.get(self.url, {"after": 0, "seq": 0})
+        chunks = aiter(response.streaming_content)
+        try:
+            await asyncio.wait_for(anext(chunks), 5)  # retry
+            payload = dict(services.message_payload(self.message), id=ids[-1] + 1, content="en direct")
+            # publié avant la fin du rattrapage: ne doit rien faire sauter
+            pubsub.publish(pubsub.room_channel(self.room.id), {"type": "message", "message": payload})
+            events = [(await asyncio.wait_for(anext(chunks), 5)).decode() for _ in range(len(ids) + 1)]
+        finally:
+            await chunks.aclose()
+        sent = [json.loads(e.split("data: ", 1)[1])["id"] for e in events]
+        self.assertEqual(sent, ids + [ids[-1] + 1])
+
+    async def test_catch_up_past_one_batch_of_changes(self):
+        await self.async_client.aforce_login(self.user)
+        await MessageChange.objects.abulk_create(
+            MessageChange(room=self.room, message=self.message, kind=MessageChange.DELETE) for _ in range(3)
+        )
+        seqs = [i async for i in MessageChange.objects.order_by("id").values_list("id", flat=True)]
+        with mock.patch.object(services, "CHANGES_BATCH", 2):
+            _response, events = await read_events(
+                self.async_client, self.url, {"after": self.message.id, "seq": 0}, 3
+            )
+        self.assertEqual([json.loads(e.split("data: ", 1)[1])["seq"] for e in events[1:]], [seqs[1], seqs[2]])
+
+    async def test_heartbeat_is_an_event(self):
+        # un commentaire ": ping" n'est pas visible d'EventSource: chat.js ne pourrait pas détecter un flux muet
+        await self.async_client.aforce_login(self.user)
+        with mock.patch("chat.views.SSE_HEARTBEAT_INTERVAL", 0.05):
+            _response, events = await read_events(self.async_client, self.url, {"after": self.message.id}, 2)
+        self.assertEqual(events[1], "event: ping\ndata: {}\n\n")
+
+
+# l'écriture qui réveille le long-poll vient d'une autre thread: elle doit être validée
+@override_settings(CHAT_RATELIMIT={})
+class LongPollTests(TransactionTestCase):
+    """api_messages?wait=: réveil à la publication, réponse vide au bout de l'attente."""
+
+    def setUp(self):
+        cache.clear()
+        recent.store.clear()
+        self.user = User.objects.create_user("alice")
+        self.other = User.objects.create_user("bob")
+        self.room = Room.objects.create(name="general", created_by=self.user)
+        self.membership = Membership.objects.create(user=self.user, room=self.room, role=Membership.MEMBER)
+        self.other_membership = Membership.objects.create(user=self.other, room=self.room, role=Membership.OWNER)
+        self.client.force_login(self.user)
+        self.url = reverse("api_messages", args=[self.room.id])
+
+    def later(self, fn, delay: float = 0.2):
+        def run():
+            try:
+                fn()
+            finally:
+                connection.close()
+
+        timer = threading.Timer(delay, run)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def poll(self, wait) -> tuple:
+        started = time.monotonic()
+        response = self.client.get(self.url, {"after": 0, "seq": 0, "wait": wait})
+        return response.json(), time.monotonic() - started
+
+    def test_wakes_on_publish(self):
+        self.later(lambda: services.send_message(self.other, self.room, self.other_membership, "réveil"))
+        data, elapsed = self.poll(10)
+        self.assertEqual([m["content"] for m in data["messages"]], ["réveil"])
+        self.assertLess(elapsed, 5)
+
+    def test_empty_at_timeout(self):
+        data, elapsed = self.poll(1)
+        self.assertEqual((data["messages"], data["deleted_ids"]), ([], []))
+        self.assertGreaterEqual(elapsed, 0.9)
+
+    def test_own_membership_change_returns_early(self):
+        def ban():
+            Membership.objects.filter(pk=self.membership.pk).update(role=Membership.BANNED)
+            services.member_changed(Membership.objects.get(pk=self.membership.pk))
+
+        self.later(ban)
+        data, elapsed = self.poll(10)
+        self.assertEqual(data["messages"], [])
+        self.assertLess(elapsed, 5)
+        # le poll suivant revérifie les droits
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_other_membership_change_keeps_waiting(self):
+        carol = User.objects.create_user("carol")
+        self.later(lambda: services.member_changed(Membership.objects.create(user=carol, room=self.room)))
+        _data, elapsed = self.poll(1)
+        self.assertGreaterEqual(elapsed, 0.9)
+
+    def test_wait_is_capped(self):
+        with mock.patch("chat.views.LONG_POLL_MAX_WAIT", 1):
+            data, elapsed = self.poll(3600)
+        self.assertEqual(data["messages"], [])
+        self.assertLess(elapsed, 5)
+
+
+@override_settings(CHAT_RATELIMIT={})
+class MembershipCacheTests(TestCase):
+    """Le cache d'adhésion ne doit jamais servir un rôle changé par un autre processus."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user("owner")
+        cls.user = User.objects.create_user("bob")
+        cls.room = Room.objects.create(name="general", created_by=cls.owner)
+        Membership.objects.create(user=cls.owner, room=cls.room, role=Membership.OWNER)
+        cls.membership = Membership.objects.create(user=cls.user, room=cls.room, role=Membership.MEMBER)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def change_role_elsewhere(self, role: str):
+        # ce qu'un autre worker laisse en base, sans toucher au cache de celui-ci
+        Membership.objects.filter(pk=self.membership.pk).update(role=role)
+        Room.objects.filter(pk=self.room.pk).update(state_version=F("state_version") + 1)
+
+    def test_ban_seen_through_warm_cache(self):
+        sync = reverse("api_sync", args=[self.room.id])
+        self.assertEqual(self.client.get(sync).status_code, 200)
+        self.change_role_elsewhere(Membership.BANNED)
+        self.assertEqual(self.client.get(sync).json(), {"error": "banned"})
+        send = reverse("api_send_message", args=[self.room.id])
+        self.assertEqual(self.client.post(send, {"content": "x"}).status_code, 403)
+
+    def test_unban_seen_through_warm_cache(self):
+        Membership.objects.filter(pk=self.membership.pk).update(role=Membership.BANNED)
+        sync = reverse("api_sync", args=[self.room.id])
+        self.assertEqual(self.client.get(sync).status_code, 403)
+        self.change_role_elsewhere(Membership.MEMBER)
+        self.assertEqual(self.client.get(sync).status_code, 200)
+
+    def test_cache_hit_without_change(self):
+        sync = reverse("api_sync", args=[self.room.id])
+        version = self.client.get(sync).json()["state_version"]
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(sync, {"state_version": version})
+        self.assertFalse([q for q in ctx.captured_queries if "chat_membership" in q["sql"]])
+
+
+@override_settings(CHAT_RATELIMIT={})
+class RoomStateTests(TestCase):
+    """api_room_state: inchangé, delta des adhésions depuis `version`, ou liste complète."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user("owner")
+        cls.bob = User.objects.create_user("bob")
+        cls.room = Room.objects.create(name="general", created_by=cls.owner)
+        services.member_changed(Membership.objects.create(user=cls.owner, room=cls.room, role=Membership.OWNER))
+        services.member_changed(Membership.objects.create(user=cls.bob, room=cls.room, role=Membership.MEMBER))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.owner)
+        self.url = reverse("api_room_state", args=[self.room.id])
+
+    def state(self, version=None) -> dict:
+        return self.client.get(self.url, {} if version is None else {"version": version}).json()
+
+    def member_version(self, user) -> int:
+        return Membership.objects.get(room=self.room, user=user).version
+
+    def roles(self, state) -> dict:
+        return {m["username"]: m["role"] for m in state["members"]}
+
+    def test_full_then_unchanged(self):
+        state = self.state()
+        self.assertNotIn("delta", state)
+        self.assertEqual(self.roles(state), {"owner": Membership.OWNER, "bob": Membership.MEMBER})
+        self.assertEqual(state["version"], Room.objects.get(id=self.room.id).state_version)
+        unchanged = self.state(state["version"])
+        self.assertEqual(unchanged["version"], state["version"])
+        self.assertTrue(unchanged["unchanged"])
+        self.assertNotIn("members", unchanged)
+
+    def test_join_bumps_version_and_is_in_delta(self):
+        version = self.state()["version"]
+        carol = User.objects.create_user("carol")
+        self.client.force_login(carol)
+        self.client.get(reverse("room_detail", args=[self.room.id]))
+        self.assertEqual(self.member_version(carol), version + 1)
+
+        self.client.force_login(self.owner)
+        delta = self.state(version)
+        self.assertTrue(delta["delta"])
+        self.assertEqual(delta["version"], version + 1)
+        self.assertEqual(self.roles(delta), {"carol": Membership.MEMBER})
+
+    def test_ban_and_role_change_bump_version(self):
+        version = self.state()["version"]
+        self.client.post(reverse("set_moderator", args=[self.room.id, self.bob.id]))
+        self.assertEqual(self.member_version(self.bob), version + 1)
+        self.assertEqual(self.roles(self.state(version)), {"bob": Membership.MOD})
+
+        # un banni quitte le salon: son adhésion reste, avec le rôle BANNED
+        self.client.post(reverse("ban_user", args=[self.room.id, self.bob.id]))
+        self.assertEqual(self.member_version(self.bob), version + 2)
+        self.assertEqual(self.roles(self.state(version + 1)), {"bob": Membership.BANNED})
+        # depuis une version plus ancienne: le dernier état de chaque adhésion changée
+        self.assertEqual(self.roles(self.state(version)), {"bob": Membership.BANNED})
+
+    def test_unknown_version_gets_full_list(self):
+        current = self.state()["version"]
+        for version in (current + 5, -1, "abc"):
+            state = self.state(version)
+            self.assertNotIn("delta", state, version)
+            self.assertEqual(set(self.roles(state)), {"owner", "bob"})
+
+    def test_banned_reader_refused(self):
+        Membership.objects.filter(user=self.bob).update(role=Membership.BANNED)
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+@override_settings(CHAT_RATELIMIT={})
+class HistoryTests(TestCase):
+    """api_history: pages par clé autour de `before`/`after`, plafond de `limit`, NDJSON."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+        Message.objects.bulk_create(Message(room=cls.room, author=cls.user, content=f"m{i}") for i in range(250))
+        cls.ids = list(Message.objects.filter(room=cls.room).order_by("id").values_list("id", flat=True))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = reverse("api_history", args=[self.room.id])
+
+    def page(self, **params) -> tuple:
+        data = self.client.get(self.url, params).json()
+        return [m["id"] for m in data["messages"]], data["has_more"]
+
+    def test_latest_then_before(self):
+        from .views import HISTORY_PAGE_SIZE
+
+        ids, has_more = self.page()
+        self.assertEqual(ids, self.ids[-HISTORY_PAGE_SIZE:])
+        self.assertTrue(has_more)
+        ids, has_more = self.page(before=ids[0])
+        self.assertEqual(ids, self.ids[-2 * HISTORY_PAGE_SIZE : -HISTORY_PAGE_SIZE])
+        self.assertTrue(has_more)
+
+    def test_before_boundaries(self):
+        # exactement `limit` messages avant: pas de page suivante
+        self.assertEqual(self.page(before=self.ids[10], limit=10), (self.ids[:10], False))
+        self.assertEqual(self.page(before=self.ids[11], limit=10), (self.ids[1:11], True))
+        self.assertEqual(self.page(before=self.ids[0], limit=10), ([], False))
+
+    def test_after_boundaries(self):
+        self.assertEqual(self.page(after=self.ids[-11], limit=10), (self.ids[-10:], False))
+        self.assertEqual(self.page(after=self.ids[-12], limit=10), (self.ids[-11:-1], True))
+        self.assertEqual(self.page(after=self.ids[-1], limit=10), ([], False))
+        self.assertEqual(self.page(after=0, limit=10), (self.ids[:10], True))
+
+    def test_limit_is_capped(self):
+        from .views import HISTORY_MAX_PAGE_SIZE, HISTORY_PAGE_SIZE
+
+        ids, has_more = self.page(after=0, limit=10_000)
+        self.assertEqual(ids, self.ids[:HISTORY_MAX_PAGE_SIZE])
+        self.assertTrue(has_more)
+        for limit in (0, "abc"):
+            self.assertEqual(len(self.page(limit=limit)[0]), HISTORY_PAGE_SIZE)
+
+    def test_stream_ndjson(self):
+        # 200 messages à suivre: pages pleines jusqu'au bout (50), ou dernière page courte (60)
+        for limit, pages in ((50, [50, 50, 50, 50]), (60, [60, 60, 60, 20])):
+            with self.subTest(limit=limit):
+                response = self.client.get(self.url, {"after": self.ids[49], "stream": 1, "limit": limit})
+                self.assertEqual(response["Content-Type"], "application/x-ndjson")
+                chunks = [c.decode() for c in response.streaming_content]
+                # une page par morceau, jamais de morceau vide
+                self.assertEqual([len(c.splitlines()) for c in chunks], pages)
+                lines = "".join(chunks).splitlines()
+                self.assertEqual([json.loads(line)["id"] for line in lines], self.ids[50:])
+                self.assertEqual(json.loads(lines[0])["content"], "m50")
+
+
+@override_settings(CHAT_RATELIMIT={})
+class WireFormatTests(TestCase):
+    """Formats négociés par `format` ou Accept (chat/wire.py)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.other = User.objects.create_user("bob")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+        for i in range(6):
+            Message.objects.create(room=cls.room, author=cls.user if i % 2 else cls.other, content=f"m{i}")
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = reverse("api_history", args=[self.room.id])
+
+    def test_columnar_round_trip(self):
+        expected = self.client.get(self.url).json()["messages"]
+        response = self.client.get(self.url, {"format": "columnar"})
+        self.assertEqual(response["Content-Type"], wire.COLUMNAR_CONTENT_TYPE)
+        cols = json.loads(response.content)["messages"]
+        self.assertEqual(sorted(cols["authors"]), ["alice", "bob"])
+        decoded = [
+            {
+                "id": cols["id"][i],
+                "author": cols["authors"][cols["author"][i]],
+                "content": cols["content"][i],
+                "created_at": cols["created_at"][i],
+                "is_deleted": cols["is_deleted"][i],
+                "can_delete": cols["can_delete"][i],
+            }
+            for i in range(len(cols["id"]))
+        ]
+        self.assertEqual(decoded, [dict(m, created_at=wire._epoch_ms(m["created_at"])) for m in expected])
+        self.assertEqual(set(wire.columnar([])), set(cols))
+        self.assertFalse(any(wire.columnar([]).values()))
+
+    def test_negotiation(self):
+        cases = [
+            ({}, {}, "json"),
+            ({"format": "columnar"}, {}, "columnar"),
+            ({}, {"HTTP_ACCEPT": wire.COLUMNAR_CONTENT_TYPE}, "columnar"),
+            # le paramètre l'emporte sur l'en-tête
+            ({"format": "json"}, {"HTTP_ACCEPT": wire.COLUMNAR_CONTENT_TYPE}, "json"),
+            ({"format": "xml"}, {"HTTP_ACCEPT": "application/json"}, "json"),
+        ]
+        factory = RequestFactory()
+        for params, headers, fmt in cases:
+            with self.subTest(params=params, headers=headers):
+                self.assertEqual(wire.negotiate(factory.get("/", params, **headers)), fmt)
+
+    def test_msgpack_falls_back_to_columnar(self):
+        with mock.patch.object(wire, "msgpack", None):
+            response = self.client.get(self.url, {"format": "msgpack"})
+        self.assertEqual(response["Content-Type"], wire.COLUMNAR_CONTENT_TYPE)
+
+    def test_vary_accept(self):
+        for fmt in ("json", "columnar"):
+            self.assertIn("Accept", self.client.get(self.url, {"format": fmt})["Vary"])
+
+
+# brotli n'est pas forcément installé: un faux module suffit pour le choix d'encodage
+fake_brotli = types.SimpleNamespace(compress=lambda data, quality: b"br:" + zlib.compress(data, 9))
+
+
+class CompressionTests(TestCase):
+    """CompressionMiddleware: br, puis gzip, puis rien; réponses d'API assez grandes seulement."""
+
+    body = {"messages": [{"id": i, "content": "bonjour tout le monde"} for i in range(50)]}
+
+    def compress(self, response, accept_encoding: str = ""):
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda r: response)(request)
+
+    def test_encoding_choice(self):
+        cases = [
+            (fake_brotli, "gzip, deflate, br", "br"),
+            (fake_brotli, "gzip", "gzip"),
+            (fake_brotli, "", None),
+            (fake_brotli, "identity", None),
+            # brotli absent: gzip même si le client accepte br
+            (None, "gzip, br", "gzip"),
+            (None, "br", None),
+        ]
+        for module, accept, encoding in cases:
+            with self.subTest(brotli=bool(module), accept=accept), mock.patch("chat.middleware.brotli", module):
+                response = self.compress(JsonResponse(self.body), accept)
+                self.assertEqual(response.get("Content-Encoding"), encoding)
+                if encoding:
+                    self.assertIn("Accept-Encoding", response["Vary"])
+                    self.assertEqual(response["Content-Length"], str(len(response.content)))
+                else:
+                    self.assertEqual(json.loads(response.content), self.body)
+
+    def test_gzip_round_trip(self):
+        response = self.compress(JsonResponse(self.body), "gzip")
+        self.assertEqual(json.loads(zlib.decompress(response.content, 16 + zlib.MAX_WBITS)), self.body)
+
+    def test_only_large_api_responses(self):
+        html = HttpResponse("<p>bonjour</p>" * 100, content_type="text/html; charset=utf-8")
+        small = JsonResponse({"ok": True})
+        stream = HttpResponse("data: x\n\n" * 100, content_type="text/event-stream")
+        for response in (html, small, stream):
+            with self.subTest(content_type=response["Content-Type"]), mock.patch("chat.middleware.brotli", fake_brotli):
+                self.assertFalse(self.compress(response, "gzip, br").has_header("Content-Encoding"))
+        columnar = HttpResponse(json.dumps(self.body), content_type=wire.COLUMNAR_CONTENT_TYPE)
+        self.assertEqual(self.compress(columnar, "gzip")["Content-Encoding"], "gzip")
+
+    def test_weak_etag(self):
+        response = JsonResponse(self.body)
+        response["ETag"] = '"v1"'
+        with mock.patch("chat.middleware.brotli", fake_brotli):
+            self.assertEqual(self.compress(response, "br")["ETag"], 'W/"v1"')
+
+
+@override_settings(CHAT_RATELIMIT={}, CHAT_METRICS={"ENABLED": True, "SAMPLE_RATE": 1.0, "TOKEN": "secret"})
+class MetricsTests(TestCase):
+    """MetricsMiddleware, rendu Prometheus et accès à la vue `metrics`."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.staff = User.objects.create_user("admin", is_staff=True)
+
+    def setUp(self):
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        self.client.force_login(self.user)
+
+    def export(self, **headers) -> str:
+        response = Client(**headers).get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        return response.content.decode()
+
+    def test_sampled_request_recorded(self):
+        self.client.get(reverse("api_room_list"))
+        self.client.get("/inconnue/")
+        text = self.export(HTTP_AUTHORIZATION="Bearer secret")
+        self.assertIn('chat_requests_total{view="api_room_list",status="200"} 1', text)
+        self.assertIn('chat_request_duration_seconds_count{view="api_room_list"} 1', text)
+        self.assertIn('chat_request_queries_bucket{view="api_room_list",le="+Inf"} 1', text)
+        # pas de chemin brut en étiquette
+        self.assertIn('chat_requests_total{view="unresolved",status="404"} 1', text)
+        self.assertNotIn("inconnue", text)
+
+    def test_sampling(self):
+        url = reverse("api_room_list")
+        cases = [
+            ({"ENABLED": False}, 0.0, 0),
+            ({"SAMPLE_RATE": 0.0}, 0.0, 0),
+            ({"SAMPLE_RATE": 0.5}, 0.7, 0),
+            ({"SAMPLE_RATE": 0.5}, 0.3, 1),
+        ]
+        for conf, draw, recorded in cases:
+            metrics.registry.clear()
+            with self.subTest(conf=conf, draw=draw), self.settings(CHAT_METRICS=conf), mock.patch.object(
+                metrics, "random", types.SimpleNamespace(random=lambda: draw)
+            ):
+                self.client.get(url)
+                self.assertEqual(len(metrics.registry._views), recorded)
+
+    def test_render(self):
+        registry = metrics.Registry()
+        sample = metrics.Sample()
+        sample.queries, sample.query_seconds = 3, 0.5
+        registry.record("api_sync", 200, 0.02, sample, 100)
+        registry.record("api_sync", 429, 2.0, metrics.Sample(), None)
+        registry.cache("membership", True)
+        registry.cache("membership", False)
+        registry.cache("membership", True)
+        lines = registry.render().splitlines()
+        for line in [
+            "chat_metrics_sample_rate 1.0",
+            "# TYPE chat_request_duration_seconds histogram",
+            'chat_request_duration_seconds_bucket{view="api_sync",le="0.01"} 0',
+            'chat_request_duration_seconds_bucket{view="api_sync",le="0.025"} 1',
+            'chat_request_duration_seconds_bucket{view="api_sync",le="2.5"} 2',
+            'chat_request_duration_seconds_bucket{view="api_sync",le="+Inf"} 2',
+            'chat_request_duration_seconds_sum{view="api_sync"} 2.02',
+            'chat_request_queries_bucket{view="api_sync",le="0"} 1',
+            'chat_request_queries_bucket{view="api_sync",le="3"} 2',
+            'chat_requests_total{view="api_sync",status="200"} 1',
+            'chat_requests_total{view="api_sync",status="429"} 1',
+            'chat_query_seconds_total{view="api_sync"} 0.5',
+            'chat_response_bytes_total{view="api_sync"} 100',
+            'chat_cache_requests_total{cache="membership",result="hit"} 2',
+            'chat_cache_requests_total{cache="membership",result="miss"} 1',
+        ]:
+            self.assertIn(line, lines)
+
+    def test_export_access(self):
+        url = reverse("metrics")
+        self.assertEqual(Client().get(url).status_code, 403)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(Client(HTTP_AUTHORIZATION="Bearer autre").get(url).status_code, 403)
+        self.assertEqual(self.client.post(url).status_code, 405)
+        self.export(HTTP_AUTHORIZATION="Bearer secret")
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        # sans jeton configuré, seul le staff y accède
+        with self.settings(CHAT_METRICS={"TOKEN": None}):
+            self.assertEqual(Client(HTTP_AUTHORIZATION="Bearer None").get(url).status_code, 403)
+
+
+@override_settings(CHAT_RATELIMIT={})
+class SyncTests(TestCase):
+    """api_sync: messages si demandés, état seulement s'il a changé, typing des autres."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.other = User.objects.create_user("bob")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        cls.membership = Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+        cls.other_membership = Membership.objects.create(user=cls.other, room=cls.room, role=Membership.MEMBER)
+        cls.message = Message.objects.create(room=cls.room, author=cls.other, content="bonjour")
+
+    def setUp(self):
+        cache.clear()
+        recent.store.clear()
+        self.client.force_login(self.user)
+        self.url = reverse("api_sync", args=[self.room.id])
+        for username in ("alice", "bob"):
+            self.addCleanup(presence.clear, self.room.id, username)
+
+    def sync(self, **params) -> dict:
+        return self.client.get(self.url, params).json()
+
+    def test_messages_only_when_asked(self):
+        data = self.sync(after=0, seq=0)
+        self.assertEqual([m["content"] for m in data["messages"]], ["bonjour"])
+        self.assertIn("deleted_ids", data)
+        self.assertEqual(self.sync(after=self.message.id, seq=0)["messages"], [])
+
+        version = data["state_version"]
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.sync(messages=0, after=0, state_version=version)
+        self.assertFalse({"messages", "deleted_ids", "seq"} & set(data))
+        self.assertFalse([q for q in ctx.captured_queries if "chat_message" in q["sql"]])
+
+    def test_state_only_when_changed(self):
+        data = self.sync(messages=0)
+        self.assertEqual({m["username"] for m in data["state"]["members"]}, {"alice", "bob"})
+        version = data["state_version"]
+        self.assertNotIn("state", self.sync(messages=0, state_version=version))
+
+        carol = User.objects.create_user("carol")
+        services.member_changed(Membership.objects.create(user=carol, room=self.room))
+        data = self.sync(messages=0, state_version=version)
+        self.assertEqual(data["state_version"], version + 1)
+        self.assertTrue(data["state"]["delta"])
+        self.assertEqual([m["username"] for m in data["state"]["members"]], ["carol"])
+
+    def test_typing_of_others(self):
+        self.assertEqual(self.sync(messages=0)["typing"], [])
+        services.mark_typing(self.membership, self.room.id, "alice")
+        # sa propre frappe n'est jamais renvoyée
+        self.assertEqual(self.sync(messages=0)["typing"], [])
+        services.mark_typing(self.other_membership, self.room.id, "bob")
+        data = self.sync(messages=0)
+        self.assertEqual(data["typing"], ["bob"])
+        self.assertEqual(data["next_poll_ms"], services.POLL_INTERVAL_ACTIVE)
+
+
+@override_settings(CHAT_RATELIMIT={})
+class RoomListETagTests(TestCase):
+    """api_room_list: 304 sur ETag identique, nouvel ETag à chaque changement de la liste."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        cls.membership = Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        self.url = reverse("api_room_list")
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"rooms-autre"').status_code, 200)
+
+    def test_etag_changes_with_room_list(self):
+        etag = self.client.get(self.url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            room = Room.objects.create(name="nouveau", created_by=self.user)
+            services.room_changed(room.id)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("nouveau", [r["name"] for r in response.json()["rooms"]])
+
+        # un message change l'aperçu du salon, donc la liste
+        etag = response["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            services.send_message(self.user, self.room, self.membership, "dernier")
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        general = next(r for r in response.json()["rooms"] if r["id"] == self.room.id)
+        self.assertEqual(general["last_message_content"], "dernier")
+
+
+@override_settings(CHAT_RATELIMIT={})
+class NonMemberTests(TestCase):
+    """Les endpoints d'API refusent un non-membre sans lui créer d'adhésion (seul room_detail en crée)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user("owner")
+        cls.stranger = User.objects.create_user("stranger")
+        cls.room = Room.objects.create(name="general", created_by=cls.owner)
+        Membership.objects.create(user=cls.owner, room=cls.room, role=Membership.OWNER)
+        cls.message = Message.objects.create(room=cls.room, author=cls.owner, content="bonjour")
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.stranger)
+
+    def test_api_forbidden_without_side_effect(self):
+        room, owner = self.room.id, self.owner.id
+        calls = [
+            ("get", "api_room_state", [room], {}),
+            ("get", "api_messages", [room], {"after": 0}),
+            ("get", "api_messages", [room], {"after": 0, "wait": 1}),
+            ("get", "api_history", [room], {}),
+            ("get", "api_room_search", [room], {"q": "bonjour"}),
+            ("get", "api_sync", [room], {}),
+            ("get", "api_typing", [room], {}),
+            ("post", "api_typing", [room], {}),
+            ("post", "api_send_message", [room], {"content": "intrus"}),
+            ("post", "api_delete_message", [room, self.message.id], {}),
+            ("post", "ban_user", [room, owner], {}),
+            ("post", "unban_user", [room, owner], {}),
+            ("post", "set_moderator", [room, owner], {}),
+            ("post", "unset_moderator", [room, owner], {}),
+        ]
+        for method, name, args, data in calls:
+            with self.subTest(method=method, view=name):
+                response = getattr(self.client, method)(reverse(name, args=args), data)
+                self.assertEqual(response.status_code, 403)
+        self.assertFalse(Membership.objects.filter(user=self.stranger).exists())
+        self.assertEqual(list(Message.objects.values_list("content", flat=True)), ["bonjour"])
+        self.assertFalse(Message.objects.get().is_deleted)
+
+    async def test_stream_forbidden(self):
+        await self.async_client.aforce_login(self.stranger)
+        response = await self.async_client.get(reverse("api_messages_stream", args=[self.room.id]))
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(await Membership.objects.filter(user=self.stranger).aexists())
+
+    def test_room_detail_joins(self):
+        self.client.get(reverse("room_detail", args=[self.room.id]))
+        self.assertEqual(Membership.objects.get(user=self.stranger).role, Membership.MEMBER)
+        self.assertEqual(self.client.get(reverse("api_sync", args=[self.room.id])).status_code, 200)
+
+
+class RoomDeleteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user("owner")
+        cls.room = Room.objects.create(name="general", created_by=cls.owner)
+        Membership.objects.create(user=cls.owner, room=cls.room, role=Membership.OWNER)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.owner)
+
+    def test_list_version_bumped_after_delete(self):
+        seen = []
+        bump = services._bump_room_list_version
+
+        def check_then_bump():
+            seen.append(Room.objects.filter(id=self.room.id).exists())
+            bump()
+
+        self.assertEqual(len(self.client.get(reverse("api_room_list")).json()["rooms"]), 1)
+        with mock.patch.object(services, "_bump_room_list_version", check_then_bump):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("room_delete", args=[self.room.id]))
+        self.assertEqual(seen, [False])
+        self.assertEqual(self.client.get(reverse("api_room_list")).json()["rooms"], [])
+
+
+class DeleteMessageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        cls.membership = Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+
+    def setUp(self):
+        self.msg = services.send_message(self.user, self.room, self.membership, "bonjour")
+
+    def test_delete_records_change(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            services.delete_message(self.user, self.membership, self.msg)
+        self.assertTrue(callbacks)
+        change = MessageChange.objects.get(message=self.msg)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.change_seq, change.id)
+        self.assertTrue(Message.objects.get(id=self.msg.id).is_deleted)
+        self.assertEqual(services.changes_after(self.room.id, 0), ([self.msg.id], change.id))
+
+    def test_failed_write_leaves_nothing_half_done(self):
+        seq = Room.objects.get(id=self.room.id).change_seq
+        with mock.patch.object(MessageChange.objects, "create", side_effect=DatabaseError("disque plein")):
+            with self.captureOnCommitCallbacks() as callbacks, self.assertRaises(DatabaseError):
+                services.delete_message(self.user, self.membership, self.msg)
+        self.assertEqual(callbacks, [])
+        self.assertFalse(Message.objects.get(id=self.msg.id).is_deleted)
+        self.assertEqual(Room.objects.get(id=self.room.id).change_seq, seq)
+
+
+@unittest.skipUnless(search.is_available(), "index FTS5 propre à SQLite")
+@override_settings(CHAT_RATELIMIT={})
+class SearchIndexTests(TestCase):
+    """Triggers de l'index FTS5 (migration 0009), reconstruction et droits de la recherche."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+
+    def setUp(self):
+        cache.clear()
+
+    def indexed(self, term: str) -> set:
+        with connection.cursor() as c:
+            c.execute(f"SELECT rowid FROM {search.FTS_TABLE} WHERE {search.FTS_TABLE} MATCH %s", [term])
+            return {row[0] for row in c.fetchall()}
+
+    def set_watermark(self, value: int) -> None:
+        with connection.cursor() as c:
+            c.execute(f"UPDATE {search.FTS_TABLE}_state SET watermark = %s", [value])
+
+    def post(self, content: str) -> Message:
+        return Message.objects.create(room=self.room, author=self.user, content=content)
+
+    def test_insert_indexed_system_message_not(self):
+        msg = self.post("pomme rouge")
+        services.post_system_message(self.room, self.user, "pomme système")
+        self.assertEqual(self.indexed("pomme"), {msg.id})
+
+    def test_soft_delete_leaves_index(self):
+        msg = self.post("pomme rouge")
+        services.delete_message(self.user, Membership.objects.get(user=self.user, room=self.room), msg)
+        self.assertEqual(self.indexed("pomme"), set())
+
+    def test_content_edit_reindexed(self):
+        msg = self.post("pomme rouge")
+        msg.content = "poire verte"
+        msg.save(update_fields=["content"])
+        self.assertEqual(self.indexed("pomme"), set())
+        self.assertEqual(self.indexed("poire"), {msg.id})
+
+    def test_triggers_skip_ids_above_watermark(self):
+        below = self.post("pomme avant")
+        self.set_watermark(below.id)
+        above = self.post("pomme après")
+        self.assertEqual(self.indexed("pomme"), {below.id})
+        # suppression d'une ligne jamais indexée: pas de 'delete' FTS5 qui corromprait l'index
+        above.is_deleted = True
+        above.save(update_fields=["is_deleted"])
+        below.content = "poire avant"
+        below.save(update_fields=["content"])
+        self.assertEqual(self.indexed("pomme"), set())
+        self.assertEqual(self.indexed("poire"), {below.id})
+
+    def test_rebuild_with_concurrent_writes(self):
+        msgs = [self.post(f"pomme {i}") for i in range(20)]
+        batches = []
+
+        def progress(done, total, indexed):
+            batches.append(done)
+            if len(batches) == 1:
+                # pendant la reconstruction: une ligne déjà indexée, une au-delà du watermark
+                for m in (msgs[1], msgs[15]):
+                    m.is_deleted = True
+                    m.save(update_fields=["is_deleted"])
+                self.post("pomme nouvelle")
+
+        search.rebuild_index(batch_size=5, progress=progress)
+        self.assertGreater(len(batches), 1)
+        expected = {m.id for m in msgs} - {msgs[1].id, msgs[15].id}
+        new = Message.objects.get(content="pomme nouvelle")
+        self.assertEqual(self.indexed("pomme"), expected | {new.id})
+        # fin de reconstruction: les triggers couvrent de nouveau tous les ids
+        after = self.post("pomme ensuite")
+        self.assertIn(after.id, self.indexed("pomme"))
+
+    def test_search_permissions_across_rooms(self):
+        other = User.objects.create_user("bob")
+        private = Room.objects.create(name="privé", created_by=other)
+        Membership.objects.create(user=other, room=private, role=Membership.OWNER)
+        banned = Room.objects.create(name="banni", created_by=other)
+        Membership.objects.create(user=self.user, room=banned, role=Membership.BANNED)
+        mine = self.post("pomme à moi")
+        Message.objects.create(room=private, author=other, content="pomme privée")
+        Message.objects.create(room=banned, author=other, content="pomme bannie")
+
+        self.client.force_login(self.user)
+        results = self.client.get(reverse("api_search"), {"q": "pomme"}).json()["results"]
+        self.assertEqual([r["id"] for r in results], [mine.id])
+        for room in (private, banned):
+            response = self.client.get(reverse("api_room_search", args=[room.id]), {"q": "pomme"})
+            self.assertEqual(response.status_code, 403)
+
+
+@override_settings(CHAT_RATELIMIT={}, CHAT_RECENT={"ENABLED": True, "PER_ROOM": 5, "MAX_BYTES": 1024 * 1024})
+class RecentBufferTests(TestCase):
+    """Le poll et le chargement de room_detail servis par le tampon doivent rester identiques à la base."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.other = User.objects.create_user("bob")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        cls.membership = Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+        Membership.objects.create(user=cls.other, room=cls.room, role=Membership.MEMBER)
+
+    def setUp(self):
+        cache.clear()
+        recent.store.clear()
+        self.addCleanup(recent.store.clear)
+        self.client.force_login(self.user)
+        for i in range(3):
+            self.send(f"message {i}")
+
+    def send(self, content: str) -> Message:
+        # callbacks exécutés: le tampon est alimenté comme après un vrai commit
+        with self.captureOnCommitCallbacks(execute=True):
+            return services.send_message(self.user, Room.objects.get(id=self.room.id), self.membership, content)
+
+    def send_elsewhere(self, content: str) -> Message:
+        # écrit par un autre processus: la base bouge, pas le tampon de celui-ci
+        with self.captureOnCommitCallbacks(execute=False):
+            return services.send_message(self.other, Room.objects.get(id=self.room.id), self.membership, content)
+
+    def delete(self, msg: Message, elsewhere: bool = False) -> None:
+        with self.captureOnCommitCallbacks(execute=not elsewhere):
+            services.delete_message(self.user, self.membership, msg)
+
+    def assertPollMatchesDb(self, after: int = 0):
+        response = self.client.get(reverse("api_messages", args=[self.room.id]), {"after": after, "seq": 0})
+        expected = [
+            serialize_message(m, Membership.OWNER, self.user.id)
+            for m in Message.objects.filter(room=self.room, id__gt=after).select_related("author").order_by("id")
+        ]
+        self.assertEqual(response.json()["messages"], expected)
+
+    def assertRoomLoadMatchesDb(self):
+        from .views import HISTORY_PAGE_SIZE
+
+        response = self.client.get(reverse("room_detail", args=[self.room.id]))
+        rows = list(Message.objects.filter(room=self.room).select_related("author").order_by("-id"))
+        expected = [(m.id, "[message supprimé]" if m.is_deleted else m.content) for m in reversed(rows[:HISTORY_PAGE_SIZE])]
+        got = [(m["id"], m["content"]) for m in response.context["chat_messages"]]
+        self.assertEqual(got, expected)
+        self.assertEqual(response.context["has_older"], len(rows) > HISTORY_PAGE_SIZE)
+
+    def test_warm_buffer_after_insert(self):
+        self.assertPollMatchesDb()
+        last = self.send("nouveau")
+        self.assertPollMatchesDb()
+        self.assertPollMatchesDb(after=last.id - 1)
+        self.assertRoomLoadMatchesDb()
+
+    def test_insert_from_another_process(self):
+        self.assertPollMatchesDb()
+        self.send_elsewhere("d'ailleurs")
+        self.send("d'ici")
+        self.assertPollMatchesDb()
+        self.assertRoomLoadMatchesDb()
+
+    def test_soft_delete(self):
+        msgs = list(Message.objects.filter(room=self.room).order_by("id"))
+        self.assertPollMatchesDb()
+        self.delete(msgs[0])
+        self.delete(msgs[1], elsewhere=True)
+        self.assertPollMatchesDb()
+        self.assertRoomLoadMatchesDb()
+
+    def test_eviction_beyond_capacity(self):
+        self.assertPollMatchesDb()
+        for i in range(8):
+            self.send(f"suite {i}")
+        first = Message.objects.filter(room=self.room).order_by("id").first()
+        # plus ancien que le tampon (5 messages): la base répond
+        self.assertPollMatchesDb(after=first.id)
+        self.assertPollMatchesDb(after=first.id + 8)
+        self.assertRoomLoadMatchesDb()
+
+    def test_falling_too_far_behind_reloads(self):
+        self.assertPollMatchesDb()
+        for i in range(7):
+            self.send_elsewhere(f"d'ailleurs {i}")
+        self.assertPollMatchesDb()
+        self.assertRoomLoadMatchesDb()
+
+    def test_cold_buffer(self):
+        recent.store.clear()
+        self.assertRoomLoadMatchesDb()
+        recent.store.clear()
+        self.assertPollMatchesDb()
+
+    def test_disabled(self):
+        with override_settings(CHAT_RECENT={"ENABLED": False}):
+            self.send("sans tampon")
+            self.assertPollMatchesDb()
+            self.assertRoomLoadMatchesDb()
+            self.assertIsNone(recent.store.cursor(self.room.id, self.room.created_at))
+
+
+LIMITED = {"RATES": {"send": (0.5, 2), "typing": (1, 1)}, "ROOMS": {}}
+
+
+class FrozenBackend(ratelimit.InMemoryBackend):
+    """Seaux en mémoire à horloge fixe (`now`), avancée à la main par les tests."""
+
+    now = 100.0
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        return super().take(key, rate, burst, self.now)
+
+
+class RateLimitTests(TestCase):
+    """Seaux à jetons: recharge, surcharges par salon, 429 + Retry-After."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice")
+        cls.room = Room.objects.create(name="general", created_by=cls.user)
+        Membership.objects.create(user=cls.user, room=cls.room, role=Membership.OWNER)
+
+    def setUp(self):
+        cache.clear()
+        # un magasin neuf par test: les seaux ne fuient pas d'un test à l'autre
+        self.store = FrozenBackend({})
+        patcher = mock.patch.object(ratelimit._store, "instance", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def test_bucket_refill(self):
+        backend = ratelimit.InMemoryBackend({})
+        # rafale de 2, puis un jeton toutes les 2 s
+        self.assertEqual(backend.take("k", 0.5, 2, now=100.0), 0)
+        self.assertEqual(backend.take("k", 0.5, 2, now=100.0), 0)
+        self.assertAlmostEqual(backend.take("k", 0.5, 2, now=100.0), 2.0)
+        self.assertAlmostEqual(backend.take("k", 0.5, 2, now=101.0), 1.0)
+        self.assertEqual(backend.take("k", 0.5, 2, now=102.0), 0)
+        self.assertAlmostEqual(backend.take("k", 0.5, 2, now=102.0), 2.0)
+        # une longue pause ne remplit pas au-delà de la rafale
+        self.assertEqual(backend.take("k", 0.5, 2, now=1000.0), 0)
+        self.assertEqual(backend.take("k", 0.5, 2, now=1000.0), 0)
+        self.assertGreater(backend.take("k", 0.5, 2, now=1000.0), 0)
+        # les clés sont indépendantes
+        self.assertEqual(backend.take("autre", 0.5, 2, now=1000.0), 0)
+
+    def test_rate_for_overrides(self):
+        rates = {"RATES": {"send": (1, 5), "typing": (2, 2)}, "ROOMS": {7: {"send": (10, 20), "poll": None}}}
+        with self.settings(CHAT_RATELIMIT=rates):
+            self.assertEqual(ratelimit.rate_for("send"), (1, 5))
+            self.assertEqual(ratelimit.rate_for("send", 3), (1, 5))
+            self.assertEqual(ratelimit.rate_for("send", 7), (10, 20))
+            # ce qui n'est pas surchargé retombe sur RATES
+            self.assertEqual(ratelimit.rate_for("typing", 7), (2, 2))
+            self.assertIsNone(ratelimit.rate_for("poll", 7))
+            self.assertIsNone(ratelimit.rate_for("inconnu"))
+        with self.settings(CHAT_RATELIMIT={}):
+            self.assertIsNone(ratelimit.rate_for("send"))
+
+    def test_scopes_and_rooms_are_separate_buckets(self):
+        with self.settings(CHAT_RATELIMIT=LIMITED):
+            ratelimit.hit("send", self.user.id, self.room.id)
+            ratelimit.hit("send", self.user.id, self.room.id)
+            with self.assertRaises(ratelimit.RateLimited) as cm:
+                ratelimit.hit("send", self.user.id, self.room.id)
+            self.assertEqual(cm.exception.scope, "send")
+            self.assertAlmostEqual(cm.exception.retry_after, 2.0)
+            ratelimit.hit("typing", self.user.id, self.room.id)
+            ratelimit.hit("send", self.user.id, self.room.id + 1)
+            ratelimit.hit("send", self.user.id + 1, self.room.id)
+
+    def test_send_returns_429_with_retry_after(self):
+        url = reverse("api_send_message", args=[self.room.id])
+        with self.settings(CHAT_RATELIMIT=LIMITED):
+            for i in range(2):
+                self.assertEqual(self.client.post(url, {"content": f"m{i}"}).status_code, 200)
+            response = self.client.post(url, {"content": "de trop"})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response["Retry-After"], "2")
+            self.assertEqual(response.json(), {"error": "rate_limited", "retry_after": 2.0})
+            self.assertFalse(Message.objects.filter(content="de trop").exists())
+            # le jeton revient après le délai annoncé
+            self.store.now += 2
+            self.assertEqual(self.client.post(url, {"content": "plus tard"}).status_code, 200)
+
+    def test_long_poll_has_its_own_bucket(self):
+        rates = {"RATES": {"poll": (0.5, 2), "longpoll": (0.5, 3)}}
+        Message.objects.create(room=self.room, author=self.user, content="déjà là")
+        sync = reverse("api_sync", args=[self.room.id])
+        messages = reverse("api_messages", args=[self.room.id])
+        with self.settings(CHAT_RATELIMIT=rates):
+            self.assertEqual([self.client.get(sync).status_code for _ in range(3)], [200, 200, 429])
+            # un message est déjà là: chaque long-poll répond sans attendre
+            codes = [self.client.get(messages, {"after": 0, "wait": 5}).status_code for _ in range(4)]
+            self.assertEqual(codes, [200, 200, 200, 429])
+            self.assertEqual(self.client.get(messages, {"after": 0}).status_code, 429)
+
+    def test_room_override_applies_to_view(self):
+        rates = dict(LIMITED, ROOMS={self.room.id: {"send": (0.5, 1)}})
+        url = reverse("api_send_message", args=[self.room.id])
+        with self.settings(CHAT_RATELIMIT=rates):
+            self.assertEqual(self.client.post(url, {"content": "un"}).status_code, 200)
+            self.assertEqual(self.client.post(url, {"content": "deux"}).status_code, 429)
+
+
+class PollIntervalTests(unittest.TestCase):
+    """Délai de poll conseillé selon l'ancienneté du dernier message et la frappe en cours."""
+
+    def test_backoff(self):
+        now = timezone.now()
+        cases = [
+            (None, False, services.POLL_INTERVAL_IDLE),
+            (None, True, services.POLL_INTERVAL_ACTIVE),
+            (now, False, services.POLL_INTERVAL_ACTIVE),
+            (now - timedelta(seconds=services.ACTIVE_WINDOW - 5), False, services.POLL_INTERVAL_ACTIVE),
+            (now - timedelta(seconds=services.ACTIVE_WINDOW + 5), False, services.POLL_INTERVAL_RECENT),
+            (now - timedelta(seconds=services.RECENT_WINDOW - 5), False, services.POLL_INTERVAL_RECENT),
+            (now - timedelta(seconds=services.RECENT_WINDOW + 5), False, services.POLL_INTERVAL_IDLE),
+            (now - timedelta(days=30), False, services.POLL_INTERVAL_IDLE),
+            # quelqu'un écrit: court même dans un salon inactif
+            (now - timedelta(days=30), True, services.POLL_INTERVAL_ACTIVE),
+        ]
+        for last_activity, typing, expected in cases:
+            with self.subTest(last_activity=last_activity, typing=typing):
+                self.assertEqual(services.poll_interval(last_activity, typing), expected)
+        self.assertLess(services.POLL_INTERVAL_ACTIVE, services.POLL_INTERVAL_RECENT)
+        self.assertLess(services.POLL_INTERVAL_RECENT, services.POLL_INTERVAL_IDLE)
+
+
+class PubSubTests(unittest.TestCase):
+    """File bornée des abonnés (débordement -> resynchronisation) et relais SQLite entre processus."""
+
+    def event(self, n: int) -> dict:
+        return {"type": "message", "n": n}
+
+    def drain(self, sub) -> list:
+        events = []
+        while (event := sub.get(timeout=0)) is not None:
+            events.append(event["n"])
+        return events
+
+    def test_overflow_marks_for_resync(self):
+        bus = pubsub.Bus()
+        small = bus.subscribe("room:1", maxsize=3)
+        large = bus.subscribe("room:1", maxsize=10)
+        self.assertFalse(small.take_overflow())
+        for n in range(5):
+            bus.publish("room:1", self.event(n))
+        # les plus anciens sont jetés, le débordement n'est signalé qu'une fois
+        self.assertTrue(small.take_overflow())
+        self.assertFalse(small.take_overflow())
+        self.assertEqual(self.drain(small), [2, 3, 4])
+        self.assertFalse(large.take_overflow())
+        self.assertEqual(self.drain(large), [0, 1, 2, 3, 4])
+
+    def test_overflow_async(self):
+        bus = pubsub.Bus()
+
+        async def run():
+            with bus.subscribe("room:1", maxsize=2) as sub:
+                for n in range(3):
+                    bus.publish("room:1", self.event(n))
+                first = await sub.aget(timeout=1)
+                return sub.take_overflow(), first["n"], await sub.aget(timeout=0.01), await sub.aget(timeout=0.01)
+
+        overflowed, first, second, empty = async_to_sync(run)()
+        self.assertTrue(overflowed)
+        self.assertEqual((first, second["n"], empty), (1, 2, None))
+        self.assertFalse(bus.has_subscribers())
+
+    def test_sqlite_backend_across_connections(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        # deux bus sur le même fichier: deux processus, chacun sa connexion et son origine
+        options = {"PATH": f"{tmpdir.name}/bus.sqlite3", "POLL_INTERVAL": 0.01}
+        sender = pubsub.Bus("chat.pubsub.SQLiteBackend", options)
+        receiver = pubsub.Bus("chat.pubsub.SQLiteBackend", options)
+        sender.publish("room:1", self.event(-1))  # avant l'abonnement: pas rejoué
+
+        local = sender.subscribe("room:1")
+        remote = receiver.subscribe("room:1")
+        other_room = receiver.subscribe("room:2")
+        time.sleep(0.05)
+        sender.publish("room:1", self.event(1))
+        received = remote.get(timeout=2)
+        self.assertEqual((received["n"], received["channel"]), (1, "room:1"))
+        self.assertEqual(local.get(timeout=0)["n"], 1)
+        time.sleep(0.1)
+        # l'émetteur ne se relit pas lui-même, l'autre salon ne reçoit rien
+        self.assertEqual(self.drain(local), [])
+        self.assertEqual(self.drain(remote), [])
+        self.assertEqual(self.drain(other_room), [])
+        for sub in (local, remote, other_room):
+            sub.close()
+
+
+class PresenceBackendTests(unittest.TestCase):
+    """clear() ne renvoie True que si l'utilisateur était encore affiché comme en train d'écrire."""
+
+    def backends(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        return [presence.InMemoryBackend({}), presence.SQLiteBackend({"PATH": f"{tmpdir.name}/presence.sqlite3"})]
+
+    def test_clear(self):
+        now = time.time()
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                backend.touch(1, "alice", now + 60)
+                backend.touch(1, "bob", now - 1)
+                self.assertTrue(backend.clear(1, "alice"))
+                self.assertFalse(backend.clear(1, "alice"))
+                # expiré: plus affiché, donc rien à annoncer
+                self.assertFalse(backend.clear(1, "bob"))
+                self.assertFalse(backend.clear(1, "inconnu"))
+                self.assertFalse(backend.clear(2, "alice"))
+                self.assertEqual(backend.active(1, now), {})
+
+
+class SocketClient:
+    """Client de test de l'application WebSocket brute (chat.consumers)."""
+
+    def __init__(self, room_id: int, session_key: str):
+        self.scope = {
+            "type": "websocket",
+            "path": f"/ws/rooms/{room_id}/",
+            "headers": [(b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_key}".encode())],
+        }
+        self.inbox = asyncio.Queue()
+        self.outbox = asyncio.Queue()
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(websocket_application(self.scope, self.inbox.get, self.outbox.put))
+        await self.inbox.put({"type": "websocket.connect"})
+        accepted = await self.receive()
+        assert accepted["type"] == "websocket.accept", accepted
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.inbox.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.task, 5)
+
+    async def receive(self, timeout: float = 5) -> dict:
+        return await asyncio.wait_for(self.outbox.get(), timeout)
+
+    async def send_text(self, text: str) -> None:
+        await self.inbox.put({"type": "websocket.receive", "text": text})
+
+    async def receive_json(self, kind: str = None, timeout: float = 5) -> dict:
+        """Prochaine trame JSON (de type `kind` si donné, les autres sont ignorées)."""
+        while True:
+            event = await self.receive(timeout)
+            assert event["type"] == "websocket.send", event
+            frame = json.loads(event["text"])
+            if kind is None or frame["type"] == kind:
+                return frame
+
+
+# les sockets ferment leurs connexions DB (close_old_connections): pas de TestCase
+@override_settings(CHAT_RATELIMIT={})
+class RoomSocketTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("alice")
+        self.room = Room.objects.create(name="general", created_by=self.user)
+        Membership.objects.create(user=self.user, room=self.room, role=Membership.OWNER)
+        self.client.force_login(self.user)
+        self.session_key = self.client.session.session_key
+
+    def socket(self) -> SocketClient:
+        return SocketClient(self.room.id, self.session_key)
+
+    async def test_malformed_frames(self):
+        frames = [
+            "pas du json",
+            "[1, 2]",
+            "null",
+            '{"content": "sans type"}',
+            '{"type": "delete", "id": [1]}',
+            '{"type": "delete", "id": {"a": 1}}',
+            '{"type": "delete", "id": "abc"}',
+            '{"type": "delete", "id": 99999999999999999999999}',
+            '{"type": "resume", "after": [1]}',
+            '{"type": "resume", "seq": 1.5e400}',
+            '{"type": "send", "content": ["x"]}',
+            '{"type": "inconnu"}',
+        ]
+        async with self.socket() as ws:
+            await ws.receive_json("state")
+            for text in frames:
+                await ws.send_text(text)
+                self.assertEqual(await ws.receive_json("error"), {"type": "error", "error": "bad_frame"}, text)
+            # la socket est toujours vivante
+            await ws.send_text(json.dumps({"type": "send", "content": "toujours là"}))
+            frame = await ws.receive_json("message")
+            self.assertEqual(frame["message"]["content"], "toujours là")
+
+    async def test_resume_past_one_page(self):
+        backlog = services.MESSAGES_PAGE_SIZE + 100
+        await Message.objects.abulk_create(
+            Message(room=self.room, author=self.user, content=f"m{i}") for i in range(backlog)
+        )
+        ids = [i async for i in Message.objects.filter(room=self.room).order_by("id").values_list("id", flat=True)]
+        async with self.socket() as ws:
+            await ws.receive_json("state")
+            await ws.send_text(json.dumps({"type": "resume", "after": 0, "seq": 0}))
+            # envoyé pendant la reprise: arrive après tout l'arriéré, sans trou
+            await ws.send_text(json.dumps({"type": "send", "content": "en direct"}))
+            received = [(await ws.receive_json("message"))["message"]["id"] for _ in range(backlog + 1)]
+        self.assertEqual(received, ids + [ids[-1] + 1])
+
+    async def test_resume_past_one_batch_of_changes(self):
+        msg = await Message.objects.acreate(room=self.room, author=self.user, content="x")
+        await MessageChange.objects.abulk_create(
+            MessageChange(room=self.room, message=msg, kind=MessageChange.DELETE) for _ in range(3)
+        )
+        seqs = [i async for i in MessageChange.objects.order_by("id").values_list("id", flat=True)]
+        with mock.patch.object(services, "CHANGES_BATCH", 2):
+            async with self.socket() as ws:
+                await ws.receive_json("state")
+                await ws.send_text(json.dumps({"type": "resume", "after": msg.id, "seq": 0}))
+                received = [(await ws.receive_json("delete"))["seq"] for _ in range(2)]
+        self.assertEqual(received, [seqs[1], seqs[2]])
+
+    async def test_rate_limited_frame(self):
+        with mock.patch.object(ratelimit._store, "instance", FrozenBackend({})), self.settings(CHAT_RATELIMIT=LIMITED):
+            async with self.socket() as ws:
+                await ws.receive_json("state")
+                for i in range(2):
+                    await ws.send_text(json.dumps({"type": "send", "content": f"m{i}"}))
+                    await ws.receive_json("message")
+                await ws.send_text(json.dumps({"type": "send", "content": "de trop"}))
+                self.assertEqual(
+                    await ws.receive_json("error"),
+                    {"type": "error", "error": "rate_limited", "scope": "send", "retry_after": 2.0},
+                )
+                await ws.send_text(json.dumps({"type": "typing"}))
+                await ws.send_text(json.dumps({"type": "typing"}))
+                frame = await ws.receive_json("error")
+                self.assertEqual((frame["error"], frame["scope"]), ("rate_limited", "typing"))
+        self.assertFalse(await Message.objects.filter(content="de trop").aexists())
+
+
+# la thread d'écriture a sa propre connexion: elle doit voir les lignes du test
+@override_settings(CHAT_RATELIMIT={}, CHAT_DB={"BATCH_WRITES": True})
+class GroupCommitTests(TransactionTestCase):
+    SENDERS = 8
+    PER_SENDER = 10
+
+    def setUp(self):
+        cache.clear()
+        recent.store.clear()
+        self.room = Room.objects.create(name="general", created_by=User.objects.create_user("alice"))
+        self.users = [User.objects.create_user(f"u{i}") for i in range(self.SENDERS)]
+        self.memberships = [
+            Membership.objects.create(user=u, room=self.room, role=Membership.MEMBER) for u in self.users
+        ]
+        # fenêtre large: les envois concurrents tombent dans les mêmes lots
+        self.writer = db.GroupCommitWriter(window=0.05, max_batch=100)
+        self.batches = []
+        commit = self.writer._commit
+
+        def record(batch):
+            self.batches.append(len(batch))
+            commit(batch)
+
+        patchers = [mock.patch.object(db, "_group_writer", self.writer), mock.patch.object(self.writer, "_commit", record)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_concurrent_sends(self):
+        start = threading.Barrier(self.SENDERS)
+        sent, errors = {}, []
+
+        def sender(i):
+            try:
+                start.wait()
+                sent[i] = [
+                    services.send_message(self.users[i], self.room, self.memberships[i], f"{i}-{n}").id
+                    for n in range(self.PER_SENDER)
+                ]
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=sender, args=(i,)) for i in range(self.SENDERS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEqual(errors, [])
+
+        rows = list(Message.objects.filter(room=self.room).order_by("id").values_list("id", "content"))
+        self.assertEqual(len(rows), self.SENDERS * self.PER_SENDER)
+        # chaque message une seule fois, avec l'id renvoyé à son expéditeur
+        by_content = dict((content, id_) for id_, content in rows)
+        self.assertEqual(len(by_content), len(rows))
+        for i, ids in sent.items():
+            self.assertEqual(ids, [by_content[f"{i}-{n}"] for n in range(self.PER_SENDER)])
+            # l'ordre d'envoi d'un même expéditeur est conservé
+            self.assertEqual(ids, sorted(ids))
+        self.assertGreater(max(self.batches), 1)
+        self.assertEqual(sum(self.batches), len(rows))
+
+        room = Room.objects.get(id=self.room.id)
+        last = Message.objects.select_related("author").get(id=rows[-1][0])
+        self.assertEqual(room.last_message_id, last.id)
+        self.assertEqual(room.last_message_content, last.content)
+        self.assertEqual(room.last_message_author, last.author.username)
+        self.assertEqual(room.last_message_created_at, last.created_at)
+        self.assertFalse(room.last_message_is_deleted)
+
+    def insert(self, content):
+        return lambda: Message.objects.create(room=self.room, author=self.users[0], content=content).id
+
+    def test_failed_write_only_fails_its_caller(self):
+        def broken():
+            Message.objects.create(room=self.room, author=self.users[0], content="annulé")
+            raise ValueError("boom")
+
+        futures = [Future() for _ in range(3)]
+        self.writer._commit(list(zip([self.insert("avant"), broken, self.insert("après")], futures)))
+
+        with self.assertRaisesMessage(ValueError, "boom"):
+            futures[1].result()
+        contents = dict(Message.objects.values_list("id", "content"))
+        self.assertEqual(contents, {futures[0].result(): "avant", futures[2].result(): "après"})
+
+    def test_failed_commit_fails_every_caller(self):
+        futures = [Future() for _ in range(3)]
+        batch = list(zip([self.insert(f"m{i}") for i in range(3)], futures))
+        with mock.patch.object(connection, "commit", side_effect=OperationalError("database is locked")):
+            self.writer._commit(batch)
+
+        for future in futures:
+            with self.assertRaisesMessage(OperationalError, "database is locked"):
+                future.result()
+        self.assertFalse(Message.objects.exists())
+        self.assertIsNone(Room.objects.get(id=self.room.id).last_message_id)
+
+    def test_submit_raises_in_caller(self):
+        with self.assertRaises(ChatError):
+            db.run_message_write(mock.Mock(side_effect=ChatError("empty")))
+        self.assertEqual(db.run_message_write(self.insert("ok")), Message.objects.get().id)
+
+
+# Requêtes SQL au plus par appel, caches vides (session et utilisateur compris).
+# Le nombre ne doit pas non plus varier avec le volume: cf. QueryBudgetTests.
+QUERY_BUDGETS = {
+    "room_list": 3,
+    "signup": 0,
+    "login": 0,
+    "room_create": 10,
+    "room_detail": 6,
+    "room_delete": 12,
+    "room_rename": 7,
+    "custom_logout": 4,
+    "metrics": 2,
+    "api_room_list": 3,
+    "api_search": 3,
+    "api_room_state": 5,
+    "api_messages": 5,
+    "api_messages_stream": 6,
+    "api_history": 5,
+    "api_room_search": 5,
+    "api_send_message": 9,
+    "api_typing": 4,
+    "api_sync": 6,
+    "api_delete_message": 11,
+    "ban_user": 16,
+    "unban_user": 16,
+    "set_moderator": 16,
+    "unset_moderator": 16,
+}
+
+
+@override_settings(CHAT_RATELIMIT={})
+class QueryBudgetTests(TestCase):
+    """
+    Chaque vue de chat/urls.py, appelée sur deux volumes de données (salons,
+    membres, messages): son nombre de requêtes tient dans QUERY_BUDGETS et
+    reste le même d'un volume à l'autre (pas de N+1).
+    """
+
+    SMALL = {"rooms": 2, "members": 3, "messages": 5}
+    LARGE = {"rooms": 6, "members": 12, "messages": 40}
+
+    def setUp(self):
+        cache.clear()
+        recent.store.clear()
+        # sans mot de passe: pas de hachage, force_login suffit
+        self.owner = User.objects.create_user("owner", is_staff=True)
+        self.members = []
+        self.rooms = []
+
+    def grow(self, rooms: int, members: int, messages: int) -> None:
+        """Complète le jeu de données jusqu'aux volumes demandés (par salon pour les messages)."""
+        while len(self.members) < members:
+            self.members.append(User.objects.create_user(f"member{len(self.members)}"))
+        while len(self.rooms) < rooms:
+            room = Room.objects.create(name=f"room{len(self.rooms)}", created_by=self.owner)
+            Membership.objects.create(user=self.owner, room=room, role=Membership.OWNER)
+            self.rooms.append(room)
+        for room in self.rooms:
+            joined = set(room.memberships.values_list("user_id", flat=True))
+            Membership.objects.bulk_create(
+                [Membership(user=u, room=room, role=Membership.MEMBER) for u in self.members if u.id not in joined]
+            )
+            count = room.messages.count()
+            Message.objects.bulk_create(
+                [
+                    Message(room=room, author=self.members[i % len(self.members)], content=f"bonjour {i}")
+                    for i in range(count, messages)
+                ]
+            )
+            last = room.messages.select_related("author").last()
+            Room.objects.filter(id=room.id).update(
+                last_message_id=last.id,
+                last_message_content=last.content,
+                last_message_author=last.author.username,
+                last_message_created_at=last.created_at,
+            )
+        self.rooms = [Room.objects.get(id=r.id) for r in self.rooms]
+
+    def calls(self) -> dict:
+        """Nom de route -> (méthode, url, données, préparation, connecté)."""
+        room = self.rooms[0]
+        target = self.members[0]
+        last_id = room.last_message_id
+        own = Message.objects.filter(room=room, author=self.owner).order_by("-id").first() or room.messages.last()
+
+        def with_role(role):
+            return lambda: Membership.objects.filter(user=target, room=room).update(role=role)
+
+        args = (room.id,)
+        member_args = (room.id, target.id)
+        return {
+            "room_list": ("get", reverse("room_list"), {}, None, True),
+            "signup": ("get", reverse("signup"), {}, None, False),
+            "login": ("get", reverse("login"), {}, None, False),
+            "room_create": ("post", reverse("room_create"), {"name": "nouveau"}, None, True),
+            "room_detail": ("get", reverse("room_detail", args=args), {}, None, True),
+            "room_delete": ("post", reverse("room_delete", args=args), {}, None, True),
+            "room_rename": ("post", reverse("room_rename", args=args), {"name": "renommé"}, None, True),
+            "custom_logout": ("post", reverse("custom_logout"), {}, None, True),
+            "metrics": ("get", reverse("metrics"), {}, None, True),
+            "api_room_list": ("get", reverse("api_room_list"), {}, None, True),
+            "api_search": ("get", reverse("api_search"), {"q": "bonjour"}, None, True),
+            "api_room_state": ("get", reverse("api_room_state", args=args), {}, None, True),
+            "api_messages": ("get", reverse("api_messages", args=args), {"after": last_id - 3}, None, True),
+            "api_messages_stream": (
+                "stream", reverse("api_messages_stream", args=args), {"after": last_id - 3}, None, True
+            ),
+            "api_history": ("get", reverse("api_history", args=args), {}, None, True),
+            "api_room_search": ("get", reverse("api_room_search", args=args), {"q": "bonjour"}, None, True),
+            "api_send_message": ("post", reverse("api_send_message", args=args), {"content": "salut"}, None, True),
+            "api_typing": ("get", reverse("api_typing", args=args), {}, None, True),
+            "api_sync": ("get", reverse("api_sync", args=args), {"after": last_id - 3, "seq": 0}, None, True),
+            "api_delete_message": (
+                "post", reverse("api_delete_message", args=(room.id, own.id)), {}, None, True
+            ),
+            "ban_user": ("post", reverse("ban_user", args=member_args), {}, None, True),
+            "unban_user": ("post", reverse("unban_user", args=member_args), {}, with_role(Membership.BANNED), True),
+            "set_moderator": ("post", reverse("set_moderator", args=member_args), {}, None, True),
+            "unset_moderator": ("post", reverse("unset_moderator", args=member_args), {}, with_role(Membership.MOD), True),
+        }
+
+    def count_queries(self, method: str, url: str, data: dict, prepare, logged_in: bool) -> int:
+        # chaque appel est annulé: les suivants partent du même état
+        with transaction.atomic():
+            client = AsyncClient() if method == "stream" else Client()
+            if logged_in:
+                client.force_login(self.owner)
+            if prepare is not None:
+                prepare()
+            cache.clear()
+            recent.store.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                if method == "stream":
+                    # en-tête "retry" puis premier message: le rattrapage a eu lieu
+                    response = async_to_sync(read_events)(client, url, data, 2)[0]
+                else:
+                    response = getattr(client, method)(url, data)
+            self.assertLess(response.status_code, 400, f"{url}: {response.status_code}")
+            transaction.set_rollback(True)
+        return len(ctx.captured_queries)
+
+    def measure(self) -> dict:
+        return {name: self.count_queries(*call) for name, call in self.calls().items()}
+
+    def test_every_route_has_a_budget(self):
+        self.assertEqual({p.name for p in urls.urlpatterns}, set(QUERY_BUDGETS))
+
+    def test_query_budgets(self):
+        for size in (self.SMALL, self.LARGE):
+            self.grow(**size)
+            for name, count in self.measure().items():
+                with self.subTest(view=name, **size):
+                    self.assertLessEqual(count, QUERY_BUDGETS[name])
+
+    def test_query_count_does_not_grow_with_data(self):
+        self.grow(**self.SMALL)
+        small = self.measure()
+        self.grow(**self.LARGE)
+        large = self.measure()
+        for name in small:
+            with self.subTest(view=name):
+                self.assertEqual(large[name], small[name])
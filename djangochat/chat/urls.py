@@ -10,13 +10,19 @@ urlpatterns = [
     path("rooms/<int:room_id>/delete/", views.room_delete, name="room_delete"),
     path("rooms/<int:room_id>/rename/", views.room_rename, name="room_rename"),
     path("logout/", views.custom_logout, name="custom_logout"),
+    path("metrics/", views.metrics_export, name="metrics"),
 
     # API JSON (AJAX)
     path("api/rooms/", views.api_room_list, name="api_room_list"),
+    path("api/search/", views.api_search, name="api_search"),
     path("api/rooms/<int:room_id>/state/", views.api_room_state, name="api_room_state"),
     path("api/rooms/<int:room_id>/messages/", views.api_messages, name="api_messages"),
+    path("api/rooms/<int:room_id>/messages/stream/", views.api_messages_stream, name="api_messages_stream"),
+    path("api/rooms/<int:room_id>/history/", views.api_history, name="api_history"),
+    path("api/rooms/<int:room_id>/search/", views.api_room_search, name="api_room_search"),
     path("api/rooms/<int:room_id>/send/", views.api_send_message, name="api_send_message"),
     path("api/rooms/<int:room_id>/typing/", views.api_typing, name="api_typing"),
+    path("api/rooms/<int:room_id>/sync/", views.api_sync, name="api_sync"),
 
     # modération basique (option)
     path("api/rooms/<int:room_id>/delete/<int:message_id>/", views.api_delete_message, name="api_delete_message"),
@@ -1,39 +1,57 @@
+from asgiref.sync import sync_to_async
 from django.contrib import messages as dj_messages
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponseForbidden
-from django.db.models import OuterRef, Subquery, Value, DateTimeField, Case, When, IntegerField
-from django.db.models.functions import Coalesce
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.db import transaction
+from django.db.models import F, Value, Case, When, IntegerField
 from django.shortcuts import get_object_or_404, redirect, render
-from django.views.decorators.http import require_GET, require_POST, require_http_methods
+from django.views.decorators.http import condition, require_GET, require_POST, require_http_methods
 from django.contrib.auth import logout
-from django.utils import timezone
-from django.utils.dateparse import parse_datetime
-from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.utils.crypto import constant_time_compare
+import json
 import time
+from datetime import datetime
 
 
 from .forms import SignupForm, RoomCreateForm, CustomAuthenticationForm
 from .models import Room, Message, Membership
+from .db import poll_reads
+from .pubsub import room_channel
+from .ratelimit import rate_limit
+from .services import ChatError, for_viewer, serialize_message
+from . import metrics, pubsub, recent, search, services, wire
+
 
+def _get_membership(request, room: Room):
+    # cache par requête (request._chat_memberships) puis cache partagé
+    memo = request.__dict__.setdefault("_chat_memberships", {})
+    return services.get_membership(request.user, room, memo)
 
-def _get_role(user, room: Room) -> str:
-    m = Membership.objects.filter(user=user, room=room).first()
+
+def _get_role(request, room: Room) -> str:
+    m = _get_membership(request, room)
     return m.role if m else ""
 
 
-def _ensure_membership(user, room: Room) -> Membership:
+def _join_room(request, room: Room) -> Membership:
     """
-    - si l'utilisateur n'a pas de membership: on l'ajoute MEMBER
-    - si il est BANNED: on refuse l'accès ailleurs
+    Seul point d'entrée qui écrit une adhésion (appelé par room_detail):
+    l'utilisateur est ajouté MEMBER s'il ne l'est pas encore.
+    Les endpoints d'API et de poll ne font qu'une lecture (_get_membership)
+    et répondent 403 aux non-membres, sans jamais prendre le verrou d'écriture.
     """
+    m = _get_membership(request, room)
+    if m is not None:
+        return m
+    user = request.user
     m, created = Membership.objects.get_or_create(user=user, room=room, defaults={"role": Membership.MEMBER})
+    request._chat_memberships[room.id] = m
     if created:
-        Message.objects.create(
-            room=room,
-            author=user,
-            content=f"[SYSTEM] {user.username} a rejoint le salon.",
-        )
+        services.member_changed(m)
+        services.post_system_message(room, user, f"{user.username} a rejoint le salon.")
     return m
 
 
@@ -67,23 +85,14 @@ def login_view(request):
 
 @login_required
 def room_list(request):
-    last_msg_qs = Message.objects.filter(room=OuterRef("pk")).order_by("-id")
-    last_created_at = Subquery(last_msg_qs.values("created_at")[:1])
-    epoch = timezone.datetime(1970, 1, 1, tzinfo=timezone.UTC)
-    rooms = (
-        Room.objects.all()
-        .annotate(
-            last_message_content=Subquery(last_msg_qs.values("content")[:1]),
-            last_message_author=Subquery(last_msg_qs.values("author__username")[:1]),
-            last_message_is_deleted=Subquery(last_msg_qs.values("is_deleted")[:1]),
-            last_message_created_at=last_created_at,
-            last_message_created_at_sort=Coalesce(
-                last_created_at, Value(epoch, output_field=DateTimeField())
-            ),
-        )
-        .order_by("-last_message_created_at_sort", "name")
+    return render(request, "chat/room_list.html", {"rooms": _rooms_for_listing()})
+
+
+def _rooms_for_listing():
+    # résumé du dernier message dénormalisé sur Room, tri sur un index
+    return Room.objects.select_related("created_by").order_by(
+        F("last_message_created_at").desc(nulls_last=True), "name"
     )
-    return render(request, "chat/room_list.html", {"rooms": rooms})
 
 
 @login_required
@@ -94,7 +103,9 @@ def room_create(request):
             room = form.save(commit=False)
             room.created_by = request.user
             room.save()
-            Membership.objects.create(user=request.user, room=room, role=Membership.OWNER)
+            owner = Membership.objects.create(user=request.user, room=room, role=Membership.OWNER)
+            services.member_changed(owner)
+            services.room_changed(room.id)
             return redirect("room_detail", room_id=room.id)
     else:
         form = RoomCreateForm()
@@ -105,7 +116,7 @@ def room_create(request):
 @login_required
 def room_detail(request, room_id: int):
     room = get_object_or_404(Room, id=room_id)
-    membership = Membership.objects.filter(user=request.user, room=room).first()
+    membership = _get_membership(request, room)
     if membership and membership.role == Membership.BANNED:
         return render(request, "chat/banned.html", {"room": room}, status=403)
 
@@ -114,7 +125,7 @@ def room_detail(request, room_id: int):
             if request.method == "POST":
                 provided = (request.POST.get("room_password") or "").strip()
                 if provided == room.password:
-                    membership = _ensure_membership(request.user, room)
+                    membership = _join_room(request, room)
                 else:
                     return render(
                         request,
@@ -130,15 +141,20 @@ def room_detail(request, room_id: int):
                     status=403,
                 )
         else:
-            membership = _ensure_membership(request.user, room)
-
-    # On affiche les 50 derniers messages au chargement
-    msgs = (
-        Message.objects.filter(room=room)
-        .select_related("author")
-        .order_by("-id")[:50]
-    )
-    msgs = list(reversed(msgs))
+            membership = _join_room(request, room)
+
+    # Seulement la dernière page au chargement, le reste via api_history
+    latest = services.recent_latest(room, HISTORY_PAGE_SIZE)
+    if latest is None:
+        rows = list(
+            Message.objects.filter(room=room)
+            .select_related("author")
+            .order_by("-id")[: HISTORY_PAGE_SIZE + 1]
+        )
+        has_older = len(rows) > HISTORY_PAGE_SIZE
+        latest = ([services.message_payload(m) for m in reversed(rows[:HISTORY_PAGE_SIZE])], has_older)
+    payloads, has_older = latest
+    msgs = [dict(p, created_at=datetime.fromisoformat(p["created_at"])) for p in payloads]
 
     role = membership.role
     members = (
@@ -162,6 +178,7 @@ def room_detail(request, room_id: int):
         {
             "room": room,
             "chat_messages": msgs,
+            "has_older": has_older,
             "role": role,
             "memberships": members,
         },
@@ -172,11 +189,16 @@ def room_detail(request, room_id: int):
 @login_required
 def room_delete(request, room_id: int):
     room = get_object_or_404(Room, id=room_id)
-    membership = _ensure_membership(request.user, room)
-    if membership.role != Membership.OWNER:
+    membership = _get_membership(request, room)
+    if not membership or membership.role != Membership.OWNER:
         return HttpResponseForbidden("Seul le owner peut supprimer ce salon.")
 
-    room.delete()
+    # suppression d'abord: la nouvelle version de la liste (après commit) ne
+    # doit pas pouvoir être mise en cache avec le salon encore dedans
+    with transaction.atomic():
+        room.delete()
+        services.room_changed(room_id, deleted=True)
+    recent.store.discard(room_id)
     dj_messages.error(request, "Salon supprimé.")
     return redirect("room_list")
 
@@ -185,8 +207,8 @@ def room_delete(request, room_id: int):
 @login_required
 def room_rename(request, room_id: int):
     room = get_object_or_404(Room, id=room_id)
-    membership = _ensure_membership(request.user, room)
-    if membership.role != Membership.OWNER:
+    membership = _get_membership(request, room)
+    if not membership or membership.role != Membership.OWNER:
         return HttpResponseForbidden("Seul le owner peut renommer ce salon.")
 
     new_name = (request.POST.get("name") or "").strip()
@@ -204,105 +226,400 @@ def room_rename(request, room_id: int):
 
     room.name = new_name
     room.save(update_fields=["name"])
+    services.room_changed(room.id)
     dj_messages.success(request, "Salon renommé.")
     return redirect("room_detail", room_id=room.id)
 
 
+def _poll_scope(request) -> str:
+    # le long-poll est réarmé à chaque réveil: dans un salon actif, il ne doit
+    # pas épuiser le seau de api_sync que le même client interroge à côté
+    return "longpoll" if _int_param(request.GET.get("wait")) else "poll"
+
+
+@poll_reads
 @require_GET
 @login_required
+@rate_limit(_poll_scope)
 def api_messages(request, room_id: int):
+    """
+    Messages après `after` et suppressions après `seq`. Avec `wait=<s>`
+    (long-poll, pour les proxys qui coupent SSE), la réponse attend jusqu'à
+    `wait` secondes qu'il y ait du nouveau.
+    """
     room = get_object_or_404(Room, id=room_id)
-    membership = _ensure_membership(request.user, room)
+    membership = _get_membership(request, room)
+    if not membership:
+        return JsonResponse({"error": "forbidden"}, status=403)
     if membership.role == Membership.BANNED:
         return JsonResponse({"error": "banned"}, status=403)
 
-    after = request.GET.get("after", "")
-    since = request.GET.get("since", "")
+    wait = min(_int_param(request.GET.get("wait")), LONG_POLL_MAX_WAIT)
+    if wait:
+        data = _wait_for_delta(request, room, membership.role, wait)
+    else:
+        data = _message_delta(request, room, membership.role)
+    data["next_poll_ms"] = services.poll_interval(room.last_message_created_at)
+    return wire.render(request, data)
+
+
+# Long-poll: au plus LONG_POLL_MAX_WAIT s, sous les timeouts usuels des proxys (30 s)
+LONG_POLL_MAX_WAIT = 25
+
+
+def _wait_for_delta(request, room: Room, role: str, wait: int) -> dict:
+    """
+    Le delta du poll, dès qu'il n'est plus vide ou après `wait` secondes.
+    L'attente se fait sur le bus (réveil à la publication), la base n'est
+    relue qu'au réveil, pas en boucle.
+    """
+    user_id = request.user.id
+    sub, data = pubsub.subscribe_and_read(lambda: _message_delta(request, room, role), room_channel(room.id))
+    with sub:
+        deadline = time.monotonic() + wait
+        while not data["messages"] and not data["deleted_ids"]:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            event = sub.get(timeout=remaining)
+            if event is None:
+                break
+            if (event["type"] == "room" and event["deleted"]) or (
+                event["type"] == "member" and event["user_id"] == user_id
+            ):
+                # salon supprimé, droits changés: réponse vide, le prochain poll revérifie
+                break
+            if event["type"] in ("message", "delete") or sub.take_overflow():
+                room.refresh_from_db(fields=["change_seq", "last_message_id", "last_message_created_at"])
+                data = _message_delta(request, room, role)
+    return data
+
+
+def _message_delta(request, room: Room, role: str) -> dict:
+    """Messages après `after` et changements après `seq` (paramètres GET du poll)."""
+    after_id = _int_param(request.GET.get("after"))
+
+    # par le tampon des derniers messages; la base seulement pour un id plus ancien
+    payloads = services.recent_messages_after(room, after_id, services.MESSAGES_PAGE_SIZE)
+    if payloads is not None:
+        data = [for_viewer(p, role, request.user.id) for p in payloads]
+    else:
+        data = [serialize_message(m, role, request.user.id) for m in services.messages_after(room.id, after_id)]
+
+    deleted_ids, seq = _changes_delta(request, room)
+    return {"messages": data, "deleted_ids": deleted_ids, "seq": seq}
+
+
+def _int_param(raw, default: int = 0) -> int:
     try:
-        after_id = int(after) if after else 0
+        return max(int(raw), 0) if raw else default
     except ValueError:
-        after_id = 0
-    since_dt = parse_datetime(since) if since else None
-    if since_dt and timezone.is_naive(since_dt):
-        since_dt = timezone.make_aware(since_dt, timezone.get_current_timezone())
-
-    qs = (
-        Message.objects.filter(room=room, id__gt=after_id)
-        .select_related("author")
-        .order_by("id")[:200]
-    )
+        return default
 
-    data = []
-    for m in qs:
-        data.append(
-            {
-                "id": m.id,
-                "author": m.author.username,
-                "content": "[message supprimé]" if m.is_deleted else m.content,
-                "created_at": m.created_at.isoformat(),
-                "is_deleted": m.is_deleted,
-                "can_delete": (membership.role in (Membership.OWNER, Membership.MOD)) or (m.author_id == request.user.id),
-            }
-        )
 
-    deleted_ids = []
-    if since_dt:
-        deleted_ids = list(
-            Message.objects.filter(room=room, is_deleted=True, edited_at__gt=since_dt)
-            .values_list("id", flat=True)
-        )
+def _version_param(raw):
+    # version d'état connue du client; None (état complet) si absente ou invalide
+    try:
+        version = int(raw)
+    except (TypeError, ValueError):
+        return None
+    return version if version >= 0 else None
 
-    return JsonResponse({"messages": data, "deleted_ids": deleted_ids, "server_now": timezone.now().isoformat()})
 
+def _changes_delta(request, room: Room):
+    # sans `seq` (premier poll), on part du dernier changement connu
+    seq = _int_param(request.GET.get("seq"), room.change_seq)
+    if seq >= room.change_seq:
+        return [], seq
+    return services.changes_after(room.id, seq)
 
-@require_POST
+
+# Historique paginé par clé (id), jamais par OFFSET: chaque page coûte
+# O(taille de page) quelle que soit la longueur de l'historique.
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+@poll_reads
+@require_GET
 @login_required
-def api_send_message(request, room_id: int):
+def api_history(request, room_id: int):
+    """
+    `before=<id>`: page précédente (scroll vers le haut); sans paramètre, la
+    dernière page. `after=<id>`: page suivante. `limit`: taille de page.
+    Avec `after` et `stream=1`, tout ce qui suit est envoyé en NDJSON, une
+    page à la fois, pour rattraper un long historique en une seule requête.
+    """
     room = get_object_or_404(Room, id=room_id)
-    membership = _ensure_membership(request.user, room)
+    membership = _get_membership(request, room)
+    if not membership:
+        return JsonResponse({"error": "forbidden"}, status=403)
     if membership.role == Membership.BANNED:
         return JsonResponse({"error": "banned"}, status=403)
 
-    content = (request.POST.get("content") or "").strip()
-    if not content:
-        return JsonResponse({"error": "empty"}, status=400)
-    if len(content) > 2000:
-        return JsonResponse({"error": "too_long"}, status=400)
+    limit = _int_param(request.GET.get("limit"), HISTORY_PAGE_SIZE) or HISTORY_PAGE_SIZE
+    limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+    role = membership.role
+    user_id = request.user.id
+    base = Message.objects.filter(room=room).select_related("author")
+
+    if "after" not in request.GET:
+        qs = base.order_by("-id")
+        if request.GET.get("before"):
+            qs = qs.filter(id__lt=_int_param(request.GET["before"]))
+        rows = list(qs[: limit + 1])
+        has_more = len(rows) > limit
+        rows = reversed(rows[:limit])
+    else:
+        after_id = _int_param(request.GET["after"])
+        if request.GET.get("stream") == "1":
+            return StreamingHttpResponse(
+                _history_stream(base, after_id, limit, role, user_id), content_type="application/x-ndjson"
+            )
+        rows = list(base.filter(id__gt=after_id).order_by("id")[: limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+    return wire.render(request, {"messages": [serialize_message(m, role, user_id) for m in rows], "has_more": has_more})
 
-    msg = Message.objects.create(room=room, author=request.user, content=content)
-    return JsonResponse(
-        {
-            "ok": True,
-            "message": {
-                "id": msg.id,
-                "author": msg.author.username,
-                "content": msg.content,
-                "created_at": msg.created_at.isoformat(),
-                "is_deleted": msg.is_deleted,
-                "can_delete": True,
-            },
-        }
+
+def _history_stream(base, after_id: int, limit: int, role: str, user_id: int):
+    while True:
+        page = list(base.filter(id__gt=after_id).order_by("id")[:limit])
+        if page:
+            yield "".join(json.dumps(serialize_message(m, role, user_id)) + "\n" for m in page)
+        if len(page) < limit:
+            return
+        after_id = page[-1].id
+
+
+@poll_reads
+@require_GET
+@login_required
+def api_search(request):
+    """Recherche dans tous les salons dont l'utilisateur est membre."""
+    return _search_response(request)
+
+
+@poll_reads
+@require_GET
+@login_required
+def api_room_search(request, room_id: int):
+    room = get_object_or_404(Room, id=room_id)
+    membership = _get_membership(request, room)
+    if not membership:
+        return JsonResponse({"error": "forbidden"}, status=403)
+    if membership.role == Membership.BANNED:
+        return JsonResponse({"error": "banned"}, status=403)
+    return _search_response(request, room.id)
+
+
+def _search_response(request, room_id: int = None):
+    # paramètres: q, cursor (renvoyé par la page précédente), limit
+    if not search.is_available():
+        return JsonResponse({"error": "search_unavailable"}, status=501)
+    query = (request.GET.get("q") or "").strip()
+    if not search.match_expression(query):
+        return JsonResponse({"error": "empty_query"}, status=400)
+    cursor = None
+    if request.GET.get("cursor"):
+        cursor = search.decode_cursor(request.GET["cursor"])
+        if cursor is None:
+            return JsonResponse({"error": "bad_cursor"}, status=400)
+    limit = _int_param(request.GET.get("limit"), search.SEARCH_PAGE_SIZE) or search.SEARCH_PAGE_SIZE
+
+    results, next_cursor = search.search_messages(
+        query, request.user.id, room_id, cursor, min(limit, search.SEARCH_MAX_PAGE_SIZE)
     )
+    return JsonResponse({"results": results, "next_cursor": next_cursor})
 
 
-@require_POST
+@poll_reads
+@require_GET
 @login_required
-def api_delete_message(request, room_id: int, message_id: int):
+@rate_limit("poll")
+def api_sync(request, room_id: int):
+    """
+    Un seul aller-retour par tick pour un salon ouvert, à la place des pollers
+    messages / typing / état: nouveaux messages (`after`, `seq`, sauf si
+    `messages=0` quand un flux SSE les livre déjà), utilisateurs en train
+    d'écrire, et état du salon seulement si `state_version` a changé (en
+    delta depuis cette version, cf. services.room_state).
+    """
     room = get_object_or_404(Room, id=room_id)
-    membership = _ensure_membership(request.user, room)
+    membership = _get_membership(request, room)
+    if not membership:
+        return JsonResponse({"error": "forbidden"}, status=403)
     if membership.role == Membership.BANNED:
         return JsonResponse({"error": "banned"}, status=403)
 
-    msg = get_object_or_404(Message, id=message_id, room=room)
+    if request.GET.get("messages") == "0":
+        data = {}
+    else:
+        data = _message_delta(request, room, membership.role)
+    data["typing"] = services.typing_users(membership, room.id, request.user.username)
+    data["state_version"] = room.state_version
+
+    state = services.room_state(room, membership, _version_param(request.GET.get("state_version")))
+    if not state.get("unchanged"):
+        data["state"] = state
+    data["next_poll_ms"] = services.poll_interval(room.last_message_created_at, bool(data["typing"]))
+    return wire.render(request, data)
 
-    is_mod = membership.role in (Membership.OWNER, Membership.MOD)
-    is_author = msg.author_id == request.user.id
-    if not (is_mod or is_author):
+
+# Flux SSE: une connexion ouverte par onglet au lieu d'un poll toutes les 1.5 s.
+# Les nouveautés arrivent par le bus (chat/pubsub.py); la base n'est relue qu'au
+# (re)démarrage, si la file de l'abonné a débordé, et par sécurité toutes les
+# SSE_HEARTBEAT_INTERVAL secondes d'inactivité.
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_MAX_DURATION = 55
+SSE_RETRY_MS = 2000
+SSE_QUEUE_SIZE = 256
+
+
+def _sse_event(event: str, data, event_id: str = "") -> str:
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _parse_stream_cursor(request, room: Room):
+    """
+    Curseur SSE "<after_id>:<seq>", relu depuis Last-Event-ID à la reconnexion;
+    sinon paramètres `after` et `seq` comme pour le poll.
+    """
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    if last_event_id:
+        after, _, seq = last_event_id.partition(":")
+        return _int_param(after), _int_param(seq)
+    return _int_param(request.GET.get("after")), _int_param(request.GET.get("seq"), room.change_seq)
+
+
+@require_GET
+@login_required
+def api_messages_stream(request, room_id: int):
+    """
+    Droits et curseur vérifiés ici (synchrone), le flux est un générateur
+    asynchrone: sous ASGI aucune thread n'est tenue pendant l'attente. Sous
+    WSGI le flux tiendrait un worker par onglet (et Django le mettrait en
+    tampon en entier): 503, le client passe au long-poll.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"error": "stream_unavailable"}, status=503)
+    room = get_object_or_404(Room, id=room_id)
+    membership = _get_membership(request, room)
+    if not membership:
+        return JsonResponse({"error": "forbidden"}, status=403)
+    if membership.role == Membership.BANNED:
+        return JsonResponse({"error": "banned"}, status=403)
+
+    after_id, seq = _parse_stream_cursor(request, room)
+    role = membership.role
+    user_id = request.user.id
+
+    def cursor() -> str:
+        return f"{after_id}:{seq}"
+
+    @sync_to_async
+    def read_delta(after: int, since: int):
+        msgs = services.messages_after(room.id, after)
+        deleted_ids, new_seq = services.changes_after(room.id, since)
+        return [serialize_message(m, role, user_id) for m in msgs], deleted_ids, new_seq
+
+    async def catch_up(page=None):
+        # page après page jusqu'au bout: un événement en direct ne doit pas
+        # avancer le curseur par-dessus des messages pas encore envoyés
+        nonlocal after_id, seq
+        while True:
+            msgs, deleted_ids, new_seq = page or await read_delta(after_id, seq)
+            page = None
+            more = len(msgs) == services.MESSAGES_PAGE_SIZE or new_seq != seq
+            seq = new_seq
+            for m in msgs:
+                after_id = m["id"]
+                yield _sse_event("message", m, cursor())
+            if deleted_ids:
+                yield _sse_event("delete", {"deleted_ids": deleted_ids, "seq": seq}, cursor())
+            if not more:
+                return
+
+    async def stream():
+        nonlocal after_id, seq, role
+        sub, page = await pubsub.asubscribe_and_read(
+            lambda: read_delta(after_id, seq), room_channel(room.id), maxsize=SSE_QUEUE_SIZE
+        )
+        with sub:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            async for chunk in catch_up(page):
+                yield chunk
+            # La connexion est fermée régulièrement: le client se reconnecte avec
+            # Last-Event-ID, ce qui re-vérifie les droits.
+            deadline = time.monotonic() + SSE_MAX_DURATION
+            while time.monotonic() < deadline:
+                event = await sub.aget(timeout=min(SSE_HEARTBEAT_INTERVAL, max(deadline - time.monotonic(), 0)))
+                if sub.take_overflow() or event is None:
+                    async for chunk in catch_up():
+                        yield chunk
+                if event is None:
+                    # un événement et non un commentaire: le client doit le voir
+                    yield _sse_event("ping", {})
+                    continue
+
+                # déjà envoyés par le rattrapage: ignorés
+                if event["type"] == "message":
+                    if event["message"]["id"] > after_id:
+                        after_id = event["message"]["id"]
+                        yield _sse_event("message", for_viewer(event["message"], role, user_id), cursor())
+                elif event["type"] == "delete":
+                    if event["seq"] > seq:
+                        seq = event["seq"]
+                        yield _sse_event("delete", {"deleted_ids": [event["message_id"]], "seq": seq}, cursor())
+                elif event["type"] == "member" and event["user_id"] == user_id:
+                    if event["role"] == Membership.BANNED:
+                        return
+                    role = event["role"]
+                elif event["type"] == "room" and event["deleted"]:
+                    return
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@require_POST
+@login_required
+@rate_limit("send")
+def api_send_message(request, room_id: int):
+    room = get_object_or_404(Room, id=room_id)
+    membership = _get_membership(request, room)
+    if not membership:
         return JsonResponse({"error": "forbidden"}, status=403)
+    try:
+        msg = services.send_message(request.user, room, membership, request.POST.get("content"))
+    except ChatError as e:
+        return JsonResponse({"error": e.code}, status=e.status)
+    return JsonResponse({"ok": True, "message": serialize_message(msg, membership.role, request.user.id)})
+
 
-    msg.is_deleted = True
-    msg.edited_at = timezone.now()
-    msg.save(update_fields=["is_deleted", "edited_at"])
+@require_POST
+@login_required
+def api_delete_message(request, room_id: int, message_id: int):
+    room = get_object_or_404(Room, id=room_id)
+    membership = _get_membership(request, room)
+    if not membership:
+        return JsonResponse({"error": "forbidden"}, status=403)
+    if membership.role == Membership.BANNED:
+        return JsonResponse({"error": "banned"}, status=403)
+
+    msg = get_object_or_404(Message, id=message_id, room=room)
+    try:
+        services.delete_message(request.user, membership, msg)
+    except ChatError as e:
+        return JsonResponse({"error": e.code}, status=e.status)
     return JsonResponse({"ok": True})
 
 
@@ -310,8 +627,8 @@ def api_delete_message(request, room_id: int, message_id: int):
 @login_required
 def ban_user(request, room_id: int, user_id: int):
     room = get_object_or_404(Room, id=room_id)
-    actor = _ensure_membership(request.user, room)
-    if actor.role not in (Membership.OWNER, Membership.MOD):
+    actor = _get_membership(request, room)
+    if not actor or actor.role not in (Membership.OWNER, Membership.MOD):
         return JsonResponse({"error": "forbidden"}, status=403)
 
     target = get_object_or_404(Membership, room=room, user_id=user_id)
@@ -320,11 +637,8 @@ def ban_user(request, room_id: int, user_id: int):
 
     target.role = Membership.BANNED
     target.save(update_fields=["role"])
-    Message.objects.create(
-        room=room,
-        author=actor.user,
-        content=f"[SYSTEM] {target.user.username} a été banni du salon.",
-    )
+    services.member_changed(target)
+    services.post_system_message(room, request.user, f"{target.user.username} a été banni du salon.")
     return redirect("room_detail", room_id=room.id)
 
 
@@ -332,8 +646,8 @@ def ban_user(request, room_id: int, user_id: int):
 @login_required
 def unban_user(request, room_id: int, user_id: int):
     room = get_object_or_404(Room, id=room_id)
-    actor = _ensure_membership(request.user, room)
-    if actor.role not in (Membership.OWNER, Membership.MOD):
+    actor = _get_membership(request, room)
+    if not actor or actor.role not in (Membership.OWNER, Membership.MOD):
         return JsonResponse({"error": "forbidden"}, status=403)
 
     target = get_object_or_404(Membership, room=room, user_id=user_id)
@@ -342,11 +656,8 @@ def unban_user(request, room_id: int, user_id: int):
 
     target.role = Membership.MEMBER
     target.save(update_fields=["role"])
-    Message.objects.create(
-        room=room,
-        author=actor.user,
-        content=f"[SYSTEM] {target.user.username} a été débanni du salon.",
-    )
+    services.member_changed(target)
+    services.post_system_message(room, request.user, f"{target.user.username} a été débanni du salon.")
     return redirect("room_detail", room_id=room.id)
 
 
@@ -354,8 +665,8 @@ def unban_user(request, room_id: int, user_id: int):
 @login_required
 def set_moderator(request, room_id: int, user_id: int):
     room = get_object_or_404(Room, id=room_id)
-    actor = _ensure_membership(request.user, room)
-    if actor.role != Membership.OWNER:
+    actor = _get_membership(request, room)
+    if not actor or actor.role != Membership.OWNER:
         return JsonResponse({"error": "forbidden"}, status=403)
 
     target = get_object_or_404(Membership, room=room, user_id=user_id)
@@ -364,11 +675,8 @@ def set_moderator(request, room_id: int, user_id: int):
 
     target.role = Membership.MOD
     target.save(update_fields=["role"])
-    Message.objects.create(
-        room=room,
-        author=actor.user,
-        content=f"[SYSTEM] {target.user.username} est maintenant modérateur.",
-    )
+    services.member_changed(target)
+    services.post_system_message(room, request.user, f"{target.user.username} est maintenant modérateur.")
     return redirect("room_detail", room_id=room.id)
 
 
@@ -376,8 +684,8 @@ def set_moderator(request, room_id: int, user_id: int):
 @login_required
 def unset_moderator(request, room_id: int, user_id: int):
     room = get_object_or_404(Room, id=room_id)
-    actor = _ensure_membership(request.user, room)
-    if actor.role != Membership.OWNER:
+    actor = _get_membership(request, room)
+    if not actor or actor.role != Membership.OWNER:
         return JsonResponse({"error": "forbidden"}, status=403)
 
     target = get_object_or_404(Membership, room=room, user_id=user_id)
@@ -386,11 +694,8 @@ def unset_moderator(request, room_id: int, user_id: int):
 
     target.role = Membership.MEMBER
     target.save(update_fields=["role"])
-    Message.objects.create(
-        room=room,
-        author=actor.user,
-        content=f"[SYSTEM] {target.user.username} n'est plus modérateur.",
-    )
+    services.member_changed(target)
+    services.post_system_message(room, request.user, f"{target.user.username} n'est plus modérateur.")
     return redirect("room_detail", room_id=room.id)
 
 
@@ -400,91 +705,94 @@ def custom_logout(request):
     return redirect("login")
 
 
+# Le payload de la liste est le même pour tous les utilisateurs: il est
+# sérialisé une fois par version (services.room_list_version) et les onglets
+# du lobby qui renvoient l'ETag reçoivent un 304 sans corps.
+ROOM_LIST_CACHE_TIMEOUT = 300
+
+
+def _room_list_etag(request) -> str:
+    return f"rooms-{services.room_list_version()}"
+
+
+@poll_reads
 @require_GET
 @login_required
+@condition(etag_func=_room_list_etag)
 def api_room_list(request):
-    last_msg_qs = Message.objects.filter(room=OuterRef("pk")).order_by("-id")
-    last_created_at = Subquery(last_msg_qs.values("created_at")[:1])
-    epoch = timezone.datetime(1970, 1, 1, tzinfo=timezone.UTC)
-    rooms = (
-        Room.objects.all()
-        .annotate(
-            last_message_content=Subquery(last_msg_qs.values("content")[:1]),
-            last_message_author=Subquery(last_msg_qs.values("author__username")[:1]),
-            last_message_is_deleted=Subquery(last_msg_qs.values("is_deleted")[:1]),
-            last_message_created_at=last_created_at,
-            last_message_created_at_sort=Coalesce(
-                last_created_at, Value(epoch, output_field=DateTimeField())
-            ),
-        )
-        .order_by("-last_message_created_at_sort", "name")
-    )
-
-    data = []
-    for r in rooms:
-        data.append(
-            {
-                "id": r.id,
-                "name": r.name,
-                "has_password": bool(r.password),
-                "created_by": r.created_by.username,
-                "last_message_content": r.last_message_content,
-                "last_message_author": r.last_message_author,
-                "last_message_is_deleted": r.last_message_is_deleted,
-                "last_message_created_at": r.last_message_created_at.isoformat()
-                if r.last_message_created_at
-                else None,
-            }
-        )
+    version = services.room_list_version()
+    key = f"room_list_payload_{version}"
+    body = cache.get(key)
+    metrics.cache_lookup("room_list", body is not None)
+    if body is None:
+        data = []
+        rooms = list(_rooms_for_listing())
+        for r in rooms:
+            data.append(
+                {
+                    "id": r.id,
+                    "name": r.name,
+                    "has_password": bool(r.password),
+                    "created_by": r.created_by.username,
+                    "last_message_content": r.last_message_content if r.last_message_id else None,
+                    "last_message_author": r.last_message_author if r.last_message_id else None,
+                    "last_message_is_deleted": r.last_message_is_deleted if r.last_message_id else None,
+                    "last_message_created_at": r.last_message_created_at.isoformat()
+                    if r.last_message_created_at
+                    else None,
+                }
+            )
+        # le premier salon est le plus récemment actif; les 304 suivants, le client les espace lui-même
+        last_activity = rooms[0].last_message_created_at if rooms else None
+        body = json.dumps({"rooms": data, "next_poll_ms": services.poll_interval(last_activity)})
+        cache.set(key, body, timeout=ROOM_LIST_CACHE_TIMEOUT)
 
-    return JsonResponse({"rooms": data})
+    response = HttpResponse(body, content_type="application/json")
+    # le navigateur garde la réponse mais revalide à chaque fois (If-None-Match)
+    response["Cache-Control"] = "private, no-cache"
+    return response
 
 
+@poll_reads
 @require_GET
 @login_required
 def api_room_state(request, room_id: int):
+    """`version`: dernière version reçue -> "unchanged" ou delta des membres."""
     room = get_object_or_404(Room, id=room_id)
-    membership = Membership.objects.filter(user=request.user, room=room).first()
-    if membership and membership.role == Membership.BANNED:
-        return JsonResponse({"error": "banned"}, status=403)
-    if not membership:
-        return JsonResponse({"error": "forbidden"}, status=403)
-
-    members = list(
-        Membership.objects.filter(room=room)
-        .select_related("user")
-        .values("user_id", "user__username", "role")
-    )
-
-    data = {
-        "room": {"id": room.id, "name": room.name},
-        "role": membership.role,
-        "members": [
-            {"user_id": m["user_id"], "username": m["user__username"], "role": m["role"]}
-            for m in members
-        ],
-    }
+    membership = _get_membership(request, room)
+    try:
+        data = services.room_state(room, membership, _version_param(request.GET.get("version")))
+    except ChatError as e:
+        return JsonResponse({"error": e.code}, status=e.status)
+    data["next_poll_ms"] = services.poll_interval(room.last_message_created_at)
     return JsonResponse(data)
 
 
 @require_http_methods(["GET", "POST"])
 @login_required
+@rate_limit("typing", methods=("POST",))
+@rate_limit("poll", methods=("GET",))
 def api_typing(request, room_id: int):
     room = get_object_or_404(Room, id=room_id)
-    membership = Membership.objects.filter(user=request.user, room=room).first()
-    if not membership or membership.role == Membership.BANNED:
-        return JsonResponse({"error": "forbidden"}, status=403)
-
+    membership = _get_membership(request, room)
     user = request.user.username
-    now = time.time()
-    key = f"typing_{room_id}"
-    room_dict = cache.get(key, {})
+    try:
+        if request.method == "POST":
+            services.mark_typing(membership, room.id, user)
+            return JsonResponse({"ok": True})
+        typing = services.typing_users(membership, room.id, user)
+        return JsonResponse(
+            {"typing": typing, "next_poll_ms": services.poll_interval(room.last_message_created_at, bool(typing))}
+        )
+    except ChatError as e:
+        return JsonResponse({"error": e.code}, status=e.status)
 
-    if request.method == "POST":
-        room_dict[user] = now
-        cache.set(key, room_dict, timeout=5)
-        return JsonResponse({"ok": True})
 
-    active_users = [u for u, t in room_dict.items() if now - t <= 1.5 and u != user]
-    cache.set(key, {u: t for u, t in room_dict.items() if now - t <= 1.5}, timeout=5)
-    return JsonResponse({"typing": active_users})
+@require_GET
+def metrics_export(request):
+    """Mesures de ce processus au format texte Prometheus: compte staff ou jeton CHAT_METRICS["TOKEN"]."""
+    token = metrics.conf("TOKEN")
+    bearer = request.headers.get("Authorization", "")
+    if not (request.user.is_staff or (token and constant_time_compare(bearer, f"Bearer {token}"))):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,83 @@
+"""
+Format des réponses qui portent des messages (api_messages, api_history,
+api_sync), choisi par le paramètre `format` ou l'en-tête Accept:
+
+    - json (défaut): "messages" est une liste d'objets.
+    - columnar (application/vnd.djangochat.columnar+json): "messages" en
+      colonnes, auteurs dédupliqués ("authors" + index), dates en ms epoch.
+    - msgpack (application/msgpack): le même contenu que columnar, en
+      MessagePack. Module `msgpack` optionnel: sans lui, réponse columnar.
+
+La compression (gzip, brotli) est faite par chat.middleware.CompressionMiddleware.
+"""
+import json
+from datetime import datetime
+
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import msgpack
+except ImportError:  # dépendance optionnelle
+    msgpack = None
+
+COLUMNAR_CONTENT_TYPE = "application/vnd.djangochat.columnar+json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+FORMATS = ("json", "columnar", "msgpack")
+
+
+def negotiate(request) -> str:
+    fmt = request.GET.get("format")
+    if fmt not in FORMATS:
+        accept = request.headers.get("Accept", "")
+        if MSGPACK_CONTENT_TYPE in accept:
+            fmt = "msgpack"
+        elif COLUMNAR_CONTENT_TYPE in accept:
+            fmt = "columnar"
+        else:
+            fmt = "json"
+    if fmt == "msgpack" and msgpack is None:
+        fmt = "columnar"
+    return fmt
+
+
+def _epoch_ms(iso: str) -> int:
+    return int(datetime.fromisoformat(iso).timestamp() * 1000)
+
+
+def columnar(messages: list) -> dict:
+    """Liste de messages (serialize_message) -> une liste par champ."""
+    authors = {}
+    cols = {
+        "id": [],
+        "author": [],
+        "content": [],
+        "created_at": [],
+        "is_deleted": [],
+        "can_delete": [],
+    }
+    for m in messages:
+        cols["id"].append(m["id"])
+        cols["author"].append(authors.setdefault(m["author"], len(authors)))
+        cols["content"].append(m["content"])
+        cols["created_at"].append(_epoch_ms(m["created_at"]))
+        cols["is_deleted"].append(m["is_deleted"])
+        cols["can_delete"].append(m["can_delete"])
+    cols["authors"] = list(authors)
+    return cols
+
+
+def render(request, data: dict) -> HttpResponse:
+    fmt = negotiate(request)
+    if fmt == "json":
+        response = JsonResponse(data)
+    else:
+        if "messages" in data:
+            data = dict(data, messages=columnar(data["messages"]))
+        if fmt == "msgpack":
+            response = HttpResponse(msgpack.packb(data, use_bin_type=True), content_type=MSGPACK_CONTENT_TYPE)
+        else:
+            response = HttpResponse(json.dumps(data, separators=(",", ":")), content_type=COLUMNAR_CONTENT_TYPE)
+    patch_vary_headers(response, ("Accept",))
+    return response
@@ -2,4 +2,14 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djangochat.settings")
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# importé après get_asgi_application(): les apps doivent être chargées
+from chat.consumers import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
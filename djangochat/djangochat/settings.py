@@ -22,7 +22,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # en tête: mesure toute la pile (chat/metrics.py)
+    "chat.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    # gzip / brotli des réponses d'API (chat/middleware.py)
+    "chat.middleware.CompressionMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -51,12 +55,47 @@ TEMPLATES = [
 WSGI_APPLICATION = "djangochat.wsgi.application"
 
 
-# DB (SQLite)
+# DB (SQLite), profil de production: voir chat/db.py
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;"
+    "PRAGMA synchronous=NORMAL;"
+    "PRAGMA mmap_size=268435456;"  # 256 Mo
+    "PRAGMA cache_size=-65536;"  # 64 Mo
+    "PRAGMA temp_store=MEMORY;"
+)
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
-    }
+        "OPTIONS": {
+            "init_command": SQLITE_PRAGMAS,
+            "transaction_mode": "IMMEDIATE",
+            "timeout": 20,  # busy timeout (s)
+        },
+    },
+}
+
+# Lecture séparée (optionnelle): même fichier, connexion query_only pour les
+# vues de poll. Décommenter et mettre CHAT_DB["READ_ALIAS"] = "reader".
+# DATABASES["reader"] = {
+#     "ENGINE": "django.db.backends.sqlite3",
+#     "NAME": BASE_DIR / "db.sqlite3",
+#     "OPTIONS": {"init_command": SQLITE_PRAGMAS + "PRAGMA query_only=ON;", "timeout": 20},
+#     "TEST": {"MIRROR": "default"},
+# }
+
+DATABASE_ROUTERS = ["chat.db.ReadAliasRouter"]
+
+CHAT_DB = {
+    # alias des lectures de poll (chat.db.poll_reads); None: tout par "default"
+    "READ_ALIAS": None,
+    # une insertion de message à la fois par processus (chat.db.message_writer)
+    "SERIALIZE_MESSAGE_WRITES": True,
+    # group commit des insertions de messages (chat.db.GroupCommitWriter)
+    "BATCH_WRITES": False,
+    "BATCH_WINDOW": 0.005,  # s
+    "BATCH_MAX": 100,
 }
 
 
@@ -72,13 +111,73 @@ STATICFILES_DIRS = []
 STATIC_ROOT = BASE_DIR / "static"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Le cache porte aussi la version de la liste des salons (api_room_list):
+# en multi-process, un backend partagé (fichier, base, memcached...) évite
+# qu'un worker serve une liste périmée jusqu'à ROOM_LIST_CACHE_TIMEOUT.
+# Les adhésions (rôles, bannissements) y sont mises en cache sous une clé qui
+# porte la state_version du salon: un cache propre à chaque worker ne sert
+# jamais un rôle périmé. Ne pas y mettre d'autre donnée de droits sans clé
+# versionnée de la même façon.
+# Une entrée d'adhésion par (utilisateur, salon, version): MAX_ENTRIES est
+# dimensionné pour elles. Au-delà, LocMemCache jette un tiers des clés les
+# moins récemment lues, room_list_version et les payloads de liste compris.
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "LOCATION": "chat-typing",
+        "LOCATION": "chat",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 50000, "CULL_FREQUENCY": 3},
     }
 }
 
+# Bus pub/sub des salons (chat/pubsub.py). En multi-process (gunicorn -w N),
+# utiliser "chat.pubsub.SQLiteBackend" pour que les workers se voient.
+CHAT_BUS = {
+    "BACKEND": "chat.pubsub.InMemoryBackend",
+    # "BACKEND": "chat.pubsub.SQLiteBackend",
+    # "OPTIONS": {"PATH": BASE_DIR / "bus.sqlite3", "POLL_INTERVAL": 0.05},
+}
+
+# "En train d'écrire" (chat/presence.py): SQLiteBackend dès qu'il y a plusieurs workers
+CHAT_TYPING = {
+    "BACKEND": "chat.presence.InMemoryBackend",
+    # "BACKEND": "chat.presence.SQLiteBackend",
+    # "OPTIONS": {"PATH": BASE_DIR / "presence.sqlite3"},
+}
+
+# Tampon des derniers messages par salon, en mémoire de chaque processus
+# (chat/recent.py): PER_ROOM messages au plus, MAX_BYTES pour tous les salons.
+CHAT_RECENT = {
+    "ENABLED": True,
+    "PER_ROOM": 200,
+    "MAX_BYTES": 16 * 1024 * 1024,
+}
+
+# Mesures par vue (chat/metrics.py), exposées sur /metrics/ aux comptes staff
+# ou avec "Authorization: Bearer <TOKEN>". SAMPLE_RATE: fraction des requêtes mesurées.
+CHAT_METRICS = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 1.0,
+    "TOKEN": None,
+}
+
+# Débit par utilisateur et par salon (chat/ratelimit.py): (jetons par seconde, rafale).
+# "poll" couvre api_messages, api_sync et le GET de api_typing; "longpoll" les
+# api_messages?wait=, réarmés à chaque message. ROOMS surcharge un salon, p. ex.
+# {42: {"send": (0.2, 2)}} pour un mode lent.
+CHAT_RATELIMIT = {
+    "BACKEND": "chat.ratelimit.InMemoryBackend",
+    # "BACKEND": "chat.ratelimit.SQLiteBackend",
+    # "OPTIONS": {"PATH": BASE_DIR / "ratelimit.sqlite3"},
+    "RATES": {
+        "send": (1, 5),
+        "typing": (2, 4),
+        "poll": (3, 10),
+        "longpoll": (5, 20),
+    },
+    "ROOMS": {},
+}
+
 LOGIN_URL = "login"
 LOGIN_REDIRECT_URL = "room_list"
 LOGOUT_REDIRECT_URL = "login"